@@ -0,0 +1,297 @@
+"""
+Benchmarks for each stage of the trd-cli pipeline.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmarks --sizes 1000 10000 --output results.json --baseline baseline.json
+
+Each stage is timed on synthetic data (see `trd_cli.synthetic`) at each size, where the size is the number of
+questionnaire responses (with a tenth as many patients).
+Results are written as JSON. If a baseline (a previous results file) is given, any stage that has become more than
+`--threshold` times slower fails the run, as does any stage whose time grows much faster than the data.
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from typing import Callable, Dict, List, Tuple
+from unittest import skipUnless
+
+from click.testing import CliRunner
+
+from trd_cli.main import run
+from trd_cli.main_functions import compare_tc_to_rc, extract_redcap_ids
+from trd_cli.parse_tc import parse_tc
+from trd_cli.questionnaires import QUESTIONNAIRES, REGISTRY, build_redcap_structure, get_redcap_structure, \
+    questionnaire_to_rc_record
+from trd_cli.synthetic import SyntheticArchive
+
+from tests.fake_redcap import FakeRedcap, TOKEN
+
+DEFAULT_SIZES = [1000, 10000]
+# The results the suite is compared to by default, with the machine they were recorded on in their "meta"
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 1.5
+# The time per row may grow at most this many times as the data grows (quadratic code's grows with the data)
+DEFAULT_MAX_SCALING = 3
+# Times below this are too noisy to compare
+MIN_SECONDS = 0.005
+
+# Tests that compare wall-clock times are too noisy (and slow) for every run of the test suite, so are opt-in
+requires_benchmarks = skipUnless(os.environ.get("TRD_BENCHMARKS"), "Set TRD_BENCHMARKS=1 to run the timing benchmarks")
+
+
+def import_time(module: str) -> Tuple[float, List[str]]:
+    """
+    Import `module` in a new interpreter with `python -X importtime`.
+
+    Return the cumulative seconds it reports for `module`, and the names of all the modules that were imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    seconds = None
+    modules = []
+    for line in result.stderr.splitlines():
+        # e.g. "import time:      5210 |      78447 | trd_cli.main", after a header line.
+        # Anything else on stderr (e.g. a warning) is skipped.
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        _self_us, cumulative_us, name = [f.strip() for f in fields]
+        if not cumulative_us.isdigit():
+            continue
+        modules.append(name)
+        if name == module:
+            seconds = int(cumulative_us) / 1e6
+    return seconds, modules
+
+
+def run_cli(*args: str):
+    """
+    Run `trd-cli` with `args` in a new interpreter, as it is run from the shell.
+    """
+    subprocess.run([sys.executable, "-m", "trd_cli.main", *args], stdout=subprocess.DEVNULL, check=True)
+
+
+def best_time(fn: Callable, repeats: int = 3) -> float:
+    """
+    Return the fastest wall time of `repeats` calls to `fn`.
+
+    Garbage collection is paused while timing (as `timeit` does) so that it doesn't add noise.
+    """
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return min(times)
+
+
+class BenchmarkData:
+    """
+    The synthetic data for benchmarking at a single size, written to `directory`.
+    """
+    def __init__(self, size: int, directory: str, seed: int = 0):
+        self.size = size
+        self.archive = SyntheticArchive(max(size // 10, 1), size, seed=seed)
+        self.path = os.path.join(directory, f"tc-{size}.zip")
+        self.archive.write(self.path)
+        self.tc_data = self.archive.tc_data()
+        self.full_export = self.archive.redcap_export(synced=1)
+        self.partial_export = self.archive.redcap_export(synced=0.5)
+        self.log_dir = os.path.join(directory, f"logs-{size}")
+        self.submitted = [r for r in self.archive.responses if r["interoperability"] is not None]
+
+    def responses_for(self, code: str) -> List[dict]:
+        name = REGISTRY.get_by_code(code)["name"]
+        return [r for r in self.submitted if r["interoperability"]["title"] == name]
+
+
+def stages(data: BenchmarkData, stack: ExitStack) -> Dict[str, Callable]:
+    """
+    Return a function to time for each stage of the pipeline, run on `data`.
+    """
+    redcap_data = extract_redcap_ids(data.partial_export)
+    out = {
+        "parse_tc": lambda: parse_tc(data.path),
+        "extract_redcap_ids": lambda: extract_redcap_ids(data.full_export),
+        "compare_tc_to_rc": lambda: compare_tc_to_rc(data.tc_data, redcap_data),
+        "questionnaire_to_rc_record": lambda: [questionnaire_to_rc_record(r) for r in data.submitted],
+        "get_redcap_structure": get_redcap_structure,
+        "build_redcap_structure": lambda: build_redcap_structure(QUESTIONNAIRES),
+        # Start-up time, including the interpreter's own
+        "startup.help": lambda: run_cli("--help"),
+        "startup.dump": lambda: run_cli("dump"),
+    }
+    for q in QUESTIONNAIRES:
+        responses = data.responses_for(q["code"])
+        out[f"conversion_fn.{q['code']}"] = lambda q=q, responses=responses: [
+            q["conversion_fn"](q, r) for r in responses
+        ]
+
+    fake = stack.enter_context(FakeRedcap())
+
+    def run_command():
+        fake.rows.clear()
+        fake.load(data.partial_export)
+        result = CliRunner().invoke(
+            run,
+            ["--rc-url", fake.url, "--rc-token", TOKEN, "--tc-archive", data.path, "--log-dir", data.log_dir],
+            env={"TRD_MAILTO_ADDRESS": None},
+        )
+        if result.exit_code != 0:
+            raise RuntimeError(f"trd-cli run failed: {result.output}")
+
+    out["run"] = run_command
+    return out
+
+
+# Stages whose work doesn't depend on the amount of data
+FIXED_SIZE_STAGES = ["get_redcap_structure", "build_redcap_structure", "startup.help", "startup.dump"]
+
+
+def run_benchmarks(
+        sizes: List[int] = None,
+        repeats: int = 3,
+        only: List[str] = None,
+        seed: int = 0,
+) -> dict:
+    """
+    Time each stage at each of `sizes` and return the results.
+
+    `only` limits the benchmarks to the stages named (or prefixed, e.g. `conversion_fn`).
+    """
+    sizes = sizes if sizes is not None else DEFAULT_SIZES
+    results: Dict[str, Dict[str, float]] = {}
+    # The stages log warnings about the deliberately incomplete responses, which would swamp the output
+    logging.disable(logging.WARNING)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                data = BenchmarkData(size, directory, seed=seed)
+                with ExitStack() as stack:
+                    for name, fn in stages(data, stack).items():
+                        if only and not any(name == o or name.startswith(f"{o}.") for o in only):
+                            continue
+                        results.setdefault(name, {})[str(size)] = best_time(fn, repeats=repeats)
+    finally:
+        logging.disable(logging.NOTSET)
+    return {
+        "meta": {
+            "datetime": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": repeats,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(
+        results: dict,
+        baseline: dict,
+        threshold: float = DEFAULT_THRESHOLD,
+) -> List[Tuple[str, str, float, float]]:
+    """
+    Return (stage, size, baseline seconds, seconds) for each stage that is over `threshold` times slower than
+    in `baseline`.
+
+    Stages and sizes that aren't in both are ignored, and times below `MIN_SECONDS` count as `MIN_SECONDS`.
+    """
+    regressions = []
+    for stage, times in results["results"].items():
+        for size, seconds in times.items():
+            base = baseline["results"].get(stage, {}).get(size)
+            if base is None:
+                continue
+            if max(seconds, MIN_SECONDS) > max(base, MIN_SECONDS) * threshold:
+                regressions.append((stage, size, base, seconds))
+    return regressions
+
+
+def check_scaling(
+        results: dict,
+        max_scaling: float = DEFAULT_MAX_SCALING,
+) -> List[Tuple[str, str, str, float]]:
+    """
+    Return (stage, size, larger size, time ratio) for each stage whose time grows more than `max_scaling` times
+    faster than the data between consecutive sizes.
+
+    E.g. with the default, 10x the data may take at most 30x the time,
+    which leaves room for noise while catching quadratic code (which takes ~100x).
+    """
+    violations = []
+    for stage, times in results["results"].items():
+        if stage in FIXED_SIZE_STAGES:
+            continue
+        sizes = sorted(times.keys(), key=int)
+        for small, large in zip(sizes, sizes[1:]):
+            small_time = max(times[small], MIN_SECONDS)
+            ratio = max(times[large], MIN_SECONDS) / small_time
+            if ratio > int(large) / int(small) * max_scaling:
+                violations.append((stage, small, large, ratio))
+    return violations
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Numbers of responses.")
+    parser.add_argument("--repeats", type=int, default=3, help="Times to run each stage (the best is kept).")
+    parser.add_argument("--only", nargs="+", help="Only run these stages.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data.")
+    parser.add_argument("--output", help="Write the results (JSON) to this file.")
+    parser.add_argument("--baseline", help="Compare the results to this results file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=float(os.environ.get("TRD_BENCHMARK_THRESHOLD", DEFAULT_THRESHOLD)),
+        help=f"Fail if a stage is this many times slower than the baseline (default {DEFAULT_THRESHOLD}).",
+    )
+    parser.add_argument(
+        "--max-scaling",
+        type=float,
+        default=DEFAULT_MAX_SCALING,
+        help=f"Fail if a stage's time grows this many times faster than the data (default {DEFAULT_MAX_SCALING}).",
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sizes=args.sizes, repeats=args.repeats, only=args.only, seed=args.seed)
+    for stage, times in results["results"].items():
+        print(f"{stage:40s} " + "  ".join(f"{size:>7s}: {t:8.4f}s" for size, t in times.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    failed = False
+    for stage, small, large, ratio in check_scaling(results, max_scaling=args.max_scaling):
+        print(f"SCALING: {stage} took {ratio:.1f}x as long for {large} as for {small}", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for stage, size, base, seconds in compare_to_baseline(results, baseline, threshold=args.threshold):
+            print(f"REGRESSION: {stage} at {size} took {seconds:.4f}s (baseline {base:.4f}s)", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
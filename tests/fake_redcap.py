@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+from trd_cli.questionnaires import get_redcap_structure
+
+# PyCap checks that tokens are 32 characters long
+TOKEN = "0123456789ABCDEF0123456789ABCDEF"
+
+
+def default_metadata() -> List[dict]:
+    """
+    Return REDCap metadata for a project set up as described by `trd-cli dump`.
+    """
+    metadata = [{"field_name": "study_id", "form_name": "private", "field_type": "text"}]
+    for form, fields in get_redcap_structure().items():
+        metadata.extend({"field_name": f, "form_name": form, "field_type": "text"} for f in fields)
+    return metadata
+
+
+class FakeRedcap:
+    """
+    A local stand-in for the REDCap API, for exercising and benchmarking trd-cli without a network.
+
+    It implements the API requests trd-cli makes through PyCap: exporting records (optionally for a list
+    of fields), importing records, generating the next record name, and exporting metadata.
+    Records are stored flat, one row per (study_id, repeat instrument, repeat instance), as REDCap does.
+
+    Use as a context manager; `url` is the API endpoint to connect to and `TOKEN` is the API token.
+
+    :param latency: seconds to wait before answering each request
+    :param fail_requests: the number of requests to fail (with a 500 error) before behaving normally
+    :param reject: imports containing any record for which this returns True are rejected (with a 400 error)
+    :param max_payload_bytes: requests larger than this are rejected (with a 413 error), as by a web server limit
+    :param metadata: the project's fields, by default those listed by `trd-cli dump`
+    """
+    def __init__(
+            self,
+            latency: float = 0.0,
+            fail_requests: int = 0,
+            reject: Optional[Callable[[dict], bool]] = None,
+            max_payload_bytes: Optional[int] = None,
+            metadata: Optional[List[dict]] = None,
+    ):
+        self.latency = latency
+        self.fail_requests = fail_requests
+        self.reject = reject
+        self.max_payload_bytes = max_payload_bytes
+        self.metadata = metadata if metadata is not None else default_metadata()
+        self.fields = [m["field_name"] for m in self.metadata]
+        # (study_id, redcap_repeat_instrument, redcap_repeat_instance) -> row
+        self.rows: Dict[tuple, dict] = {}
+        # Everything imported, in the order it arrived
+        self.records = []
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/api/"
+
+    def __enter__(self):
+        # Check for shutdown often, so tests don't wait the default half second for each server to stop
+        threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        return self
+
+    def __exit__(self, *_args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def load(self, records: List[dict]):
+        """
+        Store `records` (e.g. a saved REDCap export) as though they had been imported.
+        """
+        for r in records:
+            self._store(r)
+
+    def _store(self, record: dict):
+        key = (
+            str(record["study_id"]),
+            record.get("redcap_repeat_instrument") or "",
+            record.get("redcap_repeat_instance") or "",
+        )
+        row = self.rows.setdefault(key, {})
+        row.update({k: v for k, v in record.items() if k in self.fields and v != ""})
+
+    def export(self, fields: Optional[List[str]]) -> List[dict]:
+        """
+        Return the stored rows the way REDCap exports them, with every requested field on every row.
+
+        The participant `id` is repeated on every row of a record, as in `fixtures/redcap_export.json`.
+        """
+        fields = [f for f in (fields or self.fields) if f != "study_id"]
+        ids = {}
+        for (study_id, _instrument, _instance), row in self.rows.items():
+            if row.get("id"):
+                ids[study_id] = row["id"]
+        out = []
+        for (study_id, instrument, instance), row in sorted(self.rows.items(), key=lambda x: self._sort_key(x[0])):
+            out.append({
+                "study_id": study_id,
+                "redcap_repeat_instrument": instrument,
+                "redcap_repeat_instance": instance,
+                **{f: str(row.get(f, "")) for f in fields},
+                **({"id": ids.get(study_id, "")} if "id" in fields else {}),
+            })
+        return out
+
+    @staticmethod
+    def _sort_key(key: tuple) -> tuple:
+        study_id, instrument, instance = key
+        return int(study_id) if study_id.isdigit() else study_id, instrument, instance or 0
+
+    def import_records(self, records: List[dict], return_content: str):
+        unknown = sorted({
+            k for r in records for k in r.keys()
+            if k not in self.fields and k not in ["redcap_repeat_instrument", "redcap_repeat_instance"]
+        })
+        if len(unknown) > 0:
+            return 400, {"error": f"The following fields were not found in the project: {', '.join(unknown)}"}
+        if self.reject is not None and any(self.reject(r) for r in records):
+            return 400, {"error": "Rejected record"}
+        with self._lock:
+            for r in records:
+                self._store(r)
+                self.records.append(r)
+        if return_content == "ids":
+            return 200, list(dict.fromkeys(str(r["study_id"]) for r in records))
+        return 200, {"count": len(set(str(r["study_id"]) for r in records))}
+
+    def next_record_name(self) -> str:
+        numeric = [int(k[0]) for k in self.rows.keys() if k[0].isdigit()]
+        return str(max(numeric, default=0) + 1)
+
+    def handle(self, payload: dict, size: int):
+        """
+        Return the (status, body) response to a REDCap API request.
+
+        A body that isn't a str is sent as JSON.
+        """
+        with self._lock:
+            if self.fail_requests > 0:
+                self.fail_requests -= 1
+                return 500, {"error": "Injected failure"}
+        if self.max_payload_bytes is not None and size > self.max_payload_bytes:
+            return 413, {"error": "Request entity too large"}
+        if payload.get("token") != TOKEN:
+            return 403, {"error": "You do not have permissions to use the API"}
+        content = payload.get("content")
+        if content == "metadata":
+            return 200, self.metadata
+        if content == "generateNextRecordName":
+            return 200, self.next_record_name()
+        if content == "record" and "data" in payload:
+            return self.import_records(json.loads(payload["data"]), payload.get("returnContent", "count"))
+        if content == "record":
+            fields = [v for k, v in sorted(payload.items()) if k.startswith("fields[")]
+            with self._lock:
+                return 200, self.export(fields)
+        return 400, {"error": f"Unsupported request: {content}"}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                size = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(size).decode()
+                payload = {k: v[0] for k, v in parse_qs(body).items()}
+                with fake._lock:
+                    fake.requests.append(payload)
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    time.sleep(fake.latency)
+                    status, content = fake.handle(payload, size)
+                finally:
+                    with fake._lock:
+                        fake.active -= 1
+                fmt = payload.get("returnFormat", payload.get("format", "json"))
+                if status >= 400 and fmt == "csv":
+                    # REDCap reports errors in the format the response was requested in
+                    content = f"ERROR: {content['error']}"
+                if isinstance(content, str):
+                    response, content_type = content.encode(), "text/plain"
+                else:
+                    response, content_type = json.dumps(content).encode(), "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *_args):
+                pass
+
+        return Handler
@@ -1,4 +1,6 @@
+import gzip
 import json
+import logging
 from typing import List
 from unittest import mock, TestCase, main
 from click.testing import CliRunner
@@ -9,6 +11,7 @@ import requests
 from trd_cli.questionnaires import QUESTIONNAIRES
 from trd_cli.main import run, dump
 from trd_cli.main_functions import compare_tc_to_rc
+from trd_cli.redcap_client import RedcapStatusError
 
 run: Command  # annotating to avoid linter warnings
 dump: Command
@@ -31,14 +34,11 @@ class CliTest(TestCase):
         self.enterContext(mock.patch.dict(os.environ, env_vars))
 
         # Setting up mocks for common modules used across tests
-        self.subprocess_run_mock = self.enterContext(
-            mock.patch("subprocess.run", autospec=True)
-        )
         self.redcap_project_mock = self.enterContext(
-            mock.patch("trd_cli.main.Project", autospec=True)
+            mock.patch("trd_cli.sync.PooledProject", autospec=True)
         )
         self.parse_tc_mock = self.enterContext(
-            mock.patch("trd_cli.main_functions.parse_tc", autospec=True)
+            mock.patch("trd_cli.main_functions.iter_tc_data", autospec=True)
         )
         self.mock_compare_return = (
             {'1255217154': {'info': {'info_birthyear_int': '1949', 'info_datetime': '2024-11-11T15:59:57.221799', 'info_is_test_bool': False, 'info_deceased_datetime': '', 'info_gender_int': '1', 'info_is_deceased_bool': ''}, 'private': {'birthdate': '1949-11-04', 'contactemail': 'b.tester@example.com', 'datetime': '2024-11-11T15:59:57.221799', 'firstname': 'Besty', 'id': '1255217154', 'lastname': 'Tester', 'mobilenumber': '+44 7000 000000', 'nhsnumber': '9910362813', 'preferredcontact': '0'}}, '1975714028': {'info': {'info_birthyear_int': '2018', 'info_datetime': '2024-11-11T15:59:57.221846', 'info_deceased_datetime': '', 'info_gender_int': '0', 'info_is_deceased_bool': ''}, 'private': {'birthdate': '2018-08-02', 'contactemail': 'jde-test1@avcosystems.com', 'datetime': '2024-11-11T15:59:57.221846', 'firstname': 'Jamie', 'id': '1975714028', 'lastname': 'Emery', 'mobilenumber': '', 'nhsnumber': '4389162012', 'preferredcontact': '0'}}},
@@ -46,7 +46,7 @@ class CliTest(TestCase):
         )
         self.compare_data_mock = self.enterContext(
             mock.patch(
-                "trd_cli.main.compare_tc_to_rc",
+                "trd_cli.sync.compare_tc_to_rc",
                 autospec=True,
                 return_value=self.mock_compare_return
             )
@@ -59,7 +59,7 @@ class CliTest(TestCase):
             with open("fixtures/tc_data.json", "r") as f:
                 return json.load(f)
 
-        # Mocking the parse_tc function to return the data from fixtures/tc_data.json
+        # Mocking the iter_tc_data function to return the data from fixtures/tc_data.json
         self.parse_tc_mock.side_effect = load_tc_data_side_effect
 
         def export_records_side_effect(*_args, **_kwargs):
@@ -73,9 +73,9 @@ class CliTest(TestCase):
 
         # Set side effect for import_records method of the redcap Project mock
         def import_records_side_effect(records, *_args, **_kwargs):
-            return {"count": len(records)}
+            return list(dict.fromkeys(str(r["study_id"]) for r in records))
 
-        # Mocking the import_records method to return {'count': len(records)}
+        # Mocking the import_records method to return the imported record ids (as for return_content="ids")
         self.redcap_project_mock.return_value.import_records.side_effect = (
             import_records_side_effect
         )
@@ -91,8 +91,6 @@ class CliTest(TestCase):
         self.assertIn("Downloading data from REDCap - ERROR", result.output)
 
     def test_email_content(self):
-        self.subprocess_run_mock.return_value = 0
-
         runner = CliRunner()
         result = runner.invoke(run)
 
@@ -105,12 +103,25 @@ class CliTest(TestCase):
         self.assertIn("(2 new)", email_html)
         self.assertIn("1 new responses", email_html)
         self.assertIn("Log File (0 Errors, 0 Warnings)", email_html)
-        self.assertIn(" INFO ", email_html)
+        # The log is attached rather than inlined
+        self.assertNotIn(" INFO ", email_html)
+        [(field, (name, content, content_type))] = self.requests_post_mock.call_args[1]["files"]
+        self.assertEqual(field, "attachment")
+        self.assertTrue(name.endswith(".log.gz"))
+        self.assertIn(" INFO ", gzip.decompress(content).decode("utf-8"))
+
+    def test_email_digest(self):
+        self.compare_data_mock.side_effect = lambda *_a, **_k: (
+            logging.getLogger("trd_cli.test").warning("Something <odd> happened") or self.mock_compare_return
+        )
+        result = CliRunner().invoke(run)
+        self.assertEqual(result.exit_code, 0, result.output)
+        email_html = self.requests_post_mock.call_args[1]["data"]["html"]
+        self.assertIn("Log File (0 Errors, 1 Warnings)", email_html)
+        self.assertIn("Something &lt;odd&gt; happened", email_html)
 
     def test_email_sending_failure(self):
         """Test email sending failure scenario."""
-        self.subprocess_run_mock.return_value = 0
-
         # Mock REDCap data
         self.redcap_project_mock.return_value.export_records.return_value = {}
         self.requests_post_mock.return_value.status_code = 500
@@ -124,6 +135,31 @@ class CliTest(TestCase):
         self.assertNotEqual(result.exit_code, 0)
         self.assertIn("Sending email summary - ERROR", result.output)
 
+    def test_partial_import_failure(self):
+        """Records REDCap rejects are isolated and reported while the rest are imported."""
+        self.compare_data_mock.side_effect = compare_tc_to_rc
+        self.redcap_project_mock.return_value.generate_next_record_name.return_value = "201"
+
+        def import_records_side_effect(records, *_args, **_kwargs):
+            if any(r["study_id"] == 202 for r in records):
+                raise RedcapStatusError("Bad record", 400)
+            return list(dict.fromkeys(str(r["study_id"]) for r in records))
+
+        self.redcap_project_mock.return_value.import_records.side_effect = import_records_side_effect
+        self.redcap_project_mock.return_value.export_records.side_effect = lambda *_, **_k: list()
+
+        runner = CliRunner()
+        result = runner.invoke(run, ["--import-chunk-records", "100"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Import failed for 1 participants: [202]", result.output)
+        imported = [
+            r["study_id"]
+            for c in self.redcap_project_mock.return_value.import_records.call_args_list
+            for r in c.args[0]
+        ]
+        self.assertIn(201, imported)
+
     def test_double_upload(self):
         """
         - Parse a True Colours export versus a blank REDCap export.
@@ -198,7 +234,7 @@ class CliTest(TestCase):
         initial_data = load_tc_data("fixtures/tc_data_initial.json")
 
         self.subTest("Initial upload")
-        self.parse_tc_mock.side_effect = lambda _: initial_data
+        self.parse_tc_mock.side_effect = lambda *_, **_k: initial_data
         self.redcap_project_mock.return_value.export_records.side_effect = lambda *_, **_k: list()
 
         runner = CliRunner()
@@ -209,7 +245,7 @@ class CliTest(TestCase):
         self.assertIn("4 participants (4 new)", result.output)
 
         self.subTest("Second upload")
-        self.parse_tc_mock.side_effect = lambda _: load_tc_data("fixtures/tc_data.json")
+        self.parse_tc_mock.side_effect = lambda *_, **_k: load_tc_data("fixtures/tc_data.json")
         self.redcap_project_mock.return_value.export_records.side_effect = lambda *_, **_k: redcap_from_tc(initial_data)
 
         runner = CliRunner()
@@ -1,12 +1,23 @@
 import csv
+import json
+import random
 from datetime import datetime
 from time import sleep
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
 
 from trd_cli.conversions import (
     extract_participant_info,
+    ConversionPlan,
 )
-from trd_cli.questionnaires import questionnaire_to_rc_record, get_redcap_structure, get_questionnaire_by_name
+from trd_cli.questionnaires import (
+    questionnaire_to_rc_record,
+    get_redcap_structure,
+    get_questionnaire_by_name,
+    QuestionnaireRegistry,
+    QUESTIONNAIRES,
+    REGISTRY,
+)
+from trd_cli.main_functions import compare_tc_to_rc
 from trd_cli.parse_tc import parse_tc
 
 
@@ -162,5 +173,120 @@ class ConversionsTest(TestCase):
                 self.assertIn(f, dump[k])
 
 
+class QuestionnaireRegistryTest(TestCase):
+    def test_lookups(self):
+        for q in QUESTIONNAIRES:
+            with self.subTest(q_name=q["code"]):
+                self.assertIs(REGISTRY.get_by_code(q["code"]), q)
+                self.assertIs(REGISTRY.get_by_title(q["name"]), q)
+                self.assertIs(REGISTRY.get_by_title(q["name"], "1"), q)
+                self.assertIsNone(REGISTRY.get_by_title(q["name"], "2"))
+                self.assertIn(f"{q['code']}_response_id", REGISTRY.response_id_fields)
+                self.assertIn(q["code"], REGISTRY.structure)
+        self.assertIsNone(REGISTRY.get_by_title("Unknown questionnaire"))
+        self.assertIsNone(REGISTRY.get_by_code("unknown"))
+
+    def test_versions(self):
+        v1 = {**QUESTIONNAIRES[0]}
+        v2 = {**QUESTIONNAIRES[0], "code": f"{v1['code']}_v2"}
+        consent = REGISTRY.get_by_code("consent")
+        registry = QuestionnaireRegistry([v1, v2, consent])
+        self.assertIs(registry.get_by_title(v1["name"]), v1)
+        self.assertIs(registry.get_by_title(v1["name"], "2"), v2)
+        self.assertIs(registry.get_by_title(v1["name"], "2"), v2)
+        self.assertIsNone(registry.get_by_title(v1["name"], "3"))
+        # Only titles and versions that resolve are remembered
+        for version in range(3, 100):
+            self.assertIsNone(registry.get_by_title(v1["name"], str(version)))
+            self.assertIsNone(registry.get_by_title(f"Unknown {version}", str(version)))
+        self.assertEqual(len(registry._by_title), 3)
+        self.assertEqual(registry.codes, [v1["code"], v2["code"], "consent"])
+
+    def test_versioned_conversion(self):
+        v1 = {**QUESTIONNAIRES[0]}
+        v2 = {**QUESTIONNAIRES[0], "code": f"{v1['code']}_v2"}
+        registry = QuestionnaireRegistry([v1, v2, REGISTRY.get_by_code("consent")])
+        with open("fixtures/tc_data.json", "r") as f:
+            response = next(
+                r for r in json.load(f)["questionnaireresponse.csv"]
+                if r["interoperability"] is not None and r["interoperability"]["title"] == v1["name"]
+            )
+        tc_data = {
+            "patient.csv": [],
+            "questionnaireresponse.csv": [{**response, "id": "a"}, {**response, "id": "b", "version": "2"}],
+        }
+        with mock.patch("trd_cli.main_functions.REGISTRY", registry), \
+                mock.patch("trd_cli.questionnaires.REGISTRY", registry):
+            _, records = compare_tc_to_rc(tc_data, {})
+        self.assertEqual(records[0][f"{v1['code']}_response_id"], "a")
+        self.assertEqual(records[1][f"{v2['code']}_response_id"], "b")
+        self.assertNotIn(f"{v1['code']}_response_id", records[1])
+
+    def test_structure_is_a_copy(self):
+        dump = get_redcap_structure()
+        dump["phq9"].append("not_a_field")
+        self.assertNotIn("not_a_field", get_redcap_structure()["phq9"])
+
+    def test_structure_has_imported_participant_fields(self):
+        with open("fixtures/tc_data.json", "r") as f:
+            patient = json.load(f)["patient.csv"][0]
+        private, info = extract_participant_info(patient)
+        dump = get_redcap_structure()
+        self.assertEqual(sorted(private.keys()), sorted(dump["private"]))
+        self.assertEqual(sorted(info.keys()), sorted(dump["info"]))
+
+
+class ConversionPlanTest(TestCase):
+    def assertSameConversion(self, q, response):
+        plan = ConversionPlan(q)
+        with mock.patch("trd_cli.conversions.LOGGER") as expected_logger:
+            expected = q["conversion_fn"](q, response)
+        with mock.patch("trd_cli.conversions.LOGGER") as logger:
+            result = plan.convert(response)
+        self.assertEqual(expected, result)
+        self.assertEqual(list(expected.keys()), list(result.keys()))
+        self.assertEqual(expected_logger.mock_calls, logger.mock_calls)
+
+    def test_fixture_equivalence(self):
+        for fixture in ["fixtures/tc_data.json", "fixtures/tc_data_initial.json"]:
+            with open(fixture, "r") as f:
+                responses = json.load(f)["questionnaireresponse.csv"]
+            for i, r in enumerate(responses):
+                if r["interoperability"] is None or r["scores"] is None:
+                    continue
+                q = get_questionnaire_by_name(r["interoperability"]["title"], r.get("version"))
+                if q is None:
+                    continue
+                with self.subTest(fixture=fixture, row=i, q_name=q["code"]):
+                    self.assertSameConversion(q, r)
+
+    def test_synthetic_equivalence(self):
+        rng = random.Random(20241104)
+        for q in QUESTIONNAIRES:
+            n_items = 19 if q["code"] == "consent" else len(q["items"])
+            question_scores = [
+                {"QuestionNumber": i + 1, "Score": rng.choice([0, 1.0, "2"]), "DisplayValue": f"Answer {i}"}
+                for i in range(n_items)
+            ]
+            category_scores = [{"Name": c, "Score": rng.random()} for c in q["scores"]]
+            if q["code"] != "consent":
+                # Missing, duplicated and out-of-order items should all be handled the same way
+                question_scores = question_scores[1:] + [{**question_scores[-1], "Score": 99}]
+                category_scores = category_scores[1:]
+            rng.shuffle(question_scores)
+            response = {
+                "id": 1234,
+                "submitted": "2024-11-04 12:59:24.973",
+                "interoperability": {"submitted": "2024-11-04T12:59:24.9477348+00:00", "title": q["name"]},
+                "scores": {"QuestionScores": question_scores, "CategoryScores": category_scores},
+            }
+            with self.subTest(q_name=q["code"]):
+                self.assertSameConversion(q, response)
+
+    def test_unknown_conversion_fn(self):
+        q = {"name": "Custom", "code": "custom", "items": [], "scores": [], "conversion_fn": lambda _q, r: {"x": r}}
+        self.assertEqual(ConversionPlan(q).convert("response"), {"x": "response"})
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,40 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+from unittest import TestCase, main
+
+from trd_cli.debug_artifacts import DebugArtifacts
+
+
+class DebugArtifactsTest(TestCase):
+    def setUp(self):
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.logger = logging.getLogger("trd_cli.test_debug_artifacts")
+        self.addCleanup(self.logger.setLevel, self.logger.level)
+
+    def test_debug(self):
+        self.logger.setLevel(logging.DEBUG)
+        artifacts = DebugArtifacts(self.directory, "run", self.logger)
+        path = artifacts.write("records", [{"study_id": 1}, {"study_id": 2, "when": object}])
+        self.assertEqual(path, os.path.join(self.directory, "run.records.ndjson.gz"))
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(json.loads(lines[0]), {"study_id": 1})
+        self.assertEqual(json.loads(lines[1])["study_id"], 2)
+
+    def test_info(self):
+        self.logger.setLevel(logging.INFO)
+        artifacts = DebugArtifacts(self.directory, "run", self.logger)
+
+        def items():
+            raise AssertionError("Items should not be iterated at INFO")
+            yield
+
+        self.assertIsNone(artifacts.write("records", items()))
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == "__main__":
+    main()
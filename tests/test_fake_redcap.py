@@ -0,0 +1,334 @@
+import gzip
+import json
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import TestCase, main, mock
+
+from click.testing import CliRunner
+from click.core import Command
+from redcap import RedcapError
+
+from trd_cli import main_functions
+from trd_cli.main import run, snapshot
+from trd_cli.redcap_client import PooledProject
+from trd_cli.synthetic import SyntheticArchive
+
+from tests.fake_redcap import FakeRedcap, TOKEN
+
+run: Command  # annotating to avoid linter warnings
+snapshot: Command
+
+
+class FakeRedcapTest(TestCase):
+    def setUp(self):
+        self.fake = self.enterContext(FakeRedcap())
+        self.project = PooledProject(self.fake.url, TOKEN)
+
+    def test_round_trip(self):
+        self.assertEqual(self.project.generate_next_record_name(), "1")
+        records = [
+            {"study_id": "1", "id": "123", "firstname": "Test"},
+            {"study_id": "1", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 1,
+             "phq9_response_id": "r1"},
+        ]
+        self.assertEqual(self.project.import_records(records, return_content="ids"), ["1"])
+        self.assertEqual(self.project.generate_next_record_name(), "2")
+        exported = self.project.export_records(fields=["id", "phq9_response_id"])
+        self.assertEqual(exported, [
+            {"study_id": "1", "redcap_repeat_instrument": "", "redcap_repeat_instance": "",
+             "id": "123", "phq9_response_id": ""},
+            {"study_id": "1", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 1,
+             "id": "123", "phq9_response_id": "r1"},
+        ])
+
+    def test_unknown_field(self):
+        with self.assertRaises(RedcapError):
+            self.project.import_records([{"study_id": "1", "not_a_field": "x"}])
+        self.assertEqual(self.fake.rows, {})
+
+    def test_error_injection(self):
+        self.fake.fail_requests = 1
+        with self.assertRaises(RedcapError):
+            self.project.generate_next_record_name()
+        self.assertEqual(self.project.generate_next_record_name(), "1")
+
+        self.fake.reject = lambda r: r.get("firstname") == "Bad"
+        with self.assertRaises(RedcapError):
+            self.project.import_records([{"study_id": "1", "firstname": "Bad"}])
+
+        self.fake.max_payload_bytes = 100
+        with self.assertRaises(RedcapError):
+            self.project.import_records([{"study_id": "1", "firstname": "A" * 100}])
+        self.assertEqual(self.fake.records, [])
+
+
+class EndToEndTest(TestCase):
+    """
+    Run `trd-cli run` against a local fake REDCap server.
+    """
+    def setUp(self):
+        self.fake = self.enterContext(FakeRedcap())
+        self.log_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.env = {
+            "TRD_REDCAP_URL": self.fake.url,
+            "TRD_REDCAP_TOKEN": TOKEN,
+            "TRD_TRUE_COLOURS_ARCHIVE": "fixtures/tc.zip",
+            "TRD_LOG_DIR": self.log_dir,
+            "TRD_LOG_LEVEL": "INFO",
+        }
+        self.enterContext(mock.patch.dict(os.environ, self.env))
+        os.environ.pop("TRD_MAILTO_ADDRESS", None)
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(run, list(args), catch_exceptions=False)
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result
+
+    def test_run(self):
+        self.invoke()
+        self.assertGreater(len(self.fake.records), 0)
+        participants = set(k[0] for k in self.fake.rows.keys())
+        self.assertGreater(len(participants), 0)
+        # Each participant's private record has their True Colours id
+        for study_id in participants:
+            self.assertIn("id", self.fake.rows[(study_id, "private", 1)])
+        responses = [r for r in self.fake.records if r.get("redcap_repeat_instrument")]
+        self.assertGreater(len(responses), 0)
+
+        with open(os.path.join(self.log_dir, "trd_cli.prom")) as f:
+            prom = f.read()
+        self.assertIn("trd_cli_last_run_success 1", prom)
+        self.assertIn('trd_cli_redcap_requests{content="record"} 2', prom)
+        for stage in ["unpack", "export", "compare", "record_names", "import"]:
+            self.assertIn(f'trd_cli_stage_wall_seconds{{stage="{stage}"}}', prom)
+        # The rows streamed out of the archive are counted in unpack as well as compare
+        rows = {
+            line.split('"')[1]: line.split()[-1] for line in prom.splitlines() if line.startswith("trd_cli_stage_rows{")
+        }
+        self.assertEqual(rows["unpack"], rows["compare"])
+
+        # Nothing new the second time round
+        imported = len(self.fake.records)
+        self.invoke()
+        self.assertEqual(len(self.fake.records), imported)
+
+    def test_state_db(self):
+        state_db = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "state.db")
+
+        def exports():
+            return len([r for r in self.fake.requests if r.get("content") == "record" and "data" not in r])
+
+        self.invoke("--state-db", state_db)
+        self.assertEqual(exports(), 1)
+        imported = len(self.fake.records)
+
+        # The next run uses the state instead of exporting from REDCap, and still finds nothing new
+        self.invoke("--state-db", state_db)
+        self.assertEqual(exports(), 1)
+        self.assertEqual(len(self.fake.records), imported)
+
+        # Unless it's time to reconcile
+        self.invoke("--state-db", state_db, "--reconcile")
+        self.assertEqual(exports(), 2)
+        self.invoke("--state-db", state_db, "--reconcile-hours", "0")
+        self.assertEqual(exports(), 3)
+        self.assertEqual(len(self.fake.records), imported)
+
+    def test_unchanged_archive(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        state_db = os.path.join(tmp, "state.db")
+        archive = os.path.join(tmp, "tc.zip")
+        shutil.copy("fixtures/tc.zip", archive)
+
+        self.invoke("--state-db", state_db, "--tc-archive", archive)
+        requests = len(self.fake.requests)
+        result = self.invoke("--state-db", state_db, "--tc-archive", archive)
+        self.assertIn("No change in the True Colours archive", result.output)
+        self.assertEqual(len(self.fake.requests), requests)
+
+        # The same content copied in again is still unchanged
+        shutil.copy("fixtures/tc.zip", archive)
+        os.utime(archive, (0, 0))
+        result = self.invoke("--state-db", state_db, "--tc-archive", archive)
+        self.assertIn("No change in the True Colours archive", result.output)
+
+        result = self.invoke("--state-db", state_db, "--tc-archive", archive, "--force")
+        self.assertIn("0 new responses", result.output)
+
+        # A different archive is processed
+        SyntheticArchive(5, 50).write(archive)
+        result = self.invoke("--state-db", state_db, "--tc-archive", archive)
+        self.assertNotIn("No change in the True Colours archive", result.output)
+
+    def test_row_delta(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        state_db = os.path.join(tmp, "state.db")
+        archive = os.path.join(tmp, "tc.zip")
+        synthetic = SyntheticArchive(5, 50, incomplete=0)
+        responses = synthetic.responses
+        synthetic.responses = responses[:40]
+        synthetic.write(archive)
+        self.invoke("--state-db", state_db, "--tc-archive", archive)
+        imported = len(self.fake.records)
+
+        # Only the new rows are compared, and only they are imported
+        synthetic.responses = responses
+        synthetic.write(archive)
+        self.invoke("--state-db", state_db, "--tc-archive", archive)
+        with open(os.path.join(self.log_dir, "trd_cli.prom")) as f:
+            self.assertIn('trd_cli_stage_rows{stage="compare"} 10', f.read())
+        self.assertEqual(len(self.fake.records), imported + 10)
+
+        # A reconcile compares every row again, but finds nothing new
+        self.invoke("--state-db", state_db, "--tc-archive", archive, "--reconcile")
+        with open(os.path.join(self.log_dir, "trd_cli.prom")) as f:
+            self.assertIn('trd_cli_stage_rows{stage="compare"} 55', f.read())
+        self.assertEqual(len(self.fake.records), imported + 10)
+
+    def test_failed_run_not_recorded(self):
+        state_db = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "state.db")
+        self.fake.reject = lambda r: r.get("redcap_repeat_instrument") == "phq9"
+        self.invoke("--state-db", state_db)
+        self.fake.reject = None
+        result = self.invoke("--state-db", state_db)
+        self.assertNotIn("No change in the True Colours archive", result.output)
+        # The responses that failed are retried
+        self.assertIn("phq9", [r.get("redcap_repeat_instrument") for r in self.fake.records])
+
+    def test_debug_artifacts(self):
+        log_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.invoke("--log-dir", log_dir)
+        self.assertEqual([f for f in os.listdir(log_dir) if f.endswith(".ndjson.gz")], [])
+        imported = len(self.fake.records)
+
+        self.fake.rows.clear()
+        log_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.invoke("--log-dir", log_dir, "--log-level", "DEBUG")
+        artifacts = {f.split(".")[1]: os.path.join(log_dir, f) for f in os.listdir(log_dir) if f.endswith(".ndjson.gz")}
+        self.assertEqual(sorted(artifacts.keys()), ["id_map", "new_records", "redcap_ids"])
+        with gzip.open(artifacts["new_records"], "rt") as f:
+            self.assertEqual(len(f.read().splitlines()), imported)
+        # The log only says where they are
+        [log_file] = [f for f in os.listdir(log_dir) if f.endswith(".log")]
+        with open(os.path.join(log_dir, log_file)) as f:
+            self.assertIn("new_records items to", f.read())
+
+    def test_profile(self):
+        profile_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.invoke("--profile", profile_dir)
+        files = os.listdir(profile_dir)
+        self.assertEqual(sorted(f.split(".", 1)[1] for f in files), ["allocations.txt", "profile.json", "pstats"])
+        run_name = files[0].split(".", 1)[0]
+        stats = pstats.Stats(os.path.join(profile_dir, f"{run_name}.pstats"))
+        self.assertTrue(any(f[2] == "compare_tc_to_rc" for f in stats.stats.keys()))
+        with open(os.path.join(profile_dir, f"{run_name}.allocations.txt")) as f:
+            allocations = f.read()
+        for stage in ["unpack", "export", "compare", "import"]:
+            self.assertIn(f"###### {stage} ", allocations)
+        with open(os.path.join(profile_dir, f"{run_name}.profile.json")) as f:
+            summary = json.load(f)
+        self.assertGreater(summary["peak_rss_bytes"], 0)
+        self.assertGreater(summary["stages"]["compare"]["peak_traced_bytes"], 0)
+
+    def test_no_profile(self):
+        # Profiling costs nothing unless it's asked for
+        result = subprocess.run(
+            [sys.executable, "-c", "import sys, trd_cli.main; print('cProfile' in sys.modules)"],
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_concurrent_chunked_run(self):
+        self.invoke("--import-chunk-records", "5", "--import-workers", "3")
+        chunked_rows = dict(self.fake.rows)
+        self.assertGreater(
+            len([r for r in self.fake.requests if "data" in r]), 1, "Expected several import requests"
+        )
+        with FakeRedcap() as fake:
+            with mock.patch.dict(os.environ, {"TRD_REDCAP_URL": fake.url}):
+                self.invoke()
+            # Uploading in chunks makes no difference to what ends up in REDCap
+            self.assertEqual(
+                {k: {f: v for f, v in r.items() if "datetime" not in f} for k, r in fake.rows.items()},
+                {k: {f: v for f, v in r.items() if "datetime" not in f} for k, r in chunked_rows.items()},
+            )
+
+    def test_overlap_export(self):
+        archive = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "tc.zip")
+        SyntheticArchive(20, 500).write(archive)
+
+        # The archive is only read once the export has been sent, which only works if they overlap
+        exporting = threading.Event()
+        overlapped = []
+        handle = self.fake.handle
+
+        def handle_export(payload, size):
+            if payload.get("content") == "record" and "data" not in payload:
+                exporting.set()
+            return handle(payload, size)
+
+        def get_true_colours_data(*args, **kwargs):
+            overlapped.append(exporting.wait(timeout=10))
+            return main_functions.get_true_colours_data(*args, **kwargs)
+
+        self.fake.handle = handle_export
+        with mock.patch("trd_cli.sync.get_true_colours_data", side_effect=get_true_colours_data):
+            result = self.invoke("--tc-archive", archive, "--overlap-export")
+        self.assertEqual(overlapped, [True])
+        self.assertIn("Waiting for True Colours archive - OK", result.output)
+        with open(os.path.join(self.log_dir, "trd_cli.prom")) as f:
+            prom = f.read()
+        self.assertIn('trd_cli_stage_rows{stage="unpack"} 520', prom)
+        self.assertIn('trd_cli_stage_rows{stage="compare"} 520', prom)
+        self.assertIn('trd_cli_stage_wall_seconds{stage="unpack_wait"}', prom)
+        # It makes no difference to what ends up in REDCap
+        with FakeRedcap() as fake:
+            with mock.patch.dict(os.environ, {"TRD_REDCAP_URL": fake.url}):
+                self.invoke("--tc-archive", archive)
+            self.assertEqual(
+                {k: {f: v for f, v in r.items() if "datetime" not in f} for k, r in fake.rows.items()},
+                {k: {f: v for f, v in r.items() if "datetime" not in f} for k, r in self.fake.rows.items()},
+            )
+
+    def test_snapshot(self):
+        self.invoke()
+        imported = len(self.fake.records)
+        output = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "redcap.json.gz")
+        result = CliRunner().invoke(snapshot, [output], catch_exceptions=False)
+        self.assertEqual(result.exit_code, 0, result.output)
+        with gzip.open(output, "rt") as f:
+            self.assertEqual(len(json.load(f)), imported)
+
+        # A run against the snapshot doesn't need (or touch) REDCap, and finds nothing new
+        requests = len(self.fake.requests)
+        with mock.patch.dict(os.environ, {"TRD_REDCAP_URL": "", "TRD_REDCAP_TOKEN": ""}):
+            os.environ.pop("TRD_REDCAP_URL")
+            os.environ.pop("TRD_REDCAP_TOKEN")
+            result = self.invoke("--rc-snapshot", output)
+        self.assertIn("Reading REDCap snapshot - OK", result.output)
+        self.assertIn("\t0 new responses for 0 participants (0 new).", result.output)
+        self.assertEqual(len(self.fake.requests), requests)
+
+    def test_snapshot_offline(self):
+        # New participants are numbered on from the snapshot, but nothing is imported
+        log_dir = self.enterContext(tempfile.TemporaryDirectory())
+        result = self.invoke(
+            "--rc-snapshot", "fixtures/redcap_export.json", "--log-dir", log_dir, "--log-level", "DEBUG"
+        )
+        self.assertIn("Reading REDCap snapshot - OK", result.output)
+        self.assertEqual(self.fake.requests, [])
+        [artifact] = [f for f in os.listdir(log_dir) if f.endswith(".new_records.ndjson.gz")]
+        with gzip.open(os.path.join(log_dir, artifact), "rt") as f:
+            study_ids = {json.loads(line)["study_id"] for line in f}
+        with open("fixtures/redcap_export.json") as f:
+            highest = max(int(r["study_id"]) for r in json.load(f))
+        self.assertIn(highest + 1, study_ids)
+
+
+if __name__ == "__main__":
+    main()
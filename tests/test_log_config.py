@@ -0,0 +1,188 @@
+import gzip
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from logging.config import dictConfig
+from unittest import TestCase, main
+
+from trd_cli.log_config import CountingHandler, GzipRotatingFileHandler, LogQueue, get_config, get_counting_handler, \
+    tidy_log_dir, mark_run_live
+
+
+class CountingHandlerTest(TestCase):
+    def setUp(self):
+        self.handler = CountingHandler(max_records=2, max_record_chars=20)
+        self.logger = logging.getLogger("trd_cli.test_log_config")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_counts(self):
+        self.logger.debug("debug")
+        self.logger.info("info")
+        self.logger.info("Not an ERROR")
+        self.logger.warning("warning")
+        self.logger.error("error")
+        self.logger.critical("critical")
+        self.assertEqual(self.handler.counts, {"DEBUG": 1, "INFO": 2, "WARNING": 1, "ERROR": 1, "CRITICAL": 1})
+        self.assertEqual(self.handler.warnings, 1)
+        self.assertEqual(self.handler.errors, 2)
+
+    def test_digest(self):
+        self.logger.info("info")
+        self.logger.warning("a long warning that gets cut short")
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            self.logger.exception("failed")
+        self.logger.error("too many")
+        self.assertEqual(self.handler.digest, ["a long warning that ", "failed\nTraceback (mo"])
+        self.assertEqual(self.handler.truncated, 1)
+
+
+class GetConfigTest(TestCase):
+    def setUp(self):
+        self.log_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.logger = logging.getLogger("trd_cli.test_log_config")
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        level = root.level
+
+        def restore():
+            for h in root.handlers[:]:
+                root.removeHandler(h)
+                h.close()
+            for h in handlers:
+                root.addHandler(h)
+            root.setLevel(level)
+
+        self.addCleanup(restore)
+
+    def test_counting_handler(self):
+        dictConfig(get_config(os.path.join(self.log_dir, "first.log")))
+        self.logger.warning("first")
+        first = get_counting_handler()
+        self.assertEqual(first.warnings, 1)
+        # Each configuration has its own counts
+        dictConfig(get_config(os.path.join(self.log_dir, "second.log")))
+        self.assertIsNot(get_counting_handler(), first)
+        self.assertEqual(get_counting_handler().warnings, 0)
+
+    def test_log_queue(self):
+        log_file = os.path.join(self.log_dir, "queued.log")
+        dictConfig(get_config(log_file))
+        log_queue = LogQueue().start()
+        self.logger.warning("queued")
+        log_queue.flush()
+        # The handlers are behind the queue, but the counter can still be found
+        self.assertEqual(get_counting_handler().warnings, 1)
+        with open(log_file) as f:
+            self.assertIn("queued", f.read())
+        log_queue.stop()
+        self.logger.warning("after")
+        self.assertEqual(get_counting_handler().warnings, 2)
+
+    def test_writes_on_listener_thread(self):
+        written_by = []
+
+        class Recorder(logging.Handler):
+            def emit(self, record):
+                written_by.append(threading.current_thread())
+
+        logging.getLogger().handlers[:] = [Recorder()]
+        log_queue = LogQueue().start()
+        self.logger.warning("queued")
+        log_queue.stop()
+        self.assertEqual(len(written_by), 1)
+        self.assertIsNot(written_by[0], threading.current_thread())
+
+    def test_json(self):
+        log_file = os.path.join(self.log_dir, "json.log")
+        dictConfig(get_config(log_file, log_format="json"))
+        log_queue = LogQueue().start()
+        self.logger.warning("a %s", "warning")
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            self.logger.exception("failed")
+        log_queue.stop()
+        with open(log_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([(r["level"], r["message"]) for r in lines], [("WARNING", "a warning"), ("ERROR", "failed")])
+        self.assertEqual(lines[0]["logger"], "trd_cli.test_log_config")
+        self.assertIn("ValueError: oops", lines[1]["exception"])
+
+
+class RotationTest(TestCase):
+    def setUp(self):
+        self.log_dir = self.enterContext(tempfile.TemporaryDirectory())
+
+    def test_size_rotation(self):
+        log_file = os.path.join(self.log_dir, "trd_cli-run.log")
+        handler = GzipRotatingFileHandler(log_file, maxBytes=100, backupCount=2)
+        self.addCleanup(handler.close)
+        for i in range(20):
+            handler.emit(logging.makeLogRecord({"msg": f"line {i} " + "x" * 20}))
+        self.assertEqual(sorted(os.listdir(self.log_dir)), [
+            "trd_cli-run.log", "trd_cli-run.log.1.gz", "trd_cli-run.log.2.gz"
+        ])
+        with gzip.open(f"{log_file}.1.gz", "rt") as f:
+            self.assertIn("line", f.read())
+
+    def test_tidy_log_dir(self):
+        def touch(name, days_old=0.0):
+            path = os.path.join(self.log_dir, name)
+            with open(path, "w") as f:
+                f.write(name)
+            when = time.time() - days_old * 24 * 60 * 60
+            os.utime(path, (when, when))
+            return path
+
+        current = touch("trd_cli-3.log")
+        touch("trd_cli-2.log", days_old=1)
+        touch("trd_cli-2.metrics.json", days_old=1)
+        touch("trd_cli-1.log.gz", days_old=40)
+        touch("trd_cli-1.metrics.json", days_old=40)
+        touch("trd_cli.prom", days_old=40)
+        tidy_log_dir(self.log_dir, current, keep_days=30)
+        self.assertEqual(sorted(os.listdir(self.log_dir)), [
+            "trd_cli-2.log.gz", "trd_cli-2.metrics.json", "trd_cli-3.log", "trd_cli.prom"
+        ])
+        with gzip.open(os.path.join(self.log_dir, "trd_cli-2.log.gz"), "rt") as f:
+            self.assertEqual(f.read(), "trd_cli-2.log")
+        # The compressed log keeps its age
+        self.assertLess(os.path.getmtime(os.path.join(self.log_dir, "trd_cli-2.log.gz")), time.time() - 60 * 60)
+
+        # 0 keeps everything
+        touch("trd_cli-0.metrics.json", days_old=400)
+        tidy_log_dir(self.log_dir, current, keep_days=0)
+        self.assertIn("trd_cli-0.metrics.json", os.listdir(self.log_dir))
+
+    def test_tidy_log_dir_live_runs(self):
+        def touch(name):
+            path = os.path.join(self.log_dir, name)
+            with open(path, "w") as f:
+                f.write(name)
+            return path
+
+        current = touch("trd_cli-3.log")
+        # Another run that's still going
+        mark_run_live(touch("trd_cli-2.log"))
+        # A run that died without tidying up after itself
+        dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+        touch("trd_cli-1.log")
+        with open(os.path.join(self.log_dir, "trd_cli-1.pid"), "w") as f:
+            f.write(dead.stdout.strip())
+        tidy_log_dir(self.log_dir, current, keep_days=30)
+        self.assertEqual(sorted(os.listdir(self.log_dir)), [
+            "trd_cli-1.log.gz", "trd_cli-2.log", "trd_cli-2.pid", "trd_cli-3.log"
+        ])
+
+
+if __name__ == "__main__":
+    main()
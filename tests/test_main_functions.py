@@ -1,8 +1,15 @@
+import copy
 import json
+import os
+import pickle
+import tempfile
+import zipfile
+from typing import Iterator
 from unittest import TestCase, main, mock
 
-from trd_cli.main_functions import extract_redcap_ids, compare_tc_to_rc
-from trd_cli.parse_tc import parse_tc
+from trd_cli.main_functions import extract_redcap_ids, compare_tc_to_rc, InstanceAllocator, \
+    read_redcap_snapshot, write_redcap_snapshot, next_study_id
+from trd_cli.parse_tc import parse_tc, iter_tc_rows, iter_tc_data, LazyResponseRow
 
 
 class RedcapExtractionTest(TestCase):
@@ -53,6 +60,53 @@ class RedcapExtractionTest(TestCase):
             extract_redcap_ids(records),
         )
 
+    def test_duplicate_response_ids(self):
+        records = [
+            {"study_id": "101", "id": "a", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 1,
+             "phq9_response_id": "111"},
+            {"study_id": "101", "id": "a", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 2,
+             "phq9_response_id": "111"},
+            {"study_id": "102", "id": "a", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 3,
+             "phq9_response_id": "222"},
+        ]
+        with self.assertLogs("trd_cli.main_functions", level="WARNING") as logs:
+            ids = extract_redcap_ids(records)
+        self.assertEqual(ids["a"]["phq9"], [("111", 1), ("222", 3)])
+        self.assertEqual(ids["a"]["study_id"], "101")
+        self.assertEqual(len(logs.output), 2)
+
+    def test_non_repeating_instruments(self):
+        records = [
+            {"study_id": "101", "id": "a", "redcap_repeat_instrument": "", "redcap_repeat_instance": "",
+             "consent_response_id": "333"},
+            {"study_id": "101", "id": "a", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 1,
+             "phq9_response_id": "111", "consent_response_id": ""},
+            {"study_id": "102", "id": "b", "redcap_repeat_instrument": "", "redcap_repeat_instance": "",
+             "consent_response_id": ""},
+        ]
+        ids = extract_redcap_ids(records)
+        self.assertEqual(ids["a"]["consent"], [("333", None)])
+        self.assertEqual(ids["a"]["phq9"], [("111", 1)])
+        self.assertEqual(ids["b"]["consent"], [])
+
+    def test_snapshot_round_trip(self):
+        with open("fixtures/redcap_export.json", "r") as f:
+            records = json.load(f)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ["redcap.json", "redcap.json.gz"]:
+                path = os.path.join(tmp, name)
+                write_redcap_snapshot(records, path)
+                self.assertEqual(read_redcap_snapshot(path), records)
+            with open(os.path.join(tmp, "not_records.json"), "w") as f:
+                json.dump({"error": "Bad token"}, f)
+            with self.assertRaises(ValueError):
+                read_redcap_snapshot(os.path.join(tmp, "not_records.json"))
+
+    def test_next_study_id(self):
+        with open("fixtures/redcap_export.json", "r") as f:
+            self.assertEqual(next_study_id(extract_redcap_ids(json.load(f))), 103)
+        self.assertEqual(next_study_id({}), 1)
+
 
 class ParseTCTest(TestCase):
     def test_load_dir(self):
@@ -73,6 +127,60 @@ class ParseTCTest(TestCase):
             with self.subTest(questionnaire="questionnaireresponse", field=f):
                 self.assertIn(f, parsed_tc["questionnaireresponse.csv"][0])
 
+    def test_load_archive(self):
+        tc_archive = "fixtures/tc.zip"
+        parsed_tc = parse_tc(tc_archive)
+        with tempfile.TemporaryDirectory() as tc_dir:
+            with zipfile.ZipFile(tc_archive) as archive:
+                archive.extractall(tc_dir)
+            self.assertEqual(parse_tc(tc_dir), parsed_tc)
+        self.assertGreater(len(parsed_tc["questionnaireresponse.csv"]), 0)
+        self.assertIsInstance(parsed_tc["questionnaireresponse.csv"][0]["scores"], dict)
+
+    def test_iter_rows(self):
+        tc_archive = "fixtures/tc.zip"
+        parsed_tc = parse_tc(tc_archive)
+        for file in ["patient.csv", "questionnaireresponse.csv"]:
+            with self.subTest(file=file):
+                rows = iter_tc_rows(tc_archive, file)
+                self.assertIsInstance(rows, Iterator)
+                self.assertEqual(next(rows), parsed_tc[file][0])
+                self.assertEqual(list(rows), parsed_tc[file][1:])
+
+    def test_lazy_response_row(self):
+        raw = {"id": "1", "responses": "", "scores": '{"QuestionScores": []}', "interoperability": "{bad"}
+        row = LazyResponseRow(raw)
+        with mock.patch("trd_cli.parse_tc.json.loads", wraps=json.loads) as loads:
+            self.assertEqual(row.get("id"), "1")
+            loads.assert_not_called()
+            self.assertEqual(row["scores"], {"QuestionScores": []})
+            self.assertEqual(row.get("scores"), {"QuestionScores": []})
+            loads.assert_called_once()
+        self.assertIsNone(row["responses"])
+        with self.assertLogs("trd_cli.parse_tc", level="WARNING"):
+            self.assertEqual(row["interoperability"], "{bad")
+        self.assertEqual({**LazyResponseRow(raw)}["scores"], {"QuestionScores": []})
+        self.assertEqual(json.loads(json.dumps(LazyResponseRow(raw)))["responses"], None)
+
+    def test_lazy_response_row_dict_methods(self):
+        raw = {"id": "1", "responses": "", "scores": '{"QuestionScores": []}'}
+        self.assertEqual(LazyResponseRow(raw).setdefault("scores"), {"QuestionScores": []})
+        self.assertEqual(LazyResponseRow(raw).setdefault("other", "x"), "x")
+        self.assertEqual(LazyResponseRow(raw).popitem(), ("scores", {"QuestionScores": []}))
+        row = LazyResponseRow(raw)
+        row.update(scores="{}")
+        self.assertEqual(row["scores"], "{}")
+        self.assertEqual((LazyResponseRow(raw) | {"id": "2"})["scores"], {"QuestionScores": []})
+        for copied in [pickle.loads(pickle.dumps(LazyResponseRow(raw))), copy.copy(LazyResponseRow(raw))]:
+            self.assertIs(type(copied), dict)
+            self.assertEqual(copied, {"id": "1", "responses": None, "scores": {"QuestionScores": []}})
+        with self.assertRaises(KeyError):
+            LazyResponseRow({}).popitem()
+
+    def test_iter_rows_missing_file(self):
+        with self.assertRaises(FileNotFoundError):
+            next(iter_tc_rows("fixtures/tc.zip", "missing.csv"))
+
 
 class CompareDataTest(TestCase):
     def setUp(self):
@@ -82,7 +190,7 @@ class CompareDataTest(TestCase):
         with open("fixtures/tc_data.json", "r") as f:
             self.tc_data = json.load(f)
 
-        def questionnaire_to_rc_record_mock_side_effect(_data):
+        def questionnaire_to_rc_record_mock_side_effect(_data, _questionnaire=None):
             return {}
 
         self.enterContext(mock.patch(
@@ -127,5 +235,48 @@ class CompareDataTest(TestCase):
         self.assertEqual(len(r), 1)
         self.assertFalse(r[0]["study_id"].startswith("__NEW__"))
 
+    def test_new_response_instances(self):
+        phq9 = [
+            r for r in self.tc_data["questionnaireresponse.csv"]
+            if r["interoperability"]["title"] == "Depression (PHQ-9)"
+        ][0]
+        rc_data = {phq9["patientid"]: {**self.rc_data["one-oh-one"]}}
+        tc_data = {
+            "patient.csv": [],
+            "questionnaireresponse.csv": [
+                {**phq9, "id": "new1"}, {**phq9, "id": "new2"}, {**phq9, "id": "new1"}
+            ],
+        }
+        p, r = compare_tc_to_rc(tc_data, rc_data)
+        self.assertEqual(len(r), 2)
+        # one-oh-one already has two phq9 responses at instance 1
+        self.assertEqual([x["redcap_repeat_instance"] for x in r], [2, 3])
+
+    def test_streamed_data(self):
+        def strip_timestamps(responses):
+            return [{k: v for k, v in r.items() if k not in ["datetime", "info_datetime"]} for r in responses]
+
+        p, r = compare_tc_to_rc(parse_tc("fixtures/tc.zip"), self.rc_data)
+        streamed_p, streamed_r = compare_tc_to_rc(iter_tc_data("fixtures/tc.zip"), self.rc_data)
+        self.assertEqual(p, streamed_p)
+        self.assertEqual(strip_timestamps(r), strip_timestamps(streamed_r))
+
+
+class InstanceAllocatorTest(TestCase):
+    def test_allocate(self):
+        allocator = InstanceAllocator({
+            "a": {"study_id": "101", "phq9": [("111", 1), ("222", 4)], "gad7": [], "private": [("then", 1)]}
+        })
+        self.assertTrue(allocator.is_known("a", "phq9", "222"))
+        self.assertFalse(allocator.is_known("a", "phq9", "333"))
+        self.assertFalse(allocator.is_known("b", "phq9", "111"))
+        self.assertEqual(allocator.allocate("a", "phq9", "333"), 5)
+        self.assertTrue(allocator.is_known("a", "phq9", "333"))
+        self.assertEqual(allocator.allocate("a", "phq9", "444"), 6)
+        self.assertEqual(allocator.allocate("a", "gad7", "555"), 1)
+        self.assertEqual(allocator.allocate("a", "private", "now"), 2)
+        self.assertEqual(allocator.allocate("b", "phq9", "111"), 1)
+
+
 if __name__ == "__main__":
     main()
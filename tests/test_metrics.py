@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase, main, mock
+
+from trd_cli.metrics import RunMetrics, CountingIterator, PROMETHEUS_FILE
+from trd_cli.redcap_client import PooledProject, make_session
+
+from tests.fake_redcap import FakeRedcap, TOKEN
+
+
+class RunMetricsTest(TestCase):
+    def test_stage(self):
+        metrics = RunMetrics()
+        with metrics.stage("compare") as stage:
+            rows = CountingIterator(range(1000))
+            total = sum(x * x for x in rows)
+            stage.rows = rows.count
+        self.assertEqual(total, sum(x * x for x in range(1000)))
+        stage = metrics.stages["compare"]
+        self.assertEqual(stage.rows, 1000)
+        self.assertGreater(stage.wall, 0)
+        self.assertAlmostEqual(stage.rows_per_second, 1000 / stage.wall)
+
+    def test_counting_iterator_stage(self):
+        metrics = RunMetrics()
+        with metrics.stage("unpack") as unpack:
+            rows = CountingIterator((time.sleep(0.001) or x for x in range(10)), stage=unpack)
+        wall = unpack.wall
+        with metrics.stage("compare"):
+            self.assertEqual(list(rows), list(range(10)))
+        # Getting the rows is counted in the stage they came from, even though it happened later
+        self.assertEqual(unpack.rows, 10)
+        self.assertGreater(unpack.wall, wall)
+        self.assertGreaterEqual(metrics.stages["compare"].wall, unpack.wall - wall)
+
+    def test_stage_thread_cpu(self):
+        metrics = RunMetrics()
+        with mock.patch("trd_cli.metrics.time.thread_time", side_effect=[1.0, 1.5]), \
+                mock.patch("trd_cli.metrics.time.process_time", side_effect=[1.0, 3.0]):
+            with metrics.stage("unpack", thread_cpu=True):
+                pass
+            with metrics.stage("export"):
+                pass
+        self.assertEqual(metrics.stages["unpack"].cpu, 0.5)
+        self.assertEqual(metrics.stages["export"].cpu, 2.0)
+
+    def test_stage_error(self):
+        metrics = RunMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage("export"):
+                raise ValueError("Failed")
+        self.assertIn("export", metrics.stages)
+        self.assertIsNone(metrics.stages["export"].rows_per_second)
+
+    def test_requests(self):
+        metrics = RunMetrics()
+        with FakeRedcap() as fake:
+            session = metrics.instrument_session(make_session())
+            project = PooledProject(fake.url, TOKEN, session=session)
+            project.import_records([{"study_id": "1", "firstname": "Test"}])
+            project.generate_next_record_name()
+            project.export_records(fields=["id"])
+        self.assertEqual(
+            {k: v.count for k, v in metrics.requests.items()},
+            # Exporting fields fetches the metadata to find the record id field
+            {"record": 2, "generateNextRecordName": 1, "metadata": 1}
+        )
+        self.assertGreater(metrics.requests["record"].bytes_sent, 0)
+        self.assertGreater(metrics.requests["metadata"].bytes_received, 0)
+        self.assertEqual(metrics.requests["record"].errors, 0)
+
+    def test_write(self):
+        metrics = RunMetrics()
+        with metrics.stage("import") as stage:
+            stage.rows = 10
+        with metrics.stage("unpack"):
+            pass
+        metrics.success = True
+        with tempfile.TemporaryDirectory() as log_dir:
+            metrics.write(log_dir, "run.metrics.json")
+            with open(os.path.join(log_dir, "run.metrics.json")) as f:
+                data = json.load(f)
+            with open(os.path.join(log_dir, PROMETHEUS_FILE)) as f:
+                prom = f.read()
+            self.assertEqual(sorted(os.listdir(log_dir)), sorted([PROMETHEUS_FILE, "run.metrics.json"]))
+        self.assertTrue(data["success"])
+        self.assertEqual(data["stages"]["import"]["rows"], 10)
+        self.assertIn("trd_cli_last_run_success 1\n", prom)
+        self.assertIn('trd_cli_stage_rows{stage="import"} 10\n', prom)
+        self.assertIn("# TYPE trd_cli_stage_wall_seconds gauge\n", prom)
+        # Stages without rows have no rows samples
+        self.assertNotIn('trd_cli_stage_rows{stage="unpack"}', prom)
+        self.assertIn('trd_cli_stage_wall_seconds{stage="unpack"}', prom)
+
+
+if __name__ == "__main__":
+    main()
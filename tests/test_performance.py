@@ -0,0 +1,299 @@
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, main, mock
+
+import json
+
+from trd_cli.conversions import ConversionPlan
+from trd_cli.main_functions import extract_redcap_ids, compare_tc_to_rc
+from trd_cli.parse_tc import iter_tc_rows, parse_responses, parse_tc
+from trd_cli.questionnaires import REGISTRY
+from trd_cli.synthetic import SyntheticArchive
+
+from tests.benchmarks import best_time, import_time, run_benchmarks, compare_to_baseline, check_scaling, \
+    requires_benchmarks, BASELINE_FILE, DEFAULT_MAX_SCALING, main as benchmarks_main
+
+
+def scale_fixture(file: str, out_dir: str, scale: int) -> str:
+    """
+    Write a copy of the `fixtures/` csv `file` with its rows repeated `scale` times to `out_dir`.
+    """
+    with open(os.path.join("fixtures", file), "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="|")
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    out_file = os.path.join(out_dir, file)
+    with open(out_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="|")
+        writer.writeheader()
+        for i in range(scale):
+            for row in rows:
+                writer.writerow({**row, "id": f"{row['id']}{i}"})
+    return out_file
+
+
+class LazyDecodingTest(TestCase):
+    def test_lazy_decoding(self):
+        """
+        Reading just the questionnaire titles (as for responses already in REDCap) should only decode them.
+        """
+        rows = list(iter_tc_rows("fixtures/tc.zip", "questionnaireresponse.csv"))
+        with mock.patch("trd_cli.parse_tc.json.loads", wraps=json.loads) as loads:
+            for row in rows:
+                _ = row.get("interoperability")
+        self.assertGreater(loads.call_count, 0)
+        self.assertEqual(loads.call_count, len([r for r in rows if r.get("interoperability") is not None]))
+
+
+@requires_benchmarks
+class LazyDecodingBenchmark(TestCase):
+    scale = 200
+
+    def setUp(self):
+        self.tc_dir = self.enterContext(tempfile.TemporaryDirectory())
+        scale_fixture("questionnaireresponse.csv", self.tc_dir, self.scale)
+
+    def test_lazy_decoding(self):
+        """
+        Reading just the questionnaire titles (as for responses already in REDCap) should skip decoding the rest.
+        """
+        def eager():
+            with open(os.path.join(self.tc_dir, "questionnaireresponse.csv"), "r", newline="") as f:
+                for row in parse_responses(list(csv.DictReader(f, delimiter="|"))):
+                    _ = row.get("interoperability")
+
+        def lazy():
+            for row in iter_tc_rows(self.tc_dir, "questionnaireresponse.csv"):
+                _ = row.get("interoperability")
+
+        eager_time = best_time(eager)
+        lazy_time = best_time(lazy)
+        print(f"questionnaireresponse.csv x{self.scale}: eager {eager_time:.3f}s, lazy {lazy_time:.3f}s")
+        self.assertLess(lazy_time, eager_time)
+
+
+@requires_benchmarks
+class ConversionPlanBenchmark(TestCase):
+    responses = 2000
+
+    def benchmark(self, code):
+        q = REGISTRY.get_by_code(code)
+        response = {
+            "id": 1234,
+            "interoperability": {"submitted": "2024-11-04T12:59:24.9477348+00:00", "title": q["name"]},
+            "scores": {
+                "QuestionScores": [
+                    {"QuestionNumber": i + 1, "Score": 1.0, "DisplayValue": "Answer"} for i in range(len(q["items"]))
+                ],
+                "CategoryScores": [{"Name": c, "Score": 2.0} for c in q["scores"]],
+            },
+        }
+        plan = ConversionPlan(q)
+
+        def legacy():
+            for _ in range(self.responses):
+                q["conversion_fn"](q, response)
+
+        def planned():
+            for _ in range(self.responses):
+                plan.convert(response)
+
+        legacy_time = best_time(legacy)
+        plan_time = best_time(planned)
+        print(f"{code} x{self.responses}: conversion_fn {legacy_time:.4f}s, plan {plan_time:.4f}s")
+        self.assertLess(plan_time, legacy_time)
+
+    def test_asrs(self):
+        self.benchmark("asrs")
+
+    def test_pvss(self):
+        self.benchmark("pvss")
+
+
+def redcap_records(participants: int, instances: int = 10) -> list:
+    """
+    Return a fake REDCap export with `instances` phq9 and gad7 responses for each of `participants`.
+    """
+    records = []
+    for p in range(participants):
+        records.append({
+            "study_id": str(p), "id": f"tc{p}", "redcap_repeat_instrument": "private", "redcap_repeat_instance": 1,
+            "updated": "2024-11-04 12:59:24.973", "info_updated_datetime": "",
+            "phq9_response_id": "", "gad7_response_id": "",
+        })
+        for i in range(instances):
+            for q in ["phq9", "gad7"]:
+                records.append({
+                    "study_id": str(p), "id": f"tc{p}", "redcap_repeat_instrument": q,
+                    "redcap_repeat_instance": i + 1, "updated": "", "info_updated_datetime": "",
+                    "phq9_response_id": "", "gad7_response_id": "", f"{q}_response_id": f"{p}-{q}-{i}",
+                })
+    return records
+
+
+@requires_benchmarks
+class ScalingTest(TestCase):
+    """
+    Check that the time per row at 10x the data is less than `max_scaling` times the time per row at 1x.
+
+    That leaves plenty of room for timing noise while still catching quadratic implementations,
+    whose time per row grows ~10x.
+    """
+    max_scaling = DEFAULT_MAX_SCALING
+
+    def assertLinear(self, fn, small, large, scale: int = 10):
+        # The small size is quick, so it is repeated more to get a stable best time
+        small_time = best_time(lambda: fn(small), repeats=15)
+        large_time = best_time(lambda: fn(large), repeats=5)
+        per_row_ratio = large_time / (small_time * scale)
+        self.assertLess(
+            per_row_ratio, self.max_scaling,
+            f"{fn.__name__}: {small_time:.4f}s -> {large_time:.4f}s for {scale}x the data"
+        )
+
+    def test_extract_redcap_ids(self):
+        self.assertLinear(extract_redcap_ids, redcap_records(1000), redcap_records(10000))
+
+    def test_compare_tc_to_rc(self):
+        with open("fixtures/tc_data.json", "r") as f:
+            tc_data = json.load(f)
+        # A backfill of many new responses for the same participant
+        patient = tc_data["patient.csv"][0]
+        response = tc_data["questionnaireresponse.csv"][0]
+        rc_data = extract_redcap_ids([{
+            "study_id": "101", "id": patient["id"], "redcap_repeat_instrument": "private",
+            "redcap_repeat_instance": 1, "updated": patient["updated"],
+        }])
+
+        def backfill(n):
+            return {
+                "patient.csv": [patient],
+                "questionnaireresponse.csv": [{**response, "patientid": patient["id"], "id": str(i)} for i in range(n)],
+            }
+
+        def compare(data):
+            return compare_tc_to_rc(data, rc_data)
+
+        self.assertLinear(compare, backfill(500), backfill(5000))
+
+    def test_parse_tc(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        paths = []
+        for size in [500, 5000]:
+            paths.append(os.path.join(tmp, f"tc-{size}.zip"))
+            SyntheticArchive(size // 10, size).write(paths[-1])
+        self.assertLinear(parse_tc, *paths)
+
+
+class BenchmarkSuiteTest(TestCase):
+    """
+    Check the benchmark suite itself (see `benchmarks.py`).
+    """
+    def test_all_stages(self):
+        results = run_benchmarks(sizes=[100], repeats=1)
+        stages = results["results"].keys()
+        for stage in ["parse_tc", "extract_redcap_ids", "compare_tc_to_rc", "get_redcap_structure", "run"]:
+            self.assertIn(stage, stages)
+        for code in REGISTRY.codes:
+            self.assertIn(f"conversion_fn.{code}", stages)
+        self.assertTrue(all(list(t.keys()) == ["100"] for t in results["results"].values()))
+
+    def test_compare_to_baseline(self):
+        baseline = {"results": {"a": {"10": 1.0, "100": 2.0}, "b": {"10": 0.001}, "c": {"10": 1.0}}}
+        results = {"results": {"a": {"10": 1.4, "100": 3.2}, "b": {"10": 0.004}, "d": {"10": 1.0}}}
+        self.assertEqual(compare_to_baseline(results, baseline), [("a", "100", 2.0, 3.2)])
+        self.assertEqual(
+            compare_to_baseline(results, baseline, threshold=1.2),
+            [("a", "10", 1.0, 1.4), ("a", "100", 2.0, 3.2)]
+        )
+
+    def test_check_scaling(self):
+        results = {"results": {
+            "linear": {"100": 0.1, "1000": 1.2},
+            "quadratic": {"100": 0.1, "1000": 10.0, "10000": 1000.0},
+            "get_redcap_structure": {"100": 0.0001, "1000": 0.01},
+            "fast": {"100": 0.00001, "1000": 0.001},
+        }}
+        self.assertEqual(
+            [(s, small, large) for s, small, large, _ in check_scaling(results)],
+            [("quadratic", "100", "1000"), ("quadratic", "1000", "10000")]
+        )
+
+    def test_import_time(self):
+        seconds, modules = import_time("json")
+        self.assertIn("json", modules)
+        self.assertGreater(seconds, 0)
+        # Other output on stderr is skipped
+        with mock.patch("tests.benchmarks.subprocess.run") as run:
+            run.return_value.stderr = (
+                "import time: self [us] | cumulative | imported package\n"
+                "import time:       100 |        250 | json\n"
+                "Warning: something else\n"
+            )
+            self.assertEqual(import_time("json"), (0.00025, ["json"]))
+
+    def test_main(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        output = os.path.join(tmp, "results.json")
+        baseline = os.path.join(tmp, "baseline.json")
+        with open(baseline, "w") as f:
+            json.dump({"results": {"run": {"100": 0.001}}}, f)
+        self.assertEqual(
+            benchmarks_main(["--sizes", "100", "--repeats", "1", "--only", "run", "--output", output]), 0
+        )
+        with open(output) as f:
+            self.assertIn("run", json.load(f)["results"])
+        self.assertEqual(
+            benchmarks_main(["--sizes", "100", "--repeats", "1", "--only", "run", "--baseline", baseline]), 1
+        )
+
+    @requires_benchmarks
+    def test_baseline(self):
+        with open(os.environ.get("TRD_BENCHMARK_BASELINE", BASELINE_FILE)) as f:
+            baseline = json.load(f)
+        sizes = sorted(set(int(s) for times in baseline["results"].values() for s in times.keys()))
+        results = run_benchmarks(sizes=sizes)
+        threshold = float(os.environ.get("TRD_BENCHMARK_THRESHOLD", 1.5))
+        self.assertEqual(compare_to_baseline(results, baseline, threshold=threshold), [])
+
+
+class StartupTest(TestCase):
+    """
+    Check that starting `trd-cli` doesn't load what only some commands need, and (with the benchmarks)
+    stays within a time budget.
+    """
+    # The seconds `python -X importtime` may report for importing trd_cli.main.
+    # It was ~0.27s when everything was imported up front, and is ~0.08s with PyCap and requests left out.
+    budget = float(os.environ.get("TRD_IMPORT_BUDGET", 0.15))
+    # Modules that must only be imported by the commands that use them
+    lazy = ["requests", "redcap", "pandas", "trd_cli.sync", "trd_cli.metrics", "trd_cli.questionnaires"]
+
+    def test_lazy_imports(self):
+        _, modules = import_time("trd_cli.main")
+        for module in self.lazy:
+            self.assertNotIn(module, modules)
+
+    def test_dump(self):
+        result = subprocess.run(
+            [
+                sys.executable, "-c",
+                "import sys; from trd_cli.main import cli; cli(['dump'], standalone_mode=False); "
+                "print(sorted(m for m in ['requests', 'redcap'] if m in sys.modules), file=sys.stderr)"
+            ],
+            capture_output=True, text=True, check=True,
+        )
+        self.assertIn("###### private ######", result.stdout)
+        self.assertEqual(result.stderr.strip(), "[]")
+
+    @requires_benchmarks
+    def test_import_budget(self):
+        seconds = min(import_time("trd_cli.main")[0] for _ in range(3))
+        print(f"import trd_cli.main: {seconds:.3f}s (budget {self.budget:.3f}s)")
+        self.assertLess(seconds, self.budget)
+
+
+if __name__ == "__main__":
+    main()
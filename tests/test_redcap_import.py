@@ -0,0 +1,153 @@
+import json
+from unittest import TestCase, main, mock
+
+import requests
+
+from trd_cli.redcap_client import PooledProject, RedcapStatusError, is_record_rejection, make_session
+from trd_cli.redcap_import import chunk_records, import_records_chunked
+from redcap import RedcapError
+
+from tests.fake_redcap import FakeRedcap, TOKEN
+
+
+def make_records(participants: int, per_participant: int) -> list:
+    return [
+        {"study_id": str(p), "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": i + 1,
+         "phq9_response_id": f"{p}-{i}"}
+        for p in range(participants) for i in range(per_participant)
+    ]
+
+
+class ChunkRecordsTest(TestCase):
+    def test_record_limit(self):
+        records = make_records(10, 3)
+        chunks = chunk_records(records, max_records=7, max_bytes=10 ** 6)
+        self.assertEqual([r for c in chunks for r in c], records)
+        for c in chunks:
+            self.assertLessEqual(len(c), 7)
+            # Participants are never split between chunks
+            self.assertEqual(len(c) % 3, 0)
+
+    def test_byte_limit(self):
+        records = make_records(10, 2)
+        record_bytes = len(json.dumps(records[0])) + 2
+        chunks = chunk_records(records, max_records=100, max_bytes=record_bytes * 5)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual([r for c in chunks for r in c], records)
+
+    def test_large_participant(self):
+        records = make_records(1, 10) + make_records(3, 1)[1:]
+        chunks = chunk_records(records, max_records=4, max_bytes=10 ** 6)
+        self.assertEqual(len(chunks[0]), 10)
+        self.assertEqual([r for c in chunks for r in c], records)
+
+
+class ImportRecordsChunkedTest(TestCase):
+    def setUp(self):
+        self.project = mock.Mock()
+        self.bad_records = []
+        self.imported = []
+
+        def import_records(records, **_kwargs):
+            if any(r in self.bad_records for r in records):
+                raise RedcapStatusError("Bad record", 400)
+            self.imported.extend(records)
+            return list(dict.fromkeys(r["study_id"] for r in records))
+
+        self.project.import_records.side_effect = import_records
+
+    def test_all_good(self):
+        records = make_records(20, 3)
+        result = import_records_chunked(self.project, records, max_records=10)
+        self.assertEqual(result.imported, records)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(result.requests, 7)
+        self.assertEqual(self.imported, records)
+
+    def test_bisect_bad_records(self):
+        records = make_records(20, 3)
+        self.bad_records = [records[13], records[40]]
+        with self.assertLogs("trd_cli.redcap_import", level="WARNING"):
+            result = import_records_chunked(self.project, records, max_records=60)
+        self.assertEqual([r for r, _ in result.failed], self.bad_records)
+        self.assertEqual(result.failed_study_ids, ["4", "13"])
+        self.assertEqual(len(result.imported), len(records) - 2)
+        # The good records still land, in order
+        self.assertEqual(self.imported, [r for r in records if r not in self.bad_records])
+
+    def test_missing_ids(self):
+        self.project.import_records.side_effect = lambda records, **_kwargs: [records[0]["study_id"]]
+        records = make_records(2, 2)
+        result = import_records_chunked(self.project, records)
+        self.assertEqual(result.imported_study_ids, ["0"])
+        self.assertEqual(result.failed_study_ids, ["1"])
+
+    def test_network_error(self):
+        self.project.import_records.side_effect = requests.ConnectionError("Connection refused")
+        records = make_records(20, 3)
+        with self.assertLogs("trd_cli.redcap_import", level="ERROR"):
+            result = import_records_chunked(self.project, records, max_records=10)
+        # A failure that doesn't say REDCap rejected the records stops the import rather than bisecting it
+        self.assertEqual(self.project.import_records.call_count, 1)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(result.stopped, records)
+
+    def test_is_record_rejection(self):
+        self.assertTrue(is_record_rejection(RedcapStatusError("Bad record", 400)))
+        self.assertFalse(is_record_rejection(RedcapStatusError("Bad token", 403)))
+        self.assertFalse(is_record_rejection(RedcapError("Bad record")))
+        self.assertFalse(is_record_rejection(requests.Timeout()))
+        self.assertFalse(is_record_rejection(ValueError()))
+
+
+class ConcurrentImportTest(TestCase):
+    def setUp(self):
+        self.fake = self.enterContext(FakeRedcap(latency=0.05))
+        self.project = PooledProject(self.fake.url, TOKEN, session=make_session(pool_size=4))
+        self.records = make_records(8, 3)
+
+    def test_sequential(self):
+        result = import_records_chunked(self.project, self.records, max_records=3)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(self.fake.records, self.records)
+        self.assertEqual(self.fake.max_active, 1)
+
+    def test_concurrent(self):
+        result = import_records_chunked(self.project, self.records, max_records=3, workers=4)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(result.imported, self.records)
+        self.assertEqual(len(self.fake.requests), 8)
+        self.assertGreater(self.fake.max_active, 1)
+        # Requests overlap, but never more than there are workers
+        self.assertLessEqual(self.fake.max_active, 4)
+        # Each participant's records arrive in order
+        for study_id in set(r["study_id"] for r in self.records):
+            self.assertEqual(
+                [r for r in self.fake.records if r["study_id"] == study_id],
+                [r for r in self.records if r["study_id"] == study_id],
+            )
+
+    def test_rejected_token(self):
+        # A bad token fails every chunk, so the import stops at the first rather than bisecting
+        project = PooledProject(self.fake.url, TOKEN[::-1])
+        with self.assertLogs("trd_cli.redcap_import", level="ERROR") as logs:
+            result = import_records_chunked(project, self.records, max_records=3)
+        self.assertEqual(len(self.fake.requests), 1)
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(result.stopped, self.records)
+        self.assertEqual(result.failed_study_ids, [str(p) for p in range(8)])
+        self.assertIn("permissions", result.error)
+
+    def test_server_error(self):
+        self.fake.fail_requests = 1
+        result = import_records_chunked(self.project, self.records, max_records=3, workers=4)
+        # The other chunks may already be on their way, but none are split up and retried
+        self.assertEqual(len(self.fake.requests), len(result.imported) // 3 + 1)
+        self.assertEqual(len(result.imported) + len(result.stopped), len(self.records))
+        self.assertEqual(result.failed, [])
+        self.assertIsNotNone(result.error)
+
+
+if __name__ == "__main__":
+    main()
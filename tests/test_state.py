@@ -0,0 +1,86 @@
+import datetime
+import json
+import os
+import tempfile
+from unittest import TestCase, main
+
+from trd_cli.main_functions import extract_redcap_ids
+from trd_cli.state import SyncState, RowDelta
+
+
+class SyncStateTest(TestCase):
+    def setUp(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = os.path.join(tmp, "state.db")
+        self.state = self.enterContext(SyncState(self.path))
+        with open("fixtures/redcap_export.json", "r") as f:
+            self.redcap_id_data = extract_redcap_ids(json.load(f))
+
+    def test_round_trip(self):
+        self.assertEqual(self.state.redcap_id_data(), {})
+        self.state.replace(self.redcap_id_data)
+        self.assertEqual(self.state.redcap_id_data(), self.redcap_id_data)
+        # The state is kept between runs
+        self.state.close()
+        with SyncState(self.path) as state:
+            self.assertEqual(state.redcap_id_data(), self.redcap_id_data)
+
+    def test_needs_reconcile(self):
+        self.assertTrue(self.state.needs_reconcile())
+        self.state.replace(self.redcap_id_data)
+        self.assertFalse(self.state.needs_reconcile(hours=1))
+        self.state.set_meta("last_reconciled", (datetime.datetime.now() - datetime.timedelta(hours=2)).isoformat())
+        self.assertTrue(self.state.needs_reconcile(hours=1))
+        self.assertFalse(self.state.needs_reconcile(hours=3))
+
+    def test_record_imported(self):
+        self.state.replace(self.redcap_id_data)
+        self.state.record_imported(
+            [
+                {"study_id": 103, "redcap_repeat_instrument": "private", "redcap_repeat_instance": 1,
+                 "id": "one-oh-three", "updated": "2024-11-04 12:59:24.973"},
+                {"study_id": 103, "consent_response_id": "c1"},
+                {"study_id": "101", "redcap_repeat_instrument": "phq9", "redcap_repeat_instance": 2,
+                 "phq9_response_id": "p2"},
+            ],
+            {"101": "one-oh-one", "102": "one-oh-two", "103": "one-oh-three"},
+        )
+        data = self.state.redcap_id_data()
+        self.assertEqual(data["one-oh-three"]["study_id"], "103")
+        self.assertEqual(data["one-oh-three"]["private"], [("2024-11-04 12:59:24.973", 1)])
+        self.assertEqual(data["one-oh-three"]["consent"], [("c1", None)])
+        self.assertEqual(data["one-oh-one"]["phq9"], [*self.redcap_id_data["one-oh-one"]["phq9"], ("p2", 2)])
+        self.assertEqual(data["one-oh-two"], self.redcap_id_data["one-oh-two"])
+
+    def test_unknown_study_id(self):
+        with self.assertLogs("trd_cli.state", level="WARNING"):
+            self.state.record_imported([{"study_id": "999", "consent_response_id": "c1"}], {})
+        self.assertEqual(self.state.redcap_id_data(), {})
+
+
+class RowDeltaTest(TestCase):
+    def test_row_delta(self):
+        rows = [{"id": "1", "value": "a"}, {"id": "2", "value": "b"}]
+        first = RowDelta({})
+        self.assertEqual([first("patient.csv", r) for r in rows], [False, False])
+        second = RowDelta(first.current)
+        changed = [{"id": "1", "value": "a"}, {"id": "2", "value": "c"}, {"id": "3", "value": "d"}]
+        self.assertEqual([second("patient.csv", r) for r in changed], [True, False, False])
+        self.assertEqual(second.skipped, 1)
+        # Rows are only compared with those of the same file
+        self.assertFalse(second("questionnaireresponse.csv", rows[0]))
+        self.assertEqual(len(second.current["patient.csv"]), 3)
+
+    def test_stored(self):
+        delta = RowDelta({})
+        delta("patient.csv", {"id": "1", "value": "a"})
+        with SyncState(os.path.join(self.enterContext(tempfile.TemporaryDirectory()), "state.db")) as state:
+            self.assertEqual(state.get_row_hashes(), {})
+            state.set_row_hashes(delta.current)
+            self.assertEqual(state.get_row_hashes(), delta.current)
+            state.set_row_hashes({})
+            self.assertEqual(state.get_row_hashes(), {})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, main
+
+from click.testing import CliRunner
+from click.core import Command
+
+from trd_cli.main import generate
+from trd_cli.main_functions import compare_tc_to_rc, extract_redcap_ids
+from trd_cli.parse_tc import parse_tc
+from trd_cli.questionnaires import QUESTIONNAIRES
+from trd_cli.synthetic import SyntheticArchive
+
+generate: Command  # annotating to avoid linter warnings
+
+
+class SyntheticArchiveTest(TestCase):
+    def setUp(self):
+        self.tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.archive = SyntheticArchive(20, 200, seed=1)
+
+    def test_deterministic(self):
+        self.archive.write(os.path.join(self.tmp, "a.zip"))
+        SyntheticArchive(20, 200, seed=1).write(os.path.join(self.tmp, "b.zip"))
+        SyntheticArchive(20, 200, seed=2).write(os.path.join(self.tmp, "c.zip"))
+        with open(os.path.join(self.tmp, "a.zip"), "rb") as a, open(os.path.join(self.tmp, "b.zip"), "rb") as b:
+            self.assertEqual(a.read(), b.read())
+        with open(os.path.join(self.tmp, "a.zip"), "rb") as a, open(os.path.join(self.tmp, "c.zip"), "rb") as c:
+            self.assertNotEqual(a.read(), c.read())
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp, "tc.zip")
+        self.archive.write(path)
+        self.assertEqual(parse_tc(path), self.archive.tc_data())
+
+    def test_all_questionnaires(self):
+        titles = set(
+            r["interoperability"]["title"] for r in self.archive.responses if r["interoperability"] is not None
+        )
+        self.assertEqual(titles, set(q["name"] for q in QUESTIONNAIRES))
+        with self.assertNoLogs("trd_cli.conversions", level="WARNING"):
+            submitted = [r for r in self.archive.responses if r["interoperability"] is not None]
+            new_participants, new_responses = compare_tc_to_rc(
+                {"patient.csv": self.archive.patients, "questionnaireresponse.csv": submitted}, {}
+            )
+        self.assertEqual(len(new_participants), 20)
+        self.assertEqual(len(new_responses), 2 * 20 + len(submitted))
+
+    def test_redcap_export(self):
+        full = self.archive.redcap_export(synced=1)
+        self.assertEqual(self.archive.redcap_export(synced=0), [])
+        partial = self.archive.redcap_export(synced=0.5)
+        self.assertLess(len(partial), len(full))
+        self.assertEqual(partial, self.archive.redcap_export(synced=0.5))
+
+        with self.assertLogs("trd_cli.main_functions", level="WARNING"):
+            _, all_new = compare_tc_to_rc(self.archive.tc_data(), {})
+        with self.assertLogs("trd_cli.main_functions", level="WARNING"):
+            _, nothing_new = compare_tc_to_rc(self.archive.tc_data(), extract_redcap_ids(full))
+        self.assertEqual(nothing_new, [])
+        with self.assertLogs("trd_cli.main_functions", level="WARNING"):
+            new_participants, some_new = compare_tc_to_rc(self.archive.tc_data(), extract_redcap_ids(partial))
+        self.assertGreater(len(some_new), 0)
+        # Everything that isn't in the partial export is new
+        self.assertEqual(len(some_new) + len(partial), len(all_new))
+        self.assertEqual(len(new_participants), 20 - len(set(r["study_id"] for r in partial)))
+
+
+class GenerateCommandTest(TestCase):
+    def test_generate(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            result = runner.invoke(
+                generate, ["tc.zip", "--patients", "5", "--responses", "50", "--redcap-export", "rc.json"]
+            )
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(len(parse_tc("tc.zip")["questionnaireresponse.csv"]), 50)
+            with open("rc.json") as f:
+                self.assertIsInstance(json.load(f), list)
+
+
+if __name__ == "__main__":
+    main()
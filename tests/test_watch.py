@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, main, mock, skipUnless
+
+from click.testing import CliRunner
+from click.core import Command
+
+from trd_cli.main import watch
+from trd_cli.metrics import RunMetrics
+from trd_cli.synthetic import SyntheticArchive
+from trd_cli.watch import InotifyWatcher, PollingWatcher, WatchHealth, make_watcher
+
+from tests.fake_redcap import FakeRedcap, TOKEN
+
+watch: Command  # annotating to avoid linter warnings
+
+
+class WatcherTest(TestCase):
+    def setUp(self):
+        self.tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = os.path.join(self.tmp, "tc.zip")
+        with open(self.path, "w") as f:
+            f.write("old")
+
+    def check_watcher(self, watcher):
+        self.addCleanup(watcher.close)
+        self.assertFalse(watcher.wait(0.05))
+        # Other files in the directory are ignored
+        with open(os.path.join(self.tmp, "other.zip"), "w") as f:
+            f.write("other")
+        self.assertFalse(watcher.wait(0.05))
+        # Written over
+        with open(self.path, "w") as f:
+            f.write("new!")
+        self.assertTrue(watcher.wait(1))
+        self.assertFalse(watcher.wait(0.05))
+        # Moved into place
+        with open(os.path.join(self.tmp, "tc.zip.part"), "w") as f:
+            f.write("newer")
+        os.replace(os.path.join(self.tmp, "tc.zip.part"), self.path)
+        self.assertTrue(watcher.wait(1))
+
+    def test_polling(self):
+        self.check_watcher(PollingWatcher(self.path, poll_seconds=0.01))
+
+    @skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+    def test_inotify(self):
+        self.check_watcher(InotifyWatcher(self.path))
+        self.assertIsInstance(make_watcher(self.path), InotifyWatcher)
+
+    def test_fallback(self):
+        with mock.patch("trd_cli.watch.InotifyWatcher", side_effect=OSError("unavailable")):
+            self.assertIsInstance(make_watcher(self.path, poll_seconds=0.01), PollingWatcher)
+
+    def test_health(self):
+        health = WatchHealth(os.path.join(self.tmp, "health", "health.json"))
+        metrics = RunMetrics()
+        metrics.success = False
+        health.record(metrics, "start")
+        health.record(metrics, "interval")
+        health.write("idle", next_cycle=1.0)
+        with open(health.path) as f:
+            written = json.load(f)
+        self.assertEqual(written["status"], "idle")
+        self.assertEqual(written["cycles"], 2)
+        self.assertEqual(written["consecutive_failures"], 2)
+        self.assertEqual(written["last_cycle"]["trigger"], "interval")
+
+
+class WatchTest(TestCase):
+    """
+    Run `trd-cli watch` against a local fake REDCap server.
+    """
+    def setUp(self):
+        self.fake = self.enterContext(FakeRedcap())
+        self.tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.archive = os.path.join(self.tmp, "tc.zip")
+        self.health_file = os.path.join(self.tmp, "health.json")
+        shutil.copy("fixtures/tc.zip", self.archive)
+        self.enterContext(mock.patch.dict(os.environ, {
+            "TRD_REDCAP_URL": self.fake.url,
+            "TRD_REDCAP_TOKEN": TOKEN,
+            "TRD_TRUE_COLOURS_ARCHIVE": self.archive,
+            "TRD_LOG_DIR": os.path.join(self.tmp, "logs"),
+            "TRD_LOG_LEVEL": "INFO",
+            "TRD_HEALTH_FILE": self.health_file,
+        }))
+        os.environ.pop("TRD_MAILTO_ADDRESS", None)
+        os.environ.pop("TRD_STATE_DB", None)
+
+    def invoke(self, *args):
+        result = CliRunner().invoke(watch, ["--settle-seconds", "0.1", *args], catch_exceptions=False)
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(self.health_file) as f:
+            return result, json.load(f)
+
+    def exports(self):
+        return len([r for r in self.fake.requests if r.get("content") == "record" and "data" not in r])
+
+    def test_interval(self):
+        result, health = self.invoke("--interval", "0", "--max-cycles", "2")
+        self.assertEqual(health["status"], "stopped")
+        self.assertEqual(health["cycles"], 2)
+        self.assertEqual(health["last_cycle"]["trigger"], "interval")
+        self.assertTrue(health["last_cycle"]["success"])
+        # REDCap is only exported once: the second sync uses the ids kept from the first
+        self.assertEqual(self.exports(), 1)
+        self.assertIn("No change in the True Colours archive", result.output)
+        self.assertTrue(result.output.startswith("Watching "))
+
+    def test_missing_archive(self):
+        os.environ.pop("TRD_TRUE_COLOURS_ARCHIVE")
+        result = CliRunner().invoke(watch, ["--max-cycles", "1"])
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("Missing required argument: tc_archive", result.output)
+        self.assertFalse(os.path.exists(self.health_file))
+
+    def test_change(self):
+        def drop_archive():
+            time.sleep(0.5)
+            SyntheticArchive(5, 50).write(f"{self.archive}.part")
+            os.replace(f"{self.archive}.part", self.archive)
+
+        dropper = threading.Thread(target=drop_archive)
+        dropper.start()
+        self.addCleanup(dropper.join)
+        started = time.monotonic()
+        result, health = self.invoke("--interval", "60", "--max-cycles", "2")
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual(health["last_cycle"]["trigger"], "change")
+        self.assertEqual(self.exports(), 1)
+        self.assertIn(SyntheticArchive(5, 50).patients[0]["id"], [r.get("id") for r in self.fake.records])
+
+    def test_state_db(self):
+        state_db = os.path.join(self.tmp, "state.db")
+        self.invoke("--interval", "0", "--max-cycles", "1", "--state-db", state_db)
+        self.invoke("--interval", "0", "--max-cycles", "1", "--state-db", state_db)
+        self.assertEqual(self.exports(), 1)
+
+
+if __name__ == "__main__":
+    main()
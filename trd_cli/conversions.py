@@ -138,3 +138,89 @@ def extract_participant_info(patient_csv_data: dict) -> Tuple[dict, dict]:
         "info_updated_datetime": patient_csv_data.get("updated"),
     }
 
+
+
+class ConversionPlan:
+    """
+    A questionnaire's conversion to a REDCap record, worked out once in advance.
+
+    Each `QuestionNumber` and category score `Name` is mapped to its REDCap field name,
+    so a response can be converted with a single pass over its `QuestionScores`.
+    The records produced are identical to those from the questionnaire's `conversion_fn`,
+    which is used directly for conversion functions the plan doesn't know about.
+    """
+    def __init__(self, questionnaire: QuestionnaireMetadata):
+        self.questionnaire = questionnaire
+        self.prefix = questionnaire["code"]
+        conversion_fn = questionnaire["conversion_fn"]
+        # (QuestionNumber, REDCap field, QuestionScores key, item name) for each item
+        self.items: List[Tuple[int, str, str, str]] = []
+        # (category Name, REDCap field) for each score
+        self.categories: List[Tuple[str, str]] = []
+        self.fallback_fn: Optional[Callable[[QuestionnaireMetadata, dict], dict]] = None
+        self.kind = None
+        if conversion_fn is convert_consent:
+            self.kind = "consent"
+            self.prefix = "consent"
+            # Question 18 is not reported because it's a signature
+            self.items = [(q + 1, f"consent_{q + 1}_str", "DisplayValue", "") for q in [*range(17), 18]]
+        elif conversion_fn is convert_display_values:
+            self.kind = "display_values"
+            self.items = [
+                (i + 1, f"{self.prefix}_{i + 1}_{k}_str", "DisplayValue", k)
+                for i, k in enumerate(questionnaire["items"])
+            ]
+        elif conversion_fn is convert_scores:
+            self.kind = "scores"
+            self.items = [
+                (i + 1, f"{self.prefix}_{i + 1}_{k}_float", "Score", k)
+                for i, k in enumerate(questionnaire["items"])
+            ]
+            self.categories = [
+                (c, f"{self.prefix}_score_{convert_key(c)}_float") for c in questionnaire["scores"]
+            ]
+        else:
+            self.fallback_fn = conversion_fn
+        self.response_id_field = f"{self.prefix}_response_id"
+        self.datetime_field = f"{self.prefix}_datetime"
+
+    def convert(self, questionnaire_response: dict) -> dict:
+        """
+        Convert a questionnaire response to REDCap fields.
+        """
+        if self.fallback_fn is not None:
+            return self.fallback_fn(self.questionnaire, questionnaire_response)
+        if self.kind == "consent":
+            submitted = questionnaire_response["submitted"]
+        else:
+            submitted = str(questionnaire_response["interoperability"]["submitted"])
+        out = {
+            self.response_id_field: str(questionnaire_response["id"]),
+            self.datetime_field: submitted,
+        }
+        scores = questionnaire_response["scores"]
+        # The first score for each question wins, as with a `next()` search
+        question_scores = {}
+        for x in scores["QuestionScores"]:
+            question_scores.setdefault(x["QuestionNumber"], x)
+        for number, field, key, name in self.items:
+            item = question_scores.get(number)
+            if self.kind == "consent":
+                out[field] = item[key]
+                continue
+            if not item:
+                LOGGER.warning(f"{self.prefix}: No {name} in scores")
+                continue
+            out[field] = str(item[key])
+
+        if self.kind == "scores":
+            category_scores = {}
+            for x in scores["CategoryScores"]:
+                category_scores.setdefault(x["Name"], x)
+            for name, field in self.categories:
+                score = category_scores.get(name)
+                if not score:
+                    LOGGER.warning(f"{self.prefix}: No {name} in category scores")
+                    continue
+                out[field] = str(score["Score"])
+        return out
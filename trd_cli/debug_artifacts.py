@@ -0,0 +1,41 @@
+import gzip
+import json
+import logging
+import os
+from typing import Iterable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DebugArtifacts:
+    """
+    Write large data structures that are useful for debugging a run to their own files, instead of the log.
+
+    Nothing is serialised unless `logger` is enabled for DEBUG, so runs at INFO don't pay for it.
+    Each artifact is streamed one item at a time as newline-delimited JSON to a gzip file in `directory`,
+    named `<run_name>.<name>.ndjson.gz`, so the log itself stays small and quick to scan.
+    """
+    def __init__(self, directory: str, run_name: str, logger: logging.Logger):
+        self.directory = directory
+        self.run_name = run_name
+        self.logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def write(self, name: str, items: Iterable) -> Optional[str]:
+        """
+        Write `items` (which are only iterated if DEBUG is enabled) to the `name` artifact. Return its path.
+        """
+        if not self.enabled:
+            return None
+        path = os.path.join(self.directory, f"{self.run_name}.{name}.ndjson.gz")
+        count = 0
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item, default=str))
+                f.write("\n")
+                count += 1
+        self.logger.debug(f"Wrote {count} {name} items to {path}.")
+        return path
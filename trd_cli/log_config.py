@@ -1,4 +1,28 @@
+import copy
+import datetime
+import gzip
+import json
+import logging
 import os
+import queue
+import shutil
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Iterator, List, Optional, Set
+
+# The most warnings and errors to keep for the email digest, and the most characters of each
+DIGEST_MAX_RECORDS = 50
+DIGEST_MAX_RECORD_CHARS = 2000
+# A run's log is rotated (and the old part gzipped) when it reaches this size, keeping this many old parts
+DEFAULT_LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Files from runs older than this are deleted from the log directory
+DEFAULT_LOG_KEEP_DAYS = 30
+# The files each run writes to the log directory (logs, metrics, debug artifacts) start with this
+RUN_FILE_PREFIX = "trd_cli-"
+LOG_FORMATS = ["text", "json"]
+# A run keeps a file with this suffix (holding its process id) next to its log while it's running
+RUN_PID_SUFFIX = ".pid"
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -6,25 +30,255 @@ LOGGING_CONFIG = {
     "formatters": {
         "simple": {
             "format": "%(asctime)s %(levelname)s %(name)s.%(funcName)s: %(message)s"
-        }
+        },
+        "json": {
+            "()": "trd_cli.log_config.JsonLinesFormatter",
+        },
     },
     "handlers": {
         "file": {
-            "class": "logging.FileHandler",
+            "class": "trd_cli.log_config.GzipRotatingFileHandler",
             "formatter": "simple",
             "filename": "trd_cli.log",
-            "mode": "w",
-        }
+            "maxBytes": DEFAULT_LOG_MAX_BYTES,
+            "backupCount": LOG_BACKUP_COUNT,
+        },
+        "counter": {
+            "()": "trd_cli.log_config.CountingHandler",
+            "formatter": "simple",
+        },
     },
-    "root": {"level": "INFO", "handlers": ["file"]},
+    "root": {"level": "INFO", "handlers": ["file", "counter"]},
 }
 
 
-def get_config(log_file: str) -> dict:
+class CountingHandler(logging.Handler):
+    """
+    Count the log records emitted at each level, and keep the first warnings and errors for the email digest.
+
+    At most `max_records` warnings and errors are kept, each cut to `max_record_chars` characters of its formatted
+    message (including any traceback), so the digest stays small however much is logged.
+    The number that didn't fit is kept in `truncated`.
+    """
+    def __init__(self, max_records: int = DIGEST_MAX_RECORDS, max_record_chars: int = DIGEST_MAX_RECORD_CHARS):
+        super().__init__()
+        self.max_records = max_records
+        self.max_record_chars = max_record_chars
+        self.counts: Dict[str, int] = {}
+        self.digest: List[str] = []
+        self.truncated = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.counts[record.levelname] = self.counts.get(record.levelname, 0) + 1
+        if record.levelno < logging.WARNING:
+            return
+        if len(self.digest) >= self.max_records:
+            self.truncated += 1
+            return
+        try:
+            self.digest.append(self.format(record)[:self.max_record_chars])
+        except Exception:
+            self.handleError(record)
+
+    @property
+    def errors(self) -> int:
+        return self.counts.get("ERROR", 0) + self.counts.get("CRITICAL", 0)
+
+    @property
+    def warnings(self) -> int:
+        return self.counts.get("WARNING", 0)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Format each log record as a single line of JSON, for log collectors to ingest.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class GzipRotatingFileHandler(RotatingFileHandler):
+    """
+    A `RotatingFileHandler` that gzips the parts of the log it rotates out (`<log>.1.gz`, `<log>.2.gz`, ...).
+    """
+    def rotation_filename(self, default_name: str) -> str:
+        return f"{default_name}.gz"
+
+    def rotate(self, source: str, dest: str):
+        gzip_log(source, dest)
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    A `QueueHandler` for a queue in the same process, which leaves exception info on records for the formatters.
+
+    The message is still resolved straight away, in case its arguments change before it is written.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogQueue:
+    """
+    Move the root logger's handlers behind a queue, so logging calls never wait on the disk.
+
+    Records are put on a queue by a `QueueHandler` and written out by the handlers on a `QueueListener` thread.
+    `flush` waits for everything logged so far to be handled; `stop` does that and puts the handlers back.
+    """
+    def __init__(self):
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.queue = queue.Queue()
+        self.queue_handler = LocalQueueHandler(self.queue)
+        # So get_counting_handler can find the counter behind the queue
+        self.queue_handler.log_queue = self
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+
+    def start(self) -> "LogQueue":
+        for h in self.handlers:
+            self.root.removeHandler(h)
+        self.root.addHandler(self.queue_handler)
+        self.listener.start()
+        return self
+
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        self.listener.stop()
+        self.root.removeHandler(self.queue_handler)
+        for h in self.handlers:
+            self.root.addHandler(h)
+
+
+def _root_handlers() -> Iterator[logging.Handler]:
+    for h in logging.getLogger().handlers:
+        log_queue = getattr(h, "log_queue", None)
+        if log_queue is not None:
+            yield from log_queue.handlers
+        else:
+            yield h
+
+
+def get_counting_handler() -> Optional[CountingHandler]:
+    """
+    Return the `CountingHandler` installed by `get_config`, if logging has been configured with it.
+    """
+    return next((h for h in _root_handlers() if isinstance(h, CountingHandler)), None)
+
+
+def gzip_log(source: str, dest: str):
+    """
+    Compress the log file `source` to `dest`, keeping its modification time, and delete `source`.
+    """
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    stat = os.stat(source)
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(source)
+
+
+def run_pid_file(log_file: str) -> str:
+    """
+    Return the path of the pid file of the run that logs to `log_file`.
+    """
+    return f"{os.path.splitext(log_file)[0]}{RUN_PID_SUFFIX}"
+
+
+def mark_run_live(log_file: str) -> str:
+    """
+    Write the pid file of the run that logs to `log_file`, so other runs leave its files alone, and return its path.
+
+    The run should delete it when it finishes.
+    """
+    pid_file = run_pid_file(log_file)
+    os.makedirs(os.path.dirname(pid_file), exist_ok=True)
+    with open(pid_file, "w") as f:
+        f.write(str(os.getpid()))
+    return pid_file
+
+
+def _is_process_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to someone else
+        return True
+    return True
+
+
+def live_runs(log_dir: str) -> Set[str]:
+    """
+    Return the names of the runs in `log_dir` that are still running, according to their pid files.
+
+    The pid files of runs that have died without deleting them are deleted.
+    """
+    live = set()
+    for name in os.listdir(log_dir):
+        if not name.startswith(RUN_FILE_PREFIX) or not name.endswith(RUN_PID_SUFFIX):
+            continue
+        path = os.path.join(log_dir, name)
+        try:
+            with open(path) as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            # Being written, or just deleted: leave it be
+            live.add(name[:-len(RUN_PID_SUFFIX)])
+            continue
+        if _is_process_running(pid):
+            live.add(name[:-len(RUN_PID_SUFFIX)])
+        else:
+            os.remove(path)
+    return live
+
+
+def tidy_log_dir(log_dir: str, current_log: str, keep_days: float = DEFAULT_LOG_KEEP_DAYS):
+    """
+    Gzip the logs of earlier runs in `log_dir`, and delete any run files older than `keep_days` (if it isn't 0).
+
+    The files of runs that are still going (see `mark_run_live`), which can overlap when cron starts a run
+    before the last has finished, are left alone.
+    """
+    cutoff = time.time() - keep_days * 24 * 60 * 60
+    live = live_runs(log_dir)
+    for name in os.listdir(log_dir):
+        path = os.path.join(log_dir, name)
+        if not name.startswith(RUN_FILE_PREFIX) or not os.path.isfile(path):
+            continue
+        if name.split(".", 1)[0] in live:
+            continue
+        if keep_days > 0 and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            logging.getLogger(__name__).debug(f"Deleted {path}, which is more than {keep_days} days old.")
+        elif name.endswith(".log") and path != current_log:
+            gzip_log(path, f"{path}.gz")
+
+
+def get_config(log_file: str, max_bytes: int = DEFAULT_LOG_MAX_BYTES, log_format: str = "text") -> dict:
     """
     Return a dictionary of the logging configuration.
+
+    The log is written to `log_file`, rotated when it reaches `max_bytes`, in the `log_format` "text" or "json"
+    (JSON lines).
     """
-    config = {**LOGGING_CONFIG}
+    config = copy.deepcopy(LOGGING_CONFIG)
     config["handlers"]["file"]["filename"] = log_file
+    config["handlers"]["file"]["maxBytes"] = max_bytes
+    if log_format == "json":
+        config["handlers"]["file"]["formatter"] = "json"
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
     return config
@@ -1,20 +1,16 @@
-import datetime
-import json
 import os
+import time
 
-from redcap import Project
 import click
-import requests
 
-from trd_cli.questionnaires import QUESTIONNAIRES, dump_redcap_structure
-from trd_cli.main_functions import extract_redcap_ids, get_true_colours_data, compare_tc_to_rc, \
-    get_response_id_from_response_data
+# Only the defaults of the options are imported here, so that `--help`, `--version` and `dump` start quickly.
+# The modules that talk to REDCap (and import PyCap and requests) are imported by the commands that need them.
+from trd_cli.log_config import DEFAULT_LOG_KEEP_DAYS, DEFAULT_LOG_MAX_BYTES, LOG_FORMATS
+from trd_cli.state import DEFAULT_RECONCILE_HOURS
+from trd_cli.redcap_import import DEFAULT_CHUNK_RECORDS, DEFAULT_CHUNK_BYTES
+from trd_cli.watch import HEALTH_FILE, DEFAULT_INTERVAL_SECONDS, DEFAULT_POLL_SECONDS, DEFAULT_SETTLE_SECONDS
 
-# Construct a logger that saves logged events to a dictionary that we can attach to an email later
 import logging
-from logging.config import dictConfig
-from trd_cli.log_config import get_config
-
 LOGGER = logging.getLogger(__name__)
 
 
@@ -25,82 +21,187 @@ def cli():
     pass
 
 
+# The options of `run`, which `watch` shares
+RUN_OPTIONS = [
+    click.option(
+        "--rc-url",
+        help="The URL to connect to the REDCap API.",
+        type=str,
+        default=lambda: os.environ.get("TRD_REDCAP_URL"),
+    ),
+    click.option(
+        "--rc-token",
+        help="The secret to connect to the REDCap API.",
+        type=str,
+        default=lambda: os.environ.get("TRD_REDCAP_TOKEN"),
+    ),
+    click.option(
+        "--rc-snapshot",
+        help="A REDCap export saved by `trd-cli snapshot` to use instead of REDCap. "
+             "Runs offline, as a dry run, without --rc-url or --rc-token.",
+        type=click.Path(exists=True, dir_okay=False, readable=True, resolve_path=True),
+        default=lambda: os.environ.get("TRD_REDCAP_SNAPSHOT"),
+    ),
+    click.option(
+        "--tc-archive",
+        help="The True Colours data archive .zip file.",
+        type=click.Path(exists=True, dir_okay=False, readable=True, resolve_path=True),
+        default=lambda: os.environ.get("TRD_TRUE_COLOURS_ARCHIVE"),
+    ),
+    click.option(
+        "--mailto",
+        help="The email address to send the summary to. If blank, no email will be sent.",
+        type=str,
+        default=lambda: os.environ.get("TRD_MAILTO_ADDRESS"),
+    ),
+    click.option(
+        "--mg-secret",
+        help="The secret for the Mailgun API.",
+        type=str,
+        default=lambda: os.environ.get("TRD_MAILGUN_SECRET"),
+    ),
+    click.option(
+        "--mg-domain",
+        help="The domain for the Mailgun API.",
+        type=str,
+        default=lambda: os.environ.get("TRD_MAILGUN_DOMAIN"),
+    ),
+    click.option(
+        "--mg-username",
+        help="The username for the Mailgun API.",
+        type=str,
+        default=lambda: os.environ.get("TRD_MAILGUN_USERNAME"),
+    ),
+    click.option(
+        "--dry-run",
+        help="Don't actually upload to REDCap.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--import-chunk-records",
+        help="The maximum number of records to send to REDCap in a single import request.",
+        type=click.IntRange(min=1),
+        default=lambda: int(os.environ.get("TRD_IMPORT_CHUNK_RECORDS", DEFAULT_CHUNK_RECORDS)),
+        show_default=str(DEFAULT_CHUNK_RECORDS),
+    ),
+    click.option(
+        "--import-chunk-bytes",
+        help="The maximum size (in bytes of JSON) of a single REDCap import request.",
+        type=click.IntRange(min=1),
+        default=lambda: int(os.environ.get("TRD_IMPORT_CHUNK_BYTES", DEFAULT_CHUNK_BYTES)),
+        show_default=str(DEFAULT_CHUNK_BYTES),
+    ),
+    click.option(
+        "--import-workers",
+        help=(
+            "The number of concurrent REDCap import requests. "
+            "Participants' records are split between workers, so each participant's records stay in order."
+        ),
+        type=click.IntRange(min=1),
+        default=lambda: int(os.environ.get("TRD_IMPORT_WORKERS", 1)),
+        show_default="1",
+    ),
+    click.option(
+        "--overlap-export",
+        help=(
+            "Read the True Colours archive in a worker thread while REDCap is being exported. "
+            "Faster for large archives, but holds the whole archive in memory rather than streaming it."
+        ),
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--state-db",
+        help=(
+            "A local SQLite file recording what has been synced to REDCap. "
+            "When given, REDCap is only exported in full to reconcile the state on schedule (or with --reconcile)."
+        ),
+        type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+        default=lambda: os.environ.get("TRD_STATE_DB"),
+    ),
+    click.option(
+        "--reconcile-hours",
+        help="How often to reconcile the --state-db with a full REDCap export.",
+        type=click.FloatRange(min=0),
+        default=lambda: float(os.environ.get("TRD_RECONCILE_HOURS", DEFAULT_RECONCILE_HOURS)),
+        show_default=str(DEFAULT_RECONCILE_HOURS),
+    ),
+    click.option(
+        "--reconcile",
+        help="Reconcile the --state-db with a full REDCap export now.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--force",
+        help="Run even if the True Colours archive hasn't changed since the last successful run (with --state-db).",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--profile",
+        help=(
+            "Profile the run with cProfile and tracemalloc, writing a .pstats file, "
+            "the top allocations of each stage, and the peak RSS to this directory."
+        ),
+        type=click.Path(file_okay=False, writable=True, resolve_path=True),
+        default=lambda: os.environ.get("TRD_PROFILE_DIR"),
+    ),
+    click.option(
+        "--log-dir",
+        help="The directory to save the log file to.",
+        type=click.Path(file_okay=False, writable=True, resolve_path=True),
+        default=lambda: os.environ.get("TRD_LOG_DIR", "/var/log/trd_cli"),
+        show_default="/var/log/trd_cli",
+    ),
+    click.option(
+        "--log-level",
+        help="The log level to use.",
+        type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
+        default=lambda: os.environ.get("TRD_LOG_LEVEL", "INFO"),
+        show_default="INFO",
+    ),
+    click.option(
+        "--log-max-bytes",
+        help="Rotate the log file when it reaches this size, gzipping the old part.",
+        type=click.IntRange(min=1),
+        default=lambda: int(os.environ.get("TRD_LOG_MAX_BYTES", DEFAULT_LOG_MAX_BYTES)),
+        show_default=str(DEFAULT_LOG_MAX_BYTES),
+    ),
+    click.option(
+        "--log-keep-days",
+        help=(
+            "Delete the logs (and other files) of runs older than this many days from the log directory. "
+            "0 keeps them."
+        ),
+        type=click.FloatRange(min=0),
+        default=lambda: float(os.environ.get("TRD_LOG_KEEP_DAYS", DEFAULT_LOG_KEEP_DAYS)),
+        show_default=str(DEFAULT_LOG_KEEP_DAYS),
+    ),
+    click.option(
+        "--log-format",
+        help="Write the log as text, or as JSON lines for log collectors.",
+        type=click.Choice(LOG_FORMATS),
+        default=lambda: os.environ.get("TRD_LOG_FORMAT", "text"),
+        show_default="text",
+    ),
+]
+
+
+def run_options(fn):
+    """
+    Add the `RUN_OPTIONS` to a command.
+    """
+    for option in reversed(RUN_OPTIONS):
+        fn = option(fn)
+    return fn
+
+
 @cli.command()
-@click.option(
-    "--rc-url",
-    help="The URL to connect to the REDCap API.",
-    type=str,
-    default=lambda: os.environ.get("TRD_REDCAP_URL"),
-)
-@click.option(
-    "--rc-token",
-    help="The secret to connect to the REDCap API.",
-    type=str,
-    default=lambda: os.environ.get("TRD_REDCAP_TOKEN"),
-)
-@click.option(
-    "--tc-archive",
-    help="The True Colours data archive .zip file.",
-    type=click.Path(exists=True, dir_okay=False, readable=True, resolve_path=True),
-    default=lambda: os.environ.get("TRD_TRUE_COLOURS_ARCHIVE"),
-)
-@click.option(
-    "--mailto",
-    help="The email address to send the summary to. If blank, no email will be sent.",
-    type=str,
-    default=lambda: os.environ.get("TRD_MAILTO_ADDRESS"),
-)
-@click.option(
-    "--mg-secret",
-    help="The secret for the Mailgun API.",
-    type=str,
-    default=lambda: os.environ.get("TRD_MAILGUN_SECRET"),
-)
-@click.option(
-    "--mg-domain",
-    help="The domain for the Mailgun API.",
-    type=str,
-    default=lambda: os.environ.get("TRD_MAILGUN_DOMAIN"),
-)
-@click.option(
-    "--mg-username",
-    help="The username for the Mailgun API.",
-    type=str,
-    default=lambda: os.environ.get("TRD_MAILGUN_USERNAME"),
-)
-@click.option(
-    "--dry-run",
-    help="Don't actually upload to REDCap.",
-    is_flag=True,
-    default=False,
-)
-@click.option(
-    "--log-dir",
-    help="The directory to save the log file to.",
-    type=click.Path(file_okay=False, writable=True, resolve_path=True),
-    default=lambda: os.environ.get("TRD_LOG_DIR", "/var/log/trd_cli"),
-    show_default="/var/log/trd_cli",
-)
-@click.option(
-    "--log-level",
-    help="The log level to use.",
-    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]),
-    default=lambda: os.environ.get("TRD_LOG_LEVEL", "INFO"),
-    show_default="INFO",
-)
+@run_options
 @click.help_option()
-def run(
-        rc_url,
-        rc_token,
-        tc_archive,
-        mailto,
-        mg_secret,
-        mg_domain,
-        mg_username,
-        dry_run,
-        log_dir,
-        log_level,
-):
+def run(**options):
     """
     Run the TRD CLI.
 
@@ -114,207 +215,130 @@ def run(
 
     All arguments can be supplied as environment variables.
     """
-    try:
-        # Logfile has the date and time of the run
-        log_file = os.path.join(log_dir, f"trd_cli-{datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')}.log")
-        dictConfig(get_config(log_file))
-        LOGGER.setLevel(log_level)
-
-        click.echo("Running TRD CLI")
-
-        # Verify that all environment variables are set
-        click.echo("Checking configuration", nl=False)
-        required = {
-            "rc_url": rc_url,
-            "rc_token": rc_token,
-            "tc_archive": tc_archive,
-        }
-        if mailto is not None:
-            required = {
-                **required,
-                "mailto": mailto,
-                "mg_secret": mg_secret,
-                "mg_domain": mg_domain,
-                "mg_username": mg_username,
-            }
-        for k, v in required.items():
-            if v is None:
-                raise ValueError(f"Missing required argument: {k}")
-        click.echo(" - OK")
-
-        # Connect to the True Colours scp server and download the zip dump
-        click.echo("Unpacking True Colours archive", nl=False)
-        tc_data = get_true_colours_data(tc_archive)
-        click.echo(" - OK")
-
-        # Download data from the REDCap API
-        click.echo("Downloading data from REDCap", nl=False)
-        redcap_project = Project(rc_url, rc_token)
-        LOGGER.debug(f"Connected to REDCap project {redcap_project}")
-        redcap_records = redcap_project.export_records(
-            fields=[
-                "study_id",
-                "id",
-                "updated",
-                "info_updated_datetime",
-                *[f"{n}_response_id" for n in [q["code"] for q in QUESTIONNAIRES]],
-            ]
-        )
-        LOGGER.debug(f"Downloaded {len(redcap_records)} records from REDCap.")
-        if len(redcap_records) > 0:
-            LOGGER.debug(f"First record: {redcap_records[0]}")
-        redcap_data = extract_redcap_ids(redcap_records)
-        LOGGER.debug(f"Extracted REDCap records:\n {json.dumps(redcap_data, indent=4)}")
-        click.echo(" - OK")
-
-        # Compare the True Colours data to the REDCap data
-        click.echo("Comparing True Colours data to REDCap data", nl=False)
-
-        new_participants, new_responses = compare_tc_to_rc(
-            tc_data=tc_data, redcap_id_data=redcap_data
-        )
-        LOGGER.debug(f"New participants:\n {json.dumps(new_participants, indent=4)}")
-        LOGGER.debug(f"New responses:\n {len(new_responses)}")
-        failed_pids = []
-        unique_ids = set()
-
-        id_map = {}
-        if len(new_participants) > 0:
-            LOGGER.info(
-                f"Generating record names for {len(new_participants)} new participants: {', '.join(new_participants)}."
-            )
-            record_names_start_at = int(redcap_project.generate_next_record_name())
-            for i, p_id in enumerate(new_participants):
-                try:
-                    new_id = record_names_start_at + i
-                    id_map[p_id] = new_id
-                except Exception as e:
-                    LOGGER.exception(e)
-            LOGGER.debug(f"id_map: {json.dumps(id_map, indent=4)}")
-
-        if len(new_responses) > 0:
-            patched_responses = []
-            for r in new_responses:
-                if isinstance(r["study_id"], str) and r["study_id"].startswith("__NEW__"):
-                    p_id = r["study_id"][7:]
-                    if p_id not in id_map:
-                        LOGGER.error(f"{p_id} not in id_map for response {json.dumps(r)}")
-                    else:
-                        r["study_id"] = id_map[p_id]
-                patched_responses.append(r)
-            # Sort patched_responses by study_id so we obey REDCap's sequential ordering in the request
-            patched_responses = sorted(patched_responses, key=lambda x: x["study_id"])
-            LOGGER.debug(f"New responses:\n {json.dumps(patched_responses, indent=4)}")
-            unique_ids = set([x["study_id"] for x in patched_responses])
-            if not dry_run:
-                rc_response_r = redcap_project.import_records(patched_responses, return_content="ids")
-                if len(rc_response_r) != len(unique_ids):
-                    failed_pids = list(unique_ids - set(rc_response_r))
-                    LOGGER.error(
-                        (
-                            f"Failed to import new questionnaire responses. "
-                            f"Failed for {len(failed_pids)}, succeeded for {len(rc_response_r)}."
-                        )
-                    )
-                    LOGGER.error(f"Failed study_ids: {json.dumps(failed_pids, indent=4)}")
-                else:
-                    pid_qid_map = {
-                        study_id: [
-                            (
-                                f"TC id: {get_response_id_from_response_data(x)} -> "
-                                f"{x.get('redcap_repeat_instrument', 'consent')}"
-                            ) for x in patched_responses if x["study_id"] == study_id
-                        ] for study_id in unique_ids
-                    }
-                    LOGGER.info(
-                        (
-                            f"Added {len(new_responses)} new questionnaire "
-                            f"responses for {len(unique_ids)} participants: "
-                            f"{json.dumps(pid_qid_map, indent=4)}."
-                        )
-                    )
-
-        click.echo(" - OK")
-        click.echo(
-            f"\t{len(new_responses)} new responses for {len(unique_ids)} participants ({len(new_participants)} new)."
-        )
-        if len(failed_pids) > 0:
-            click.echo(f"\tImport failed for {len(failed_pids)} participants: {failed_pids}.", err=True)
-
-        # Scan logs and count errors and warnings
-        with open(log_file, "r") as f:
-            log_data = f.read()
-        error_count = log_data.count("ERROR")
-        warning_count = log_data.count("WARNING")
-        log_content = log_data.replace("\n", "<br />")
+    from trd_cli.sync import sync
+    metrics = sync(**options)
+    if metrics.error is not None:
+        exit(1)
 
-        # Send email summary
-        if mailto is not None:
-            click.echo("Sending email summary", nl=False)
 
-            if (
-                    len(new_responses) == 0
-                    and error_count == 0
-                    and warning_count == 0
-            ):
-                click.echo(" - SKIPPED: No changes detected.")
-                return
+@cli.command()
+@run_options
+@click.option(
+    "--interval",
+    help="Seconds between syncs when the True Colours archive doesn't change.",
+    type=click.FloatRange(min=0),
+    default=lambda: float(os.environ.get("TRD_WATCH_INTERVAL", DEFAULT_INTERVAL_SECONDS)),
+    show_default=str(DEFAULT_INTERVAL_SECONDS),
+)
+@click.option(
+    "--poll-seconds",
+    help="How often to check the True Colours archive for changes where inotify isn't available.",
+    type=click.FloatRange(min=0, min_open=True),
+    default=lambda: float(os.environ.get("TRD_WATCH_POLL_SECONDS", DEFAULT_POLL_SECONDS)),
+    show_default=str(DEFAULT_POLL_SECONDS),
+)
+@click.option(
+    "--settle-seconds",
+    help="How long the True Colours archive must stop changing for before it is synced.",
+    type=click.FloatRange(min=0),
+    default=lambda: float(os.environ.get("TRD_WATCH_SETTLE_SECONDS", DEFAULT_SETTLE_SECONDS)),
+    show_default=str(DEFAULT_SETTLE_SECONDS),
+)
+@click.option(
+    "--health-file",
+    help=f"The JSON file to keep the health of the watch process in. Defaults to {HEALTH_FILE} in the --log-dir.",
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+    default=lambda: os.environ.get("TRD_HEALTH_FILE"),
+)
+@click.option(
+    "--max-cycles",
+    help="Stop after this many syncs.",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.help_option()
+def watch(interval, poll_seconds, settle_seconds, health_file, max_cycles, **options):
+    """
+    Stay running, and sync whenever the True Colours archive changes and every --interval seconds.
 
-            if len(new_participants) == 0 and len(new_responses) == 0:
-                change_list = None
-            else:
-                if len(failed_pids) > 0:
-                    failed_str = (
-                        f"Import failed for {len(failed_pids)} participants: {json.dumps(failed_pids, indent=4)}."
-                    )
+    Takes all the options of `run`, which apply to every sync.
+    The REDCap session and the record ids exported from REDCap are kept between syncs:
+    in the --state-db if one is given, otherwise in memory.
+    Each sync writes its log and metrics to --log-dir as `run` does, and the process's health is kept in
+    --health-file.
+    """
+    from trd_cli.redcap_client import make_session
+    from trd_cli.state import SyncState
+    from trd_cli.sync import sync
+    from trd_cli.watch import WatchHealth, make_watcher, stop_on_sigterm
+
+    if options["tc_archive"] is None:
+        raise click.UsageError("Missing required argument: tc_archive")
+    health = WatchHealth(health_file or os.path.join(options["log_dir"], HEALTH_FILE))
+    session = make_session(pool_size=max(options["import_workers"], 10))
+    state = SyncState(options["state_db"] if options["state_db"] is not None else ":memory:")
+    watcher = make_watcher(options["tc_archive"], poll_seconds)
+    click.echo(f"Watching {options['tc_archive']} with {watcher.__class__.__name__}")
+    try:
+        with stop_on_sigterm():
+            trigger = "start"
+            while True:
+                health.write("syncing")
+                metrics = sync(**options, session=session, state=state)
+                health.record(metrics, trigger)
+                if max_cycles is not None and health.cycles >= max_cycles:
+                    break
+                health.write("idle", next_cycle=time.time() + interval)
+                if watcher.wait(interval):
+                    # Wait for the new archive to finish being written
+                    while watcher.wait(settle_seconds):
+                        pass
+                    trigger = "change"
                 else:
-                    failed_str = ""
-                change_list = f"""
-<h2>Changes</h2>
-    <p>
-        {len(new_responses)} new responses added for {len(unique_ids)} participants ({len(new_participants)} new).
-        {failed_str}
-    </p>
-</h2>
-                """
+                    trigger = "interval"
+    except KeyboardInterrupt:
+        click.echo("Stopping")
+    finally:
+        watcher.close()
+        state.close()
+        session.close()
+        health.write("stopped")
 
-            email_html = f"""
-<html>
-<body>
-<h1>True Colours -> REDCap Data Comparison Summary</h1>
-{change_list if change_list else ""}
-<h2>Log Summary</h2>
-    <details>
-        <summary>Log File ({error_count} Errors, {warning_count} Warnings)</summary>
-        <p>{log_content}</p>
-    </details>
-</h2>
-</body>
-</html>
-        """
 
-            url = f"https://api.mailgun.net/v3/{mg_domain}/messages"
-
-            data = {
-                "from": f"TRD CLI <mailgun@{mg_domain}>",
-                "to": mailto,
-                "subject": f"TRD CLI Summary{' [DRY RUN]' if dry_run else ''}",
-                "html": email_html,
-            }
-
-            headers = {"Content-Type": "multipart/form-data"}
+@cli.command()
+@click.argument(
+    "output",
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+)
+@click.option(
+    "--rc-url",
+    help="The URL to connect to the REDCap API.",
+    type=str,
+    default=lambda: os.environ.get("TRD_REDCAP_URL"),
+)
+@click.option(
+    "--rc-token",
+    help="The secret to connect to the REDCap API.",
+    type=str,
+    default=lambda: os.environ.get("TRD_REDCAP_TOKEN"),
+)
+@click.help_option()
+def snapshot(output, rc_url, rc_token):
+    """
+    Save the REDCap records that `run` compares against to OUTPUT, for `run --rc-snapshot`.
 
-            response = requests.post(
-                url, data=data, headers=headers, auth=(mg_username, mg_secret)
-            )
-            response.raise_for_status()
-            click.echo(" - OK")
+    Only the fields `run` needs are exported. OUTPUT is gzip-compressed if it ends in .gz.
+    """
+    from trd_cli.main_functions import get_redcap_export_fields, write_redcap_snapshot
+    from trd_cli.redcap_client import PooledProject, make_session
 
-    except Exception as e:
-        click.echo(" - ERROR", err=True)
-        LOGGER.exception(e)
-        click.echo(f"{e.__class__.__name__}: {e}", err=True)
-        exit(1)
+    for k, v in {"rc_url": rc_url, "rc_token": rc_token}.items():
+        if v is None:
+            raise click.UsageError(f"Missing required argument: {k}")
+    with make_session() as session:
+        records = PooledProject(rc_url, rc_token, session=session).export_records(fields=get_redcap_export_fields())
+    write_redcap_snapshot(records, output)
+    click.echo(f"Saved {len(records)} REDCap records to {output}")
 
 
 # Allow dumping the REDCap structure to a given file
@@ -331,8 +355,64 @@ def dump(output):
     
     An argument can be supplied to save the output to a file.
     """
+    from trd_cli.questionnaires import dump_redcap_structure
     dump_redcap_structure(output)
 
 
+@cli.command()
+@click.argument(
+    "output",
+    type=click.Path(writable=True, resolve_path=True),
+)
+@click.option(
+    "--patients",
+    help="The number of patients to generate.",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+)
+@click.option(
+    "--responses",
+    help="The number of questionnaire responses to generate.",
+    type=click.IntRange(min=0),
+    default=1000,
+    show_default=True,
+)
+@click.option(
+    "--seed",
+    help="The random seed. The same seed always generates the same data.",
+    type=int,
+    default=0,
+    show_default=True,
+)
+@click.option(
+    "--redcap-export",
+    help="Also write a matching REDCap export (JSON) of a partially synced state to this file.",
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+    default=None,
+)
+@click.option(
+    "--synced",
+    help="The fraction of patients, and of their responses, that are already in the REDCap export.",
+    type=click.FloatRange(min=0, max=1),
+    default=0.5,
+    show_default=True,
+)
+@click.help_option()
+def generate(output, patients, responses, seed, redcap_export, synced):
+    """
+    Generate a synthetic True Colours archive for testing and benchmarking.
+
+    OUTPUT is the .zip archive to write, or an existing directory to write the .csv files into.
+    """
+    from trd_cli.synthetic import generate_archive
+    _, records = generate_archive(
+        output, patients, responses, seed=seed, redcap_export=redcap_export, synced=synced
+    )
+    click.echo(f"Generated {patients} patients and {responses} responses in {output}.")
+    if redcap_export is not None:
+        click.echo(f"Generated {len(records)} REDCap records in {redcap_export}.")
+
+
 if __name__ == "__main__":
     cli()
@@ -1,22 +1,36 @@
-import os
-import subprocess
-from typing import Tuple, List, Optional
-
-from redcap import Project
+import gzip
+import json
+from typing import TYPE_CHECKING, Callable, Dict, List, Set, Tuple, Optional
 
 from trd_cli.conversions import extract_participant_info
 from trd_cli.questionnaires import (
-    QUESTIONNAIRES,
+    REGISTRY,
     questionnaire_to_rc_record,
     get_redcap_structure,
-    get_questionnaire_by_name
 )
-from trd_cli.parse_tc import parse_tc
+from trd_cli.parse_tc import iter_tc_data
+
+if TYPE_CHECKING:
+    # Only for type hints: PyCap (and requests) are slow to import, and only needed once REDCap is connected to
+    from redcap import Project
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
 
+def get_redcap_export_fields() -> List[str]:
+    """
+    Return the REDCap fields needed to tell which participants and responses are already in REDCap.
+    """
+    return [
+        "study_id",
+        "id",
+        "updated",
+        "info_updated_datetime",
+        *REGISTRY.response_id_fields,
+    ]
+
+
 def extract_redcap_ids(records) -> dict:
     """
     Get a list of participants from REDCap.
@@ -25,75 +39,156 @@ def extract_redcap_ids(records) -> dict:
 
     Return a dictionary of `id`: with the `study_id` and the names of each questionnaire containing
     a list of tuples of (`_response_id`, `redcap_repeat_instance`) for all responses for that questionnaire.
+
+    The records are indexed in a single pass, so this scales linearly with the size of the REDCap export.
     """
-    ids = set([r.get("id") for r in records])
+    instruments = [*REGISTRY.codes, "private", "info"]
+    # Non-repeating instruments' data are exported on each record's row without a `redcap_repeat_instrument`
+    non_repeating = [q["code"] for q in REGISTRY.questionnaires if not q.get("repeat_instrument", True)]
     out = {}
-    for record_id in ids:
-        subset = list(filter(lambda x: x["id"] == record_id, records))
-        if not all([s.get("study_id") == subset[0].get("study_id") for s in subset]):
+    # The study_ids seen for each `id`, and the instance each questionnaire `_response_id` was seen with
+    study_ids = {}
+    seen_instances = {}
+    for s in records:
+        record_id = s.get("id")
+        if record_id not in out:
+            out[record_id] = {"study_id": s["study_id"], **{n: [] for n in instruments}}
+            study_ids[record_id] = set()
+            seen_instances[record_id] = {n: {} for n in instruments}
+        study_ids[record_id].add(s.get("study_id"))
+        q_name = s.get("redcap_repeat_instrument")
+        if q_name in [None, ""]:
+            for code in non_repeating:
+                response_id = s.get(f"{code}_response_id")
+                if response_id not in [None, ""] and response_id not in seen_instances[record_id][code]:
+                    seen_instances[record_id][code][response_id] = None
+                    out[record_id][code].append((response_id, None))
+            continue
+        if q_name not in seen_instances[record_id]:
+            LOGGER.warning(
+                f"Unrecognised `redcap_repeat_instrument` value: {q_name}"
+            )
+            continue
+        if q_name == "private":
+            response_id = s.get("updated")
+        elif q_name == "info":
+            response_id = s.get("info_updated_datetime")
+        else:
+            response_id = s.get(f"{q_name}_response_id")
+            seen = seen_instances[record_id][q_name]
+            if response_id in seen:
+                if s.get("redcap_repeat_instance") != seen[response_id]:
+                    LOGGER.warning(
+                        (
+                            f"{q_name}[{response_id}] "
+                            f"has instance {s.get('redcap_repeat_instance')}, "
+                            f"but this id is already associated with instance {seen[response_id]}."
+                        )
+                    )
+                continue
+            seen[response_id] = s.get("redcap_repeat_instance")
+        out[record_id][q_name].append(
+            (response_id, s.get("redcap_repeat_instance"))
+        )
+    for record_id, ids in study_ids.items():
+        if len(ids) > 1:
             LOGGER.warning(
                 (
-                    f"Subset of {record_id} does not have the `study_id` field. Unique ids: "
-                    f"{', '.join(set([s.get('study_id') for s in subset]))}."
+                    f"Records for {record_id} do not share a single `study_id`. Unique ids: "
+                    f"{', '.join([str(i) for i in ids])}."
                 )
             )
-        qr = {
-            **{n: [] for n in [q["code"] for q in QUESTIONNAIRES]},
-            "private": [],
-            "info": []
-        }
-        for s in subset:
-            q_name = s.get("redcap_repeat_instrument")
-            if q_name in qr.keys():
-                if s.get(f"{q_name}_response_id") in list(
-                        map(lambda x: x[0], qr[q_name])
-                ):
-                    if (
-                            s.get("redcap_repeat_instance")
-                            != qr[f"{q_name}_response_id"][1]
-                    ):
-                        LOGGER.warning(
-                            (
-                                f"{q_name}[{s.get(f'{q_name}_response_id')}] "
-                                f"has instance {s.get('redcap_repeat_instance')}, "
-                                f"but this id is already associated with instance {qr[f'{q_name}_response_id'][1]}."
-                            )
-                        )
+    return out
+
+
+def get_true_colours_data(tc_archive: str, skip_row: Optional[Callable[[str, dict], bool]] = None) -> dict:
+    """
+    Open the True Colours data in the export archive.
+
+    Return a dictionary of row iterators for each csv file (actually pipe-separated) in the archive.
+    The rows are streamed from the archive as they are consumed (e.g. by `compare_tc_to_rc`),
+    so the whole archive is never held in memory at once.
+    Rows for which `skip_row(file, row)` returns True are dropped before they are parsed.
+    """
+    return iter_tc_data(tc_archive, skip_row=skip_row)
+
+
+def _open_snapshot(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_redcap_snapshot(records: List[dict], path: str):
+    """
+    Save a REDCap export (`records`) to `path` as JSON, gzip-compressed if `path` ends in .gz.
+    """
+    with _open_snapshot(path, "w") as f:
+        json.dump(records, f, separators=(",", ":"))
+
+
+def read_redcap_snapshot(path: str) -> List[dict]:
+    """
+    Read a REDCap export saved by `write_redcap_snapshot` (or any JSON list of records, like a REDCap JSON export).
+    """
+    with _open_snapshot(path, "r") as f:
+        records = json.load(f)
+    if not isinstance(records, list):
+        raise ValueError(f"REDCap snapshot {path} is not a list of records.")
+    return records
+
+
+def next_study_id(redcap_id_data: dict) -> int:
+    """
+    Return the study_id after the highest numeric one in `redcap_id_data` (from `extract_redcap_ids`),
+    as REDCap's generateNextRecordName would for a project with auto-numbered records.
+    """
+    study_ids = [int(p["study_id"]) for p in redcap_id_data.values() if str(p["study_id"]).isdigit()]
+    return max(study_ids, default=0) + 1
+
+
+class InstanceAllocator:
+    """
+    Track the responses REDCap holds for each participant and allocate `redcap_repeat_instance` numbers.
+
+    Built from the output of `extract_redcap_ids`.
+    Allocating a response records it, so a later response for the same participant and instrument is
+    recognised as already handled and new responses get consecutive instances.
+    """
+    def __init__(self, redcap_id_data: dict):
+        self._response_ids: Dict[Tuple[str, str], Set[str]] = {}
+        self._max_instance: Dict[Tuple[str, str], int] = {}
+        for p_id, p_data in redcap_id_data.items():
+            for instrument, responses in p_data.items():
+                if instrument == "study_id":
                     continue
-                if q_name == "private":
-                    response_id = s.get("updated")
-                elif q_name == "info":
-                    response_id = s.get("info_updated_datetime")
-                else:
-                    response_id = s.get(f"{q_name}_response_id")
-                qr[q_name].append(
-                    (response_id, s.get("redcap_repeat_instance"))
-                )
-            else:
-                LOGGER.warning(
-                    f"Unrecognised `redcap_repeat_instrument` value: {q_name}"
+                self._response_ids[(p_id, instrument)] = {r[0] for r in responses}
+                self._max_instance[(p_id, instrument)] = max(
+                    [int(r[1]) for r in responses if r[1] not in [None, ""]], default=0
                 )
-        out[record_id] = {"study_id": subset[0]["study_id"], **qr}
-    return out
 
+    def is_known(self, p_id: str, instrument: str, response_id: str) -> bool:
+        """
+        Return whether `response_id` is already recorded for participant `p_id`'s `instrument`.
+        """
+        return response_id in self._response_ids.get((p_id, instrument), ())
 
-def get_true_colours_data(tc_dir: str) -> dict:
-    tmp_dir = ".run"
-    os.makedirs(tmp_dir, exist_ok=True)
-    # unzip the archive
-    subprocess.run(["unzip", "-o", tc_dir, "-d", tmp_dir], check=True)
-    # We now have a directory of csv files (actually pipe-separated) we can load as a dict
-    tc_data = parse_tc(tmp_dir)
-    # Clean up
-    subprocess.run(["rm", "-rf", tmp_dir], check=True)
-    return tc_data
+    def allocate(self, p_id: str, instrument: str, response_id: str) -> int:
+        """
+        Record `response_id` for participant `p_id`'s `instrument` and return the instance number it should use.
+        """
+        key = (p_id, instrument)
+        self._response_ids.setdefault(key, set()).add(response_id)
+        self._max_instance[key] = self._max_instance.get(key, 0) + 1
+        return self._max_instance[key]
 
 
-def compare_tc_to_rc(tc_data: dict, redcap_id_data: List[dict]) -> Tuple[list, list]:
+def compare_tc_to_rc(tc_data: dict, redcap_id_data: dict) -> Tuple[list, list]:
     """
     Compare the True Colours data to the REDCap data.
     
-    :param tc_data: parsed data exported from True Colours
+    :param tc_data: parsed data exported from True Colours. Each file's rows may be a list or an iterator
+        (e.g. from `get_true_colours_data`); they are only iterated once.
     :param redcap_id_data: parsed data exported from REDCap
     :return: a tuple of new_participants, new_responses
         new_participants is a list of participant_ids whose private and info data needs to be uploaded to REDCap.
@@ -104,30 +199,32 @@ def compare_tc_to_rc(tc_data: dict, redcap_id_data: List[dict]) -> Tuple[list, l
     """
     new_participants = []
     new_responses = []
+    instances = InstanceAllocator(redcap_id_data)
 
     # First, search for patients who don't have REDCap entries
     for p in tc_data["patient.csv"]:
-        is_new = False
         p_id = p.get("id")
-        if p_id not in redcap_id_data:
+        updated = p.get("updated")
+        is_new = p_id not in redcap_id_data
+        if is_new:
             new_participants.append(p_id)
-            is_new = True
-        if is_new or p.get("updated") != redcap_id_data[p_id]["private"][-1][0]:
+        if is_new or not instances.is_known(p_id, "private", updated):
+            study_id = f"__NEW__{p_id}" if is_new else redcap_id_data[p_id]["study_id"]
             # Generate REDCap info
             private, public = extract_participant_info(p)
             new_responses.append(
                 {
-                    "study_id": f"__NEW__{p_id}" if is_new else redcap_id_data[p_id]["study_id"],
+                    "study_id": study_id,
                     **private,
                     "redcap_repeat_instrument": "private",
-                    "redcap_repeat_instance": 1 if is_new else len(redcap_id_data[p.get("id")]["private"]) + 1,
+                    "redcap_repeat_instance": instances.allocate(p_id, "private", updated),
                 })
             new_responses.append(
                 {
-                    "study_id": f"__NEW__{p_id}" if is_new else redcap_id_data[p_id]["study_id"],
+                    "study_id": study_id,
                     **public,
                     "redcap_repeat_instrument": "info",
-                    "redcap_repeat_instance": 1 if is_new else len(redcap_id_data[p.get("id")]["info"]) + 1,
+                    "redcap_repeat_instance": instances.allocate(p_id, "info", updated),
                 }
             )
 
@@ -143,7 +240,7 @@ def compare_tc_to_rc(tc_data: dict, redcap_id_data: List[dict]) -> Tuple[list, l
             continue
         q_name = interop.get("title")
         version = qr.get('version')
-        questionnaire = get_questionnaire_by_name(q_name, version)
+        questionnaire = REGISTRY.get_by_title(q_name, version)
         if questionnaire is None:
             LOGGER.warning(
                 f"Questionnaire response id={q_id} has unrecognised title {q_name}."
@@ -151,14 +248,8 @@ def compare_tc_to_rc(tc_data: dict, redcap_id_data: List[dict]) -> Tuple[list, l
             continue
         q_code = questionnaire.get("code")
         q_repeats = questionnaire.get("repeat_instrument", True)
-        is_new = p_id not in redcap_id_data or q_id not in [
-            x[0] for x in redcap_id_data[p_id][q_code]
-        ]
-        if is_new:
-            if p_id not in redcap_id_data or len(redcap_id_data[p_id].get(q_code, list())) == 0:
-                instance_number = 1
-            else:
-                instance_number = max([x[1] for x in redcap_id_data[p_id][q_code]]) + 1
+        if not instances.is_known(p_id, q_code, q_id):
+            instance_number = instances.allocate(p_id, q_code, q_id)
             new_responses.append(
                 {
                     "study_id": redcap_id_data[p_id]["study_id"] if p_id in redcap_id_data else f"__NEW__{p_id}",
@@ -169,13 +260,13 @@ def compare_tc_to_rc(tc_data: dict, redcap_id_data: List[dict]) -> Tuple[list, l
                             "redcap_repeat_instance": instance_number
                         } if q_repeats else {}
                     ),
-                    **questionnaire_to_rc_record(qr),
+                    **questionnaire_to_rc_record(qr, questionnaire),
                 }
             )
     return new_participants, new_responses
 
 
-def is_redcap_structure_valid(redcap_project: Project, raise_error: bool = False) -> Optional[bool]:
+def is_redcap_structure_valid(redcap_project: "Project", raise_error: bool = False) -> Optional[bool]:
     """
     Check if the REDCap structure is valid. 
     This can only check if all the required fields are present, not that they belong to the appropriate instruments.
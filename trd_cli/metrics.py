@@ -0,0 +1,233 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import requests
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Prefix for the Prometheus metric names
+PROMETHEUS_PREFIX = "trd_cli"
+# The file the Prometheus node_exporter textfile collector reads; it's replaced by each run
+PROMETHEUS_FILE = "trd_cli.prom"
+
+_CONTENT_RE = re.compile(r"(?:^|&)content=(\w+)")
+
+
+class StageMetrics:
+    """
+    Timings and row counts for a single stage of a `trd-cli run`.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rows: Optional[int] = None
+
+    @property
+    def rows_per_second(self) -> Optional[float]:
+        if self.rows is None or self.wall <= 0:
+            return None
+        return self.rows / self.wall
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "rows": self.rows,
+            "rows_per_second": self.rows_per_second,
+        }
+
+
+class RequestMetrics:
+    """
+    Counts, payload sizes and latencies of the requests made to the REDCap API, by API `content` type.
+    """
+    def __init__(self, content: str):
+        self.content = content
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency_seconds": self.latency,
+            "max_latency_seconds": self.max_latency,
+        }
+
+
+class CountingIterator:
+    """
+    Pass through the items of `iterable`, counting them in `count`.
+
+    If a `stage` is given, the time spent getting each item (e.g. reading it from the archive) is added to it,
+    and the items are counted in its `rows`, however long after the stage itself it is iterated.
+    """
+    def __init__(self, iterable: Iterable, stage: Optional[StageMetrics] = None):
+        self._iterator = iter(iterable)
+        self.stage = stage
+        self.count = 0
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        if self.stage is None:
+            item = next(self._iterator)
+        else:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(self._iterator)
+            finally:
+                self.stage.wall += time.perf_counter() - wall
+                self.stage.cpu += time.process_time() - cpu
+            self.stage.rows = (self.stage.rows or 0) + 1
+        self.count += 1
+        return item
+
+
+class RunMetrics:
+    """
+    Instrumentation for a `trd-cli run`: per-stage wall and CPU time, rows and throughput, and REDCap API traffic.
+
+    Time stages with `with metrics.stage("name") as stage:` (setting `stage.rows` if it processes rows),
+    and record REDCap requests by passing the session to `instrument_session`.
+    If a `profiler` (see `trd_cli.profiling`) is given, it is told when each stage starts and ends.
+    """
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.started = time.time()
+        self.success: Optional[bool] = None
+        # The exception that stopped the run, if one did
+        self.error: Optional[BaseException] = None
+        self.stages: Dict[str, StageMetrics] = {}
+        self.requests: Dict[str, RequestMetrics] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, thread_cpu: bool = False) -> Iterator[StageMetrics]:
+        """
+        Time the stage `name` for the duration of the `with` block.
+
+        The CPU time is the whole process's, unless `thread_cpu` is set, when it is only the current thread's.
+        Stages that run alongside each other in different threads need that so they don't count each other's.
+        """
+        stage = self.stages.setdefault(name, StageMetrics(name))
+        if self.profiler is not None:
+            self.profiler.start_stage(name)
+        cpu_time = time.thread_time if thread_cpu else time.process_time
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield stage
+        finally:
+            stage.wall += time.perf_counter() - wall
+            stage.cpu += cpu_time() - cpu
+            if self.profiler is not None:
+                self.profiler.end_stage(name)
+            LOGGER.debug(
+                f"Stage {name}: {stage.wall:.3f}s wall, {stage.cpu:.3f}s CPU"
+                f"{f', {stage.rows} rows' if stage.rows is not None else ''}."
+            )
+
+    def record_response(self, response: requests.Response, *_args, **_kwargs):
+        """
+        Record a REDCap API `response`. This is a `requests` response hook (see `instrument_session`).
+        """
+        body = response.request.body or ""
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", errors="replace")
+        match = _CONTENT_RE.search(body)
+        content = match.group(1) if match else "unknown"
+        latency = response.elapsed.total_seconds()
+        with self._lock:
+            r = self.requests.setdefault(content, RequestMetrics(content))
+            r.count += 1
+            r.errors += 0 if response.ok else 1
+            r.bytes_sent += len(body.encode("utf-8"))
+            r.bytes_received += len(response.content)
+            r.latency += latency
+            r.max_latency = max(r.max_latency, latency)
+
+    def instrument_session(self, session: requests.Session) -> requests.Session:
+        """
+        Record every request made through `session`.
+        """
+        session.hooks["response"].append(self.record_response)
+        return session
+
+    def release_session(self, session: requests.Session):
+        """
+        Stop recording the requests made through `session`, e.g. when it is kept open for the next run.
+        """
+        if self.record_response in session.hooks["response"]:
+            session.hooks["response"].remove(self.record_response)
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started,
+            "success": self.success,
+            "error": f"{self.error.__class__.__name__}: {self.error}" if self.error is not None else None,
+            "stages": {k: v.to_dict() for k, v in self.stages.items()},
+            "redcap_requests": {k: v.to_dict() for k, v in self.requests.items()},
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Return the metrics in the Prometheus text exposition format, for the node_exporter textfile collector.
+        """
+        lines = []
+
+        def metric(name: str, description: str, samples: List[tuple]):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                suffix = f"{{{label_str}}}" if label_str else ""
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{suffix} {value}")
+
+        metric("last_run_timestamp_seconds", "When the last run started.", [({}, self.started)])
+        metric("last_run_success", "Whether the last run succeeded.", [({}, int(bool(self.success)))])
+        for name, attribute, description in [
+            ("stage_wall_seconds", "wall", "Wall time of each stage."),
+            ("stage_cpu_seconds", "cpu", "CPU time of each stage."),
+            ("stage_rows", "rows", "Rows processed by each stage."),
+            ("stage_rows_per_second", "rows_per_second", "Throughput of each stage."),
+        ]:
+            metric(name, description, [({"stage": s.name}, getattr(s, attribute)) for s in self.stages.values()])
+        for name, attribute, description in [
+            ("redcap_requests", "count", "REDCap API requests."),
+            ("redcap_request_errors", "errors", "REDCap API requests that returned an error status."),
+            ("redcap_request_bytes", "bytes_sent", "Bytes sent to the REDCap API."),
+            ("redcap_response_bytes", "bytes_received", "Bytes received from the REDCap API."),
+            ("redcap_latency_seconds", "latency", "Total latency of REDCap API requests."),
+            ("redcap_max_latency_seconds", "max_latency", "Longest REDCap API request."),
+        ]:
+            metric(name, description, [({"content": r.content}, getattr(r, attribute)) for r in self.requests.values()])
+        return "\n".join(lines) + "\n"
+
+    def write(self, log_dir: str, json_file: str) -> None:
+        """
+        Write the metrics as JSON to `json_file` and in Prometheus format to `PROMETHEUS_FILE`, both in `log_dir`.
+
+        The Prometheus file is replaced atomically so the collector never reads a partial file.
+        """
+        with open(os.path.join(log_dir, json_file), "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        prom_file = os.path.join(log_dir, PROMETHEUS_FILE)
+        with open(f"{prom_file}.tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(f"{prom_file}.tmp", prom_file)
@@ -1,38 +1,232 @@
 import csv
+import io
 import json
 import os
 import logging
+import zipfile
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, TextIO
 
 LOGGER = logging.getLogger(__name__)
 
 
+# The questionnaire response fields that contain JSON
+JSON_FIELDS = ["responses", "scores", "interoperability"]
+
+
+def decode_json_field(key: str, value: str, i: int = 0):
+    """
+    Return the json-parsed `value` of questionnaire response field `key`.
+
+    Empty fields are None, and fields that aren't valid JSON are logged and returned unchanged.
+    `i` is the row number, used to locate any parsing problems in the logs.
+    """
+    if value == "":
+        return None
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError as e:
+        LOGGER.warning(f"L{i}:{key} - {e}{' | ' + value if value else '[Empty]'}")
+        return value
+
+
+class LazyResponseRow(dict):
+    """
+    A questionnaire response row whose JSON fields are only parsed when they are first accessed.
+
+    The parsed value replaces the raw string in the row, so each field is decoded at most once.
+    Anything that needs the whole row (e.g. `items()`, comparison, copying, pickling) decodes all the fields.
+    """
+    def __init__(self, row: dict, i: int = 0):
+        super().__init__(row)
+        self._line = i
+        self._pending = {k for k in JSON_FIELDS if k in row}
+
+    def _decode(self, key):
+        if key in self._pending:
+            self._pending.discard(key)
+            super().__setitem__(key, decode_json_field(key, super().__getitem__(key), self._line))
+
+    def _decode_all(self):
+        for key in list(self._pending):
+            self._decode(key)
+
+    def __getitem__(self, key):
+        self._decode(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._pending.discard(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._pending.discard(key)
+        super().__delitem__(key)
+
+    def __iter__(self):
+        # Overriding __iter__ stops dict() and {**row} from copying the raw values directly
+        return super().__iter__()
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, LazyResponseRow):
+            other._decode_all()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._decode_all()
+        return super().__repr__()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        self._decode(key)
+        self._pending.discard(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        if len(self) == 0:
+            raise KeyError("popitem(): dictionary is empty")
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __or__(self, other):
+        return {**self.copy(), **other}
+
+    def clear(self):
+        self._pending.clear()
+        super().clear()
+
+    def items(self):
+        self._decode_all()
+        return super().items()
+
+    def values(self):
+        self._decode_all()
+        return super().values()
+
+    def copy(self) -> dict:
+        self._decode_all()
+        return dict(super().items())
+
+    def __reduce__(self):
+        # Pickle (and copy.copy) as a plain dict of the decoded values
+        return dict, (self.copy(),)
+
+
+def parse_response_row(row: dict, i: int = 0) -> dict:
+    """
+    Return a single questionnaire response `row` with the response fields json-parsed.
+
+    `i` is the row number, used to locate any parsing problems in the logs.
+    """
+    for k, v in row.items():
+        if k in JSON_FIELDS:
+            row[k] = decode_json_field(k, v, i)
+    return row
+
+
 def parse_responses(questionnaire_response_data: list) -> list:
     """
     Return `questionnaire_response_data` with the response fields json-parsed.
     """
     for i, row in enumerate(questionnaire_response_data):
-        for k, v in row.items():
-            if k in ["responses", "scores", "interoperability"]:
-                if v == "":
-                    row[k] = None
-                    continue
-                try:
-                    row[k] = json.loads(v)
-                except json.JSONDecodeError as e:
-                    LOGGER.warning(f"L{i}:{k} - {e}{' | ' + v if v else '[Empty]'}")
+        parse_response_row(row, i)
     return questionnaire_response_data
 
 
-def parse_tc(tc_dir: str) -> dict:
+def list_tc_files(tc_source: str) -> List[str]:
+    """
+    List the .csv files available in a True Colours export archive or directory.
     """
-    Return a dictionary of parsed .csv files in a True Colours export directory.
+    if os.path.isdir(tc_source):
+        return [f for f in os.listdir(tc_source) if f.endswith(".csv")]
+    with zipfile.ZipFile(tc_source) as archive:
+        return [
+            os.path.basename(m.filename) for m in archive.infolist()
+            if not m.is_dir() and m.filename.endswith(".csv")
+        ]
+
+
+@contextmanager
+def open_tc_file(tc_source: str, file: str) -> Iterator[TextIO]:
     """
-    tc_data = {}
-    files = os.listdir(tc_dir)
-    for file in list(filter(lambda x: x.endswith(".csv"), files)):
-        with open(os.path.join(tc_dir, file), "r") as f:
-            data = list(csv.DictReader(f, delimiter="|"))
+    Open a single .csv `file` from a True Colours export archive or directory for reading.
+
+    Archive members are streamed straight out of the .zip, so nothing is written to disk.
+    """
+    if os.path.isdir(tc_source):
+        with open(os.path.join(tc_source, file), "r", newline="") as f:
+            yield f
+        return
+    with zipfile.ZipFile(tc_source) as archive:
+        member = next(
+            (m for m in archive.infolist() if not m.is_dir() and os.path.basename(m.filename) == file),
+            None
+        )
+        if member is None:
+            raise FileNotFoundError(f"No {file} in True Colours archive {tc_source}")
+        with archive.open(member) as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                yield f
+
+
+def iter_tc_rows(
+        tc_source: str,
+        file: str,
+        skip_row: Optional[Callable[[str, dict], bool]] = None,
+) -> Iterator[dict]:
+    """
+    Yield the parsed rows of a single (pipe-separated) True Colours .csv `file` one at a time.
+
+    Questionnaire responses are yielded as `LazyResponseRow`s, so their response fields are only
+    json-parsed if they are used.
+    If `skip_row(file, row)` is given, rows for which it returns True are dropped before any parsing,
+    while they are still the raw strings from the .csv.
+    """
+    with open_tc_file(tc_source, file) as f:
+        for i, row in enumerate(csv.DictReader(f, delimiter="|")):
+            if skip_row is not None and skip_row(file, row):
+                continue
             if file == "questionnaireresponse.csv":
-                data = parse_responses(data)
-            tc_data[os.path.basename(file)] = data
-    return tc_data
+                row = LazyResponseRow(row, i)
+            yield row
+
+
+def iter_tc_data(
+        tc_source: str,
+        skip_row: Optional[Callable[[str, dict], bool]] = None,
+) -> Dict[str, Iterator[dict]]:
+    """
+    Return a dictionary of row iterators for the .csv files in a True Colours export.
+
+    Nothing is read until the iterators are consumed, and each can only be consumed once.
+    `skip_row` filters out raw rows (see `iter_tc_rows`).
+    """
+    return {file: iter_tc_rows(tc_source, file, skip_row=skip_row) for file in list_tc_files(tc_source)}
+
+
+def parse_tc(tc_source: str) -> dict:
+    """
+    Return a dictionary of parsed .csv files in a True Colours export.
+
+    `tc_source` may be either the export .zip archive or a directory it has been extracted to.
+    """
+    return {file: list(rows) for file, rows in iter_tc_data(tc_source).items()}
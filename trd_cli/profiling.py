@@ -0,0 +1,111 @@
+import cProfile
+import json
+import os
+import sys
+import tracemalloc
+from typing import Dict, List, Optional
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# The number of allocation sites to report for each stage
+DEFAULT_TOP_N = 25
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None where that isn't available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageAllocations:
+    """
+    The memory allocated during a single stage, from tracemalloc snapshots taken at its start and end.
+    """
+    def __init__(self, name: str, peak: int, top: List[tracemalloc.StatisticDiff]):
+        self.name = name
+        self.peak = peak
+        self.top = top
+
+    def report(self) -> str:
+        lines = [f"###### {self.name} (peak traced memory {self.peak / 1024 / 1024:.1f} MiB) ######"]
+        for stat in self.top:
+            lines.append(str(stat))
+        lines.append("")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    Profile a `trd-cli run` with cProfile and tracemalloc, writing the results to `directory`.
+
+    `RunMetrics` calls `start_stage` and `end_stage` around each stage so allocations can be reported per stage.
+    Writes `<run_name>.pstats` (load with `pstats` or e.g. snakeviz), `<run_name>.allocations.txt` with the top
+    `top_n` allocation sites of each stage, and `<run_name>.profile.json` with the peak RSS and per-stage peaks.
+
+    Only the main thread is profiled by cProfile, so concurrent import workers show up as waiting on them.
+    """
+    def __init__(self, directory: str, run_name: str, top_n: int = DEFAULT_TOP_N):
+        self.directory = directory
+        self.run_name = run_name
+        self.top_n = top_n
+        self.stages: List[StageAllocations] = []
+        self._profile = cProfile.Profile()
+        self._snapshots: Dict[str, tracemalloc.Snapshot] = {}
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start()
+        self._profile.enable()
+
+    def start_stage(self, name: str):
+        tracemalloc.reset_peak()
+        self._snapshots[name] = tracemalloc.take_snapshot()
+
+    def end_stage(self, name: str):
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        start = self._snapshots.pop(name, None)
+        if start is None:
+            return
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        top = snapshot.filter_traces(filters).compare_to(start.filter_traces(filters), "lineno")[:self.top_n]
+        self.stages.append(StageAllocations(name, peak, top))
+
+    def stop(self) -> Dict[str, str]:
+        """
+        Stop profiling and write the results. Return the files written.
+        """
+        self._profile.disable()
+        # The peak is reset for each stage, so the overall peak is the highest of them
+        peak = max([tracemalloc.get_traced_memory()[1], *[s.peak for s in self.stages]])
+        tracemalloc.stop()
+
+        files = {
+            "pstats": os.path.join(self.directory, f"{self.run_name}.pstats"),
+            "allocations": os.path.join(self.directory, f"{self.run_name}.allocations.txt"),
+            "summary": os.path.join(self.directory, f"{self.run_name}.profile.json"),
+        }
+        self._profile.dump_stats(files["pstats"])
+        with open(files["allocations"], "w") as f:
+            f.write("\n".join(s.report() for s in self.stages))
+        with open(files["summary"], "w") as f:
+            json.dump(
+                {
+                    "peak_rss_bytes": peak_rss_bytes(),
+                    "peak_traced_bytes": peak,
+                    "stages": {s.name: {"peak_traced_bytes": s.peak} for s in self.stages},
+                    "files": files,
+                },
+                f,
+                indent=4,
+            )
+        LOGGER.info(f"Wrote profile to {self.directory}.")
+        return files
@@ -1,7 +1,7 @@
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Tuple, Union
 
 from trd_cli.conversions import QuestionnaireMetadata, convert_scores, convert_display_values, convert_consent, \
-    RCRecordMetadata, extract_participant_info
+    RCRecordMetadata, extract_participant_info, ConversionPlan
 
 # List of questionnaires with their metadata corresponding to True Colours questionnaires.
 # Each questionnaire has a name, code, list of items, and a list of scores, 
@@ -306,23 +306,37 @@ def to_rc_record(metadata: RCRecordMetadata, data: dict):
     return {**metadata, **data}
 
 
-def questionnaire_to_rc_record(questionnaire_response: dict) -> dict:
-    """
-    Convert a questionnaire response to a REDCap record.
-    """
+def _find_questionnaire(questionnaire_response: dict) -> QuestionnaireMetadata:
     q_name = questionnaire_response["interoperability"]["title"]
-    q = list(filter(lambda x: x["name"] == q_name, QUESTIONNAIRES))
-    if len(q) == 0:
+    q = REGISTRY.get_by_title(q_name, questionnaire_response.get("version"))
+    if q is None:
         # This should never happen because questionnaire_response will already have been vetted
         raise ValueError(f"Unrecognised questionnaire name {q_name}")
-    else:
-        q = q[0]
-    return q["conversion_fn"](q, questionnaire_response)
+    return q
 
 
-def get_redcap_structure() -> Dict[str, List[str]]:
+def _plan_for(q: QuestionnaireMetadata) -> ConversionPlan:
+    plan = REGISTRY.get_plan(q["code"])
+    # Questionnaires that aren't in the registry (e.g. in tests) get a plan of their own
+    return plan if plan is not None and plan.questionnaire is q else ConversionPlan(q)
+
+
+def questionnaire_to_rc_record(
+        questionnaire_response: dict,
+        questionnaire: Optional[QuestionnaireMetadata] = None,
+) -> dict:
     """
-    Map the required REDCap structure to a dict of {"instrument": [fields]}.
+    Convert a questionnaire response to a REDCap record.
+
+    `questionnaire` is the response's questionnaire if it has already been looked up (by title and version).
+    """
+    q = questionnaire if questionnaire is not None else _find_questionnaire(questionnaire_response)
+    return _plan_for(q).convert(questionnaire_response)
+
+
+def build_redcap_structure(questionnaires: List[QuestionnaireMetadata]) -> Dict[str, List[str]]:
+    """
+    Map the REDCap structure required by `questionnaires` to a dict of {"instrument": [fields]}.
     """
     dump = {}
     # The participant data is a special case because it's not a questionnaire
@@ -338,10 +352,11 @@ def get_redcap_structure() -> Dict[str, List[str]]:
         "deceasedboolean": "",
         "deceaseddatetime": "",
         "gender": "",
+        "updated": "",
     }
     dump["private"], dump["info"] = extract_participant_info(dummy_participant)
 
-    consent_q = list(filter(lambda x: x["code"] == "consent", QUESTIONNAIRES))[0]
+    consent_q = list(filter(lambda x: x["code"] == "consent", questionnaires))[0]
     consent_data = {
         "id": "1234567890",
         "submitted": "YYYY-MM-DD HH:MM:SS.sss",
@@ -359,7 +374,7 @@ def get_redcap_structure() -> Dict[str, List[str]]:
     consent_data["scores"]["QuestionScores"][-1]["QuestionNumber"] += 1
     dump["consent"] = convert_consent(consent_q, consent_data)
 
-    for q in QUESTIONNAIRES:
+    for q in questionnaires:
         # Special case for 'consent' questionnaire where Q17 is a non-exported signature.
         # Questionnaires private, info handled above
         if q["code"] in ["private", "info", "consent"]:
@@ -389,6 +404,13 @@ def get_redcap_structure() -> Dict[str, List[str]]:
     return dump
 
 
+def get_redcap_structure() -> Dict[str, List[str]]:
+    """
+    Map the required REDCap structure to a dict of {"instrument": [fields]}.
+    """
+    return {k: list(v) for k, v in REGISTRY.structure.items()}
+
+
 def dump_redcap_structure(filename: Union[str, None]):
     """
     Dump the REDCap structure to a file.
@@ -411,11 +433,54 @@ def dump_redcap_structure(filename: Union[str, None]):
 
 
 def get_questionnaire_by_name(name: str, version: Union[int, None]) -> Union[QuestionnaireMetadata, None]:
-    if version == '1':
-        version = None
-    qs = [q for q in QUESTIONNAIRES if q["name"] == name]
-    if version is not None:
-        qs = [q for q in qs if f"_v{version}" in q.get("code")]
-    if len(qs) == 0:
-        return None
-    return qs[0]
+    return REGISTRY.get_by_title(name, version)
+
+
+class QuestionnaireRegistry:
+    """
+    Index of questionnaires by True Colours title (and version) and by REDCap code.
+
+    The registry also holds the REDCap field names and `ConversionPlan` for each instrument,
+    so they are only worked out once.
+    """
+    def __init__(self, questionnaires: List[QuestionnaireMetadata]):
+        self.questionnaires = questionnaires
+        self.codes: List[str] = [q["code"] for q in questionnaires]
+        self.response_id_fields: List[str] = [f"{c}_response_id" for c in self.codes]
+        self.structure: Dict[str, List[str]] = build_redcap_structure(questionnaires)
+        self._by_code: Dict[str, QuestionnaireMetadata] = {}
+        self._plans: Dict[str, ConversionPlan] = {}
+        self._by_name: Dict[str, List[QuestionnaireMetadata]] = {}
+        self._by_title: Dict[Tuple[str, Union[str, None]], QuestionnaireMetadata] = {}
+        for q in questionnaires:
+            self._by_code.setdefault(q["code"], q)
+            self._plans.setdefault(q["code"], ConversionPlan(q))
+            self._by_name.setdefault(q["name"], []).append(q)
+            self._by_title.setdefault((q["name"], None), q)
+
+    def get_by_code(self, code: str) -> Union[QuestionnaireMetadata, None]:
+        return self._by_code.get(code)
+
+    def get_plan(self, code: str) -> Union[ConversionPlan, None]:
+        return self._plans.get(code)
+
+    def get_by_title(self, name: str, version: Union[str, None] = None) -> Union[QuestionnaireMetadata, None]:
+        """
+        Return the questionnaire with True Colours title `name`.
+
+        If a `version` other than '1' is given, the questionnaire's code must contain `_v{version}`.
+        """
+        if version == '1':
+            version = None
+        key = (name, version)
+        q = self._by_title.get(key)
+        if q is None and version is not None:
+            # Versioned titles are looked up the first time they're seen and then remembered.
+            # Unrecognised ones aren't, so titles and versions from the archive can't grow the index without limit.
+            q = next((q for q in self._by_name.get(name, []) if f"_v{version}" in q.get("code")), None)
+            if q is not None:
+                self._by_title[key] = q
+        return q
+
+
+REGISTRY = QuestionnaireRegistry(QUESTIONNAIRES)
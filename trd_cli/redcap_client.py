@@ -0,0 +1,75 @@
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from redcap import Project, RedcapError
+from redcap.request import _ContentConfig, _RCRequest
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    Return a `requests.Session` that keeps up to `pool_size` connections to the REDCap server open for reuse.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class RedcapStatusError(RedcapError):
+    """
+    A `RedcapError` with the HTTP `status_code` of the response that REDCap reported the error in.
+    """
+    def __init__(self, content, status_code: int):
+        super().__init__(content)
+        self.status_code = status_code
+
+
+def is_record_rejection(error: Exception) -> bool:
+    """
+    Return whether `error` is REDCap rejecting the records sent to it (a 400 Bad Request) rather than e.g.
+    a bad token, a server error or a network failure, which would fail whatever records were sent.
+
+    Only a `PooledProject` reports the status (as a `RedcapStatusError`), so any other error is not a rejection.
+    """
+    return isinstance(error, RedcapStatusError) and error.status_code == 400
+
+
+class _StatusRCRequest(_RCRequest):
+    """
+    An `_RCRequest` that remembers the HTTP status of the response.
+    """
+    status_code: Optional[int] = None
+
+    def get_content(self, response: requests.Response, *args, **kwargs):
+        self.status_code = response.status_code
+        return _RCRequest.get_content(response, *args, **kwargs)
+
+
+class PooledProject(Project):
+    """
+    A REDCap `Project` whose API requests all go through one (pooled) `requests.Session`.
+
+    PyCap otherwise sends every request through its own module-level session, which we can't size or share.
+    The session is safe to share between the threads importing records concurrently.
+    """
+    def __init__(self, url: str, token: str, session: Optional[requests.Session] = None, **kwargs):
+        super().__init__(url, token, **kwargs)
+        self.session = session if session is not None else make_session()
+
+    def _call_api(self, payload, return_type, file=None):
+        config = _ContentConfig(
+            return_empty_json=return_type == "empty_json",
+            return_bytes=return_type == "file_map",
+        )
+        rcr = _StatusRCRequest(url=self.url, payload=payload, config=config, session=self.session)
+        try:
+            return rcr.execute(
+                verify_ssl=self.verify_ssl,
+                return_headers=return_type == "file_map",
+                file=file,
+                **self._request_kwargs,
+            )
+        except RedcapError as e:
+            raise RedcapStatusError(e.args[0] if e.args else str(e), rcr.status_code) from e
@@ -0,0 +1,155 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Default limits for a single REDCap import request
+DEFAULT_CHUNK_RECORDS = 500
+DEFAULT_CHUNK_BYTES = 2_000_000
+
+
+class ImportResult:
+    """
+    The outcome of importing records into REDCap, record by record.
+    """
+    def __init__(self):
+        self.imported: List[dict] = []
+        # (record, reason) for each record that REDCap rejected
+        self.failed: List[Tuple[dict, str]] = []
+        # The records that weren't imported because the import was stopped by `error`
+        self.stopped: List[dict] = []
+        # The error (other than REDCap rejecting records) that stopped the import, if one did
+        self.error: Optional[str] = None
+        self.requests = 0
+
+    @property
+    def imported_study_ids(self) -> list:
+        return list(dict.fromkeys(r["study_id"] for r in self.imported))
+
+    @property
+    def failed_study_ids(self) -> list:
+        return list(dict.fromkeys([*(r["study_id"] for r, _ in self.failed), *(r["study_id"] for r in self.stopped)]))
+
+    def merge(self, other: "ImportResult"):
+        self.imported.extend(other.imported)
+        self.failed.extend(other.failed)
+        self.stopped.extend(other.stopped)
+        self.error = self.error or other.error
+        self.requests += other.requests
+
+
+def group_by_study_id(records: List[dict]) -> List[List[dict]]:
+    """
+    Group `records` by `study_id`, keeping the groups and the records within them in their original order.
+    """
+    groups = {}
+    for r in records:
+        groups.setdefault(r["study_id"], []).append(r)
+    return list(groups.values())
+
+
+def chunk_records(records: List[dict], max_records: int, max_bytes: int) -> List[List[dict]]:
+    """
+    Split `records` into chunks of at most `max_records` records and `max_bytes` bytes of JSON.
+
+    Records for the same `study_id` always go in the same chunk (in their original order),
+    so a participant with more records than the limits allow gets a chunk to themselves.
+    """
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for group in group_by_study_id(records):
+        group_bytes = sum(len(json.dumps(r)) + 2 for r in group)
+        if len(chunk) > 0 and (len(chunk) + len(group) > max_records or chunk_bytes + group_bytes > max_bytes):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.extend(group)
+        chunk_bytes += group_bytes
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def _import_chunk(redcap_project, chunk: List[dict], stop: threading.Event) -> ImportResult:
+    """
+    Import a chunk of records, bisecting it to isolate the bad records if REDCap rejects it.
+
+    A chunk is split between participants where possible, and otherwise between a participant's
+    records, with the first half imported before the second so their order is kept.
+    Any other error (a bad token, a server or network error) would fail the halves too, so it sets `stop`
+    instead, and neither this chunk nor any after it are sent.
+    """
+    # Imported here so the CLI can read the chunk defaults without importing PyCap
+    from trd_cli.redcap_client import is_record_rejection
+
+    result = ImportResult()
+    if stop.is_set():
+        result.stopped.extend(chunk)
+        return result
+    result.requests += 1
+    try:
+        imported_ids = redcap_project.import_records(chunk, return_content="ids")
+    except Exception as e:
+        if not is_record_rejection(e):
+            if not stop.is_set():
+                stop.set()
+                LOGGER.error(f"Importing into REDCap failed ({e.__class__.__name__}: {e}). Stopping the import.")
+            result.error = f"{e.__class__.__name__}: {e}"
+            result.stopped.extend(chunk)
+            return result
+        groups = group_by_study_id(chunk)
+        if len(chunk) == 1:
+            LOGGER.error(f"REDCap rejected record for study_id {chunk[0]['study_id']}: {e}")
+            result.failed.append((chunk[0], str(e)))
+            return result
+        LOGGER.warning(f"REDCap rejected a chunk of {len(chunk)} records ({e}). Bisecting to find the bad records.")
+        if len(groups) > 1:
+            middle = len(groups) // 2
+            halves = [[r for g in groups[:middle] for r in g], [r for g in groups[middle:] for r in g]]
+        else:
+            middle = len(chunk) // 2
+            halves = [chunk[:middle], chunk[middle:]]
+        for half in halves:
+            result.merge(_import_chunk(redcap_project, half, stop))
+        return result
+
+    imported_ids = set(str(i) for i in imported_ids)
+    for r in chunk:
+        if str(r["study_id"]) in imported_ids:
+            result.imported.append(r)
+        else:
+            result.failed.append((r, "study_id not in the ids REDCap reported as imported"))
+    return result
+
+
+def import_records_chunked(
+        redcap_project,
+        records: List[dict],
+        max_records: int = DEFAULT_CHUNK_RECORDS,
+        max_bytes: int = DEFAULT_CHUNK_BYTES,
+        workers: int = 1,
+) -> ImportResult:
+    """
+    Import `records` into `redcap_project` in chunks that keep within REDCap's request limits.
+
+    Chunks that REDCap rejects are bisected so the good records still land and the bad ones are isolated.
+    Any other error stops the import, and the records that weren't sent are listed in `stopped`.
+    With more than one worker, chunks are uploaded concurrently by a pool of `workers` threads.
+    Each participant's records are all in one chunk, so they are still imported in order.
+    Return the per-record outcome.
+    """
+    result = ImportResult()
+    stop = threading.Event()
+    chunks = chunk_records(records, max_records=max_records, max_bytes=max_bytes)
+    LOGGER.debug(f"Importing {len(records)} records in {len(chunks)} chunks with {workers} workers.")
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="redcap-import") as pool:
+            chunk_results = list(pool.map(lambda c: _import_chunk(redcap_project, c, stop), chunks))
+    else:
+        chunk_results = [_import_chunk(redcap_project, c, stop) for c in chunks]
+    for chunk_result in chunk_results:
+        result.merge(chunk_result)
+    return result
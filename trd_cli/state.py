@@ -0,0 +1,253 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# How often to check the state store against a full REDCap export, by default
+DEFAULT_RECONCILE_HOURS = 24
+
+# Size of the chunks an archive is read in to hash it
+HASH_CHUNK_BYTES = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (
+    id TEXT PRIMARY KEY,
+    study_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS responses (
+    id TEXT NOT NULL,
+    instrument TEXT NOT NULL,
+    response_id TEXT,
+    instance INTEGER,
+    PRIMARY KEY (id, instrument, response_id)
+);
+CREATE TABLE IF NOT EXISTS row_hashes (
+    file TEXT NOT NULL,
+    id TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (file, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def hash_file(path: str) -> str:
+    """
+    Return the SHA-256 hex digest of the file at `path`, reading it a chunk at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_fingerprint(path: str, content_hash: Optional[str] = None) -> dict:
+    """
+    Return the size, modification time and content hash of the archive at `path`.
+    """
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": content_hash if content_hash is not None else hash_file(path),
+    }
+
+
+def hash_row(row: dict) -> bytes:
+    """
+    Return a compact hash of the raw values of a True Colours .csv `row`.
+    """
+    return hashlib.blake2b("\x1f".join(str(v) for v in row.values()).encode("utf-8"), digest_size=16).digest()
+
+
+class RowDelta:
+    """
+    A `skip_row` filter (see `iter_tc_rows`) that drops the rows that are unchanged since the previous archive.
+
+    `previous` maps each file to a map of row `id` to `hash_row` hash, as from `SyncState.get_row_hashes`.
+    The hashes of every row seen, changed or not, are collected in `current` to be saved for the next run.
+    """
+    def __init__(self, previous: Dict[str, Dict[str, bytes]]):
+        self.previous = previous
+        self.current: Dict[str, Dict[str, bytes]] = {}
+        self.skipped = 0
+
+    def __call__(self, file: str, row: dict) -> bool:
+        row_id = row.get("id")
+        digest = hash_row(row)
+        self.current.setdefault(file, {})[row_id] = digest
+        if self.previous.get(file, {}).get(row_id) == digest:
+            self.skipped += 1
+            return True
+        return False
+
+
+class SyncState:
+    """
+    A local SQLite record of what has been synced to REDCap, so runs don't have to export it from REDCap every time.
+
+    It holds the same information as `extract_redcap_ids` gets from a REDCap export:
+    each participant's `study_id` and the response ids (and instances) of their records for each instrument.
+    It is replaced wholesale from a full REDCap export whenever it is reconciled, and updated with the
+    records each run imports.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def last_reconciled(self) -> Optional[datetime.datetime]:
+        value = self.get_meta("last_reconciled")
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    def needs_reconcile(self, hours: float = DEFAULT_RECONCILE_HOURS) -> bool:
+        """
+        Return whether it's more than `hours` since the state was last reconciled with REDCap (or it never has been).
+        """
+        last = self.last_reconciled
+        return last is None or datetime.datetime.now() - last > datetime.timedelta(hours=hours)
+
+    def is_archive_unchanged(self, path: str) -> bool:
+        """
+        Return whether the archive at `path` is the same as the one recorded by the last successful run.
+
+        Archives of a different size have changed. Archives with the same size and modification time are the same.
+        Otherwise (e.g. the same file copied in again) the content hashes are compared.
+        """
+        value = self.get_meta("archive_fingerprint")
+        if value is None:
+            return False
+        last = json.loads(value)
+        stat = os.stat(path)
+        if stat.st_size != last["size"]:
+            return False
+        if stat.st_mtime_ns == last["mtime"]:
+            return True
+        return hash_file(path) == last["sha256"]
+
+    def record_archive(self, path: str):
+        """
+        Record the fingerprint of the archive at `path` as successfully synced.
+        """
+        self.set_meta("archive_fingerprint", json.dumps(archive_fingerprint(path)))
+
+    def get_row_hashes(self) -> Dict[str, Dict[str, bytes]]:
+        """
+        Return the row hashes of the last successfully synced archive, by file and row `id`.
+        """
+        out = {}
+        for file, row_id, digest in self._db.execute("SELECT file, id, hash FROM row_hashes"):
+            out.setdefault(file, {})[row_id] = digest
+        return out
+
+    def set_row_hashes(self, row_hashes: Dict[str, Dict[str, bytes]]):
+        """
+        Replace the row hashes with those of the archive that has just been synced.
+        """
+        with self._db:
+            self._db.execute("DELETE FROM row_hashes")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO row_hashes (file, id, hash) VALUES (?, ?, ?)",
+                [(file, row_id, digest) for file, rows in row_hashes.items() for row_id, digest in rows.items()],
+            )
+
+    def redcap_id_data(self) -> dict:
+        """
+        Return the synced data in the same shape as `extract_redcap_ids`.
+        """
+        # Imported here so the CLI can read DEFAULT_RECONCILE_HOURS without loading the questionnaires
+        from trd_cli.questionnaires import REGISTRY
+        instruments = [*REGISTRY.codes, "private", "info"]
+        out = {}
+        for p_id, study_id in self._db.execute("SELECT id, study_id FROM participants ORDER BY rowid"):
+            out[p_id] = {"study_id": study_id, **{n: [] for n in instruments}}
+        for p_id, instrument, response_id, instance in self._db.execute(
+                "SELECT id, instrument, response_id, instance FROM responses ORDER BY rowid"
+        ):
+            if p_id in out and instrument in out[p_id]:
+                out[p_id][instrument].append((response_id, instance))
+        return out
+
+    def replace(self, redcap_id_data: dict):
+        """
+        Replace the state with `redcap_id_data` (from `extract_redcap_ids`) and mark it as reconciled.
+        """
+        with self._db:
+            self._db.execute("DELETE FROM participants")
+            self._db.execute("DELETE FROM responses")
+            self._db.executemany(
+                "INSERT INTO participants (id, study_id) VALUES (?, ?)",
+                [(p_id, str(p["study_id"])) for p_id, p in redcap_id_data.items() if p_id is not None],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses (id, instrument, response_id, instance) VALUES (?, ?, ?, ?)",
+                [
+                    (p_id, instrument, response_id, instance if instance != "" else None)
+                    for p_id, p in redcap_id_data.items() if p_id is not None
+                    for instrument, responses in p.items() if instrument != "study_id"
+                    for response_id, instance in responses
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_reconciled', ?)",
+                (datetime.datetime.now().isoformat(),)
+            )
+        LOGGER.debug(f"Replaced sync state with {len(redcap_id_data)} participants from REDCap.")
+
+    def record_imported(self, records: List[dict], participant_ids: Dict[str, str]):
+        """
+        Add `records` that have been imported into REDCap to the state.
+
+        `participant_ids` maps each record's `study_id` (as a string) to the participant's True Colours `id`.
+        """
+        from trd_cli.main_functions import get_response_id_from_response_data
+        from trd_cli.questionnaires import REGISTRY
+        participants = []
+        responses = []
+        for r in records:
+            study_id = str(r["study_id"])
+            p_id = participant_ids.get(study_id)
+            if p_id is None:
+                LOGGER.warning(f"No participant id for study_id {study_id}; not recording it in the sync state.")
+                continue
+            instrument = r.get("redcap_repeat_instrument")
+            if instrument is None:
+                instrument = next(
+                    (c for c in REGISTRY.codes if r.get(f"{c}_response_id") not in [None, ""]), None
+                )
+            participants.append((p_id, study_id))
+            response_id = get_response_id_from_response_data(r)
+            responses.append((p_id, instrument, response_id, r.get("redcap_repeat_instance")))
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO participants (id, study_id) VALUES (?, ?)", participants)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses (id, instrument, response_id, instance) VALUES (?, ?, ?, ?)",
+                responses,
+            )
@@ -0,0 +1,454 @@
+import datetime
+import gzip
+import html
+import io
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import click
+import requests
+
+from trd_cli.main_functions import extract_redcap_ids, get_true_colours_data, compare_tc_to_rc, \
+    get_response_id_from_response_data, get_redcap_export_fields, read_redcap_snapshot, next_study_id
+from trd_cli.debug_artifacts import DebugArtifacts
+from trd_cli.metrics import RunMetrics, CountingIterator
+from trd_cli.redcap_client import PooledProject, make_session
+from trd_cli.state import SyncState, RowDelta
+from trd_cli.redcap_import import import_records_chunked
+
+# Construct a logger that saves logged events to a dictionary that we can attach to an email later
+import logging
+from logging.config import dictConfig
+from trd_cli.log_config import CountingHandler, LogQueue, get_config, get_counting_handler, tidy_log_dir, \
+    mark_run_live, DEFAULT_LOG_KEEP_DAYS, DEFAULT_LOG_MAX_BYTES
+
+LOGGER = logging.getLogger(__name__)
+
+
+def gzip_file(path: str) -> bytes:
+    """
+    Return the gzip-compressed contents of the file at `path`.
+    """
+    out = io.BytesIO()
+    with open(path, "rb") as f, gzip.GzipFile(fileobj=out, mode="wb") as gz:
+        shutil.copyfileobj(f, gz)
+    return out.getvalue()
+
+
+def log_digest_html(log_counts: CountingHandler) -> str:
+    """
+    Return the first warnings and errors logged during the run as HTML for the email summary.
+    """
+    if len(log_counts.digest) == 0:
+        return ""
+    records = "\n".join(html.escape(r) for r in log_counts.digest)
+    more = f"<p>... and {log_counts.truncated} more (see the attached log).</p>" if log_counts.truncated else ""
+    return f"""
+    <details>
+        <summary>First {len(log_counts.digest)} warnings and errors</summary>
+        <pre>{records}</pre>
+        {more}
+    </details>"""
+
+
+def sync(
+        rc_url,
+        rc_token,
+        rc_snapshot,
+        tc_archive,
+        mailto,
+        mg_secret,
+        mg_domain,
+        mg_username,
+        dry_run,
+        import_chunk_records,
+        import_chunk_bytes,
+        import_workers,
+        overlap_export,
+        state_db,
+        reconcile_hours,
+        reconcile,
+        force,
+        profile,
+        log_dir,
+        log_level,
+        log_max_bytes=DEFAULT_LOG_MAX_BYTES,
+        log_keep_days=DEFAULT_LOG_KEEP_DAYS,
+        log_format="text",
+        session: Optional[requests.Session] = None,
+        state: Optional[SyncState] = None,
+) -> RunMetrics:
+    """
+    Sync the True Colours archive to REDCap once, with the options of `run`, and return the run's metrics.
+
+    `watch` passes in a `session` and `state` that it keeps open between syncs.
+    Otherwise they are created here, and the state (if there is a `state_db`) is closed afterwards.
+    """
+    # Logfile (and metrics file) has the date and time of the run
+    run_name = f"trd_cli-{datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')}"
+    profiler = None
+    if profile is not None:
+        # Only imported when profiling, so there's no cost otherwise
+        from trd_cli.profiling import Profiler
+        profiler = Profiler(profile, run_name)
+    metrics = RunMetrics(profiler=profiler)
+    close_state = False
+    log_queue = None
+    unpack_executor = None
+    pid_file = None
+    try:
+        log_file = os.path.join(log_dir, f"{run_name}.log")
+        # So that a run that overlaps this one doesn't compress or delete its log while it's being written
+        pid_file = mark_run_live(log_file)
+        dictConfig(get_config(log_file, max_bytes=log_max_bytes, log_format=log_format))
+        # Log records are written to disk by a background thread, so logging never holds up the run
+        log_queue = LogQueue().start()
+        LOGGER.setLevel(log_level)
+        tidy_log_dir(log_dir, log_file, keep_days=log_keep_days)
+        # Big structures (the REDCap ids, the records to upload) go to their own files, and only at DEBUG
+        debug_artifacts = DebugArtifacts(log_dir, run_name, LOGGER)
+        if profiler is not None:
+            profiler.start()
+
+        click.echo("Running TRD CLI")
+
+        # Verify that all environment variables are set
+        click.echo("Checking configuration", nl=False)
+        required = {
+            "rc_url": rc_url,
+            "rc_token": rc_token,
+            "tc_archive": tc_archive,
+        }
+        if rc_snapshot is not None:
+            # Replaying a saved REDCap export is offline: nothing is sent to REDCap (or emailed), and no state is kept
+            required = {"tc_archive": tc_archive}
+            dry_run = True
+            mailto = None
+            state = None
+            state_db = None
+        if mailto is not None:
+            required = {
+                **required,
+                "mailto": mailto,
+                "mg_secret": mg_secret,
+                "mg_domain": mg_domain,
+                "mg_username": mg_username,
+            }
+        for k, v in required.items():
+            if v is None:
+                raise ValueError(f"Missing required argument: {k}")
+        click.echo(" - OK")
+        if rc_snapshot is not None:
+            LOGGER.info(f"Running offline against REDCap snapshot {rc_snapshot}: this is a dry run.")
+
+        row_delta = None
+        if state is None and state_db is not None:
+            state = SyncState(state_db)
+            close_state = True
+        if state is not None:
+            # Reconciling with REDCap may find changes there, so isn't skipped
+            due_to_reconcile = reconcile or state.needs_reconcile(reconcile_hours)
+            if not force and not due_to_reconcile and state.is_archive_unchanged(tc_archive):
+                LOGGER.info(f"True Colours archive {tc_archive} is unchanged since the last successful run.")
+                click.echo("No change in the True Colours archive since the last successful run - SKIPPED")
+                metrics.success = True
+                return metrics
+            # Only rows that have changed since the last successful run need to be compared, unless this is a full run.
+            # The hashes of all the rows are collected either way for next time.
+            row_delta = RowDelta({} if force or due_to_reconcile else state.get_row_hashes())
+
+        # Connect to the True Colours scp server and download the zip dump
+        click.echo("Unpacking True Colours archive", nl=False)
+        if overlap_export:
+            def unpack():
+                with metrics.stage("unpack", thread_cpu=True) as unpack_stage:
+                    data = {k: list(v) for k, v in get_true_colours_data(tc_archive, skip_row=row_delta).items()}
+                    unpack_stage.rows = sum(len(v) for v in data.values())
+                return data
+
+            # The archive is disk and CPU work while the export mostly waits on the network, so they overlap well
+            unpack_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="unpack")
+            unpacked = unpack_executor.submit(unpack)
+            click.echo(" - STARTED")
+        else:
+            with metrics.stage("unpack") as unpack_stage:
+                # The rows are streamed out of the archive as compare_tc_to_rc asks for them,
+                # and the time that takes is added to this stage then
+                tc_data = {
+                    k: CountingIterator(v, stage=unpack_stage)
+                    for k, v in get_true_colours_data(tc_archive, skip_row=row_delta).items()
+                }
+            click.echo(" - OK")
+
+        # Download data from the REDCap API, or read it from a snapshot of a previous download
+        if rc_snapshot is not None:
+            click.echo("Reading REDCap snapshot", nl=False)
+        else:
+            click.echo("Downloading data from REDCap", nl=False)
+        # While the archive is unpacked alongside it, only count the CPU time of the export itself
+        with metrics.stage("export", thread_cpu=overlap_export) as stage:
+            redcap_project = None
+            if rc_snapshot is not None:
+                redcap_records = read_redcap_snapshot(rc_snapshot)
+                stage.rows = len(redcap_records)
+                LOGGER.info(f"Read {len(redcap_records)} records from REDCap snapshot {rc_snapshot}.")
+                redcap_data = extract_redcap_ids(redcap_records)
+            else:
+                if session is None:
+                    session = make_session(pool_size=max(import_workers, 10))
+                metrics.instrument_session(session)
+                redcap_project = PooledProject(rc_url, rc_token, session=session)
+                LOGGER.debug(f"Connected to REDCap project {redcap_project}")
+                if state is not None and not reconcile and not state.needs_reconcile(reconcile_hours):
+                    redcap_data = state.redcap_id_data()
+                    stage.rows = len(redcap_data)
+                    LOGGER.info(
+                        f"Using sync state {state.path} "
+                        f"(last reconciled with REDCap at {state.last_reconciled.isoformat()})."
+                    )
+                else:
+                    redcap_records = redcap_project.export_records(fields=get_redcap_export_fields())
+                    stage.rows = len(redcap_records)
+                    LOGGER.debug(f"Downloaded {len(redcap_records)} records from REDCap.")
+                    if len(redcap_records) > 0:
+                        LOGGER.debug(f"First record: {redcap_records[0]}")
+                    redcap_data = extract_redcap_ids(redcap_records)
+                    if state is not None:
+                        state.replace(redcap_data)
+                        LOGGER.info(f"Reconciled sync state {state.path} with REDCap.")
+            debug_artifacts.write("redcap_ids", ({"id": p_id, **p} for p_id, p in redcap_data.items()))
+        click.echo(" - OK")
+
+        if overlap_export:
+            click.echo("Waiting for True Colours archive", nl=False)
+            with metrics.stage("unpack_wait", thread_cpu=True) as stage:
+                tc_data = {k: CountingIterator(v) for k, v in unpacked.result().items()}
+            unpack_executor.shutdown()
+            unpack_executor = None
+            saved = metrics.stages["unpack"].wall - stage.wall
+            LOGGER.info(
+                f"Unpacked the True Colours archive in {metrics.stages['unpack'].wall:.3f}s alongside the "
+                f"{metrics.stages['export'].wall:.3f}s REDCap export, waiting {stage.wall:.3f}s for it "
+                f"(saving {saved:.3f}s)."
+            )
+            click.echo(" - OK")
+
+        # Compare the True Colours data to the REDCap data
+        click.echo("Comparing True Colours data to REDCap data", nl=False)
+
+        unpack_stage = metrics.stages["unpack"]
+        unpacked_wall, unpacked_cpu = unpack_stage.wall, unpack_stage.cpu
+        with metrics.stage("compare") as stage:
+            new_participants, new_responses = compare_tc_to_rc(tc_data=tc_data, redcap_id_data=redcap_data)
+            stage.rows = sum(rows.count for rows in tc_data.values())
+            # Don't count the time spent streaming rows out of the archive twice
+            stage.wall -= unpack_stage.wall - unpacked_wall
+            stage.cpu -= unpack_stage.cpu - unpacked_cpu
+        if row_delta is not None and row_delta.skipped > 0:
+            LOGGER.info(
+                f"Skipped {row_delta.skipped} True Colours rows that are unchanged since the last successful run."
+            )
+        LOGGER.debug(f"{len(new_participants)} new participants, {len(new_responses)} new responses.")
+        failed_pids = []
+        unique_ids = set()
+
+        id_map = {}
+        if len(new_participants) > 0:
+            LOGGER.info(
+                f"Generating record names for {len(new_participants)} new participants: {', '.join(new_participants)}."
+            )
+            with metrics.stage("record_names"):
+                if redcap_project is None:
+                    # Offline, so number them on from the snapshot
+                    record_names_start_at = next_study_id(redcap_data)
+                else:
+                    record_names_start_at = int(redcap_project.generate_next_record_name())
+            for i, p_id in enumerate(new_participants):
+                try:
+                    new_id = record_names_start_at + i
+                    id_map[p_id] = new_id
+                except Exception as e:
+                    LOGGER.exception(e)
+            debug_artifacts.write("id_map", ({"id": p_id, "study_id": study_id} for p_id, study_id in id_map.items()))
+
+        if len(new_responses) > 0:
+            patched_responses = []
+            for r in new_responses:
+                if isinstance(r["study_id"], str) and r["study_id"].startswith("__NEW__"):
+                    p_id = r["study_id"][7:]
+                    if p_id not in id_map:
+                        LOGGER.error(f"{p_id} not in id_map for response {json.dumps(r)}")
+                    else:
+                        r["study_id"] = id_map[p_id]
+                patched_responses.append(r)
+            # Sort patched_responses by study_id so we obey REDCap's sequential ordering in the request.
+            # Existing study_ids come from REDCap as strings and new ones are ints, so compare them as numbers.
+            patched_responses = sorted(
+                patched_responses, key=lambda x: (len(str(x["study_id"])), str(x["study_id"]))
+            )
+            debug_artifacts.write("new_records", patched_responses)
+            unique_ids = set([x["study_id"] for x in patched_responses])
+            if not dry_run:
+                with metrics.stage("import") as stage:
+                    import_result = import_records_chunked(
+                        redcap_project,
+                        patched_responses,
+                        max_records=import_chunk_records,
+                        max_bytes=import_chunk_bytes,
+                        workers=import_workers,
+                    )
+                    stage.rows = len(patched_responses)
+                LOGGER.debug(f"Imported records in {import_result.requests} REDCap requests.")
+                if state is not None:
+                    participant_ids = {str(p["study_id"]): p_id for p_id, p in redcap_data.items()}
+                    participant_ids.update({str(study_id): p_id for p_id, study_id in id_map.items()})
+                    state.record_imported(import_result.imported, participant_ids)
+                failed_pids = import_result.failed_study_ids
+                if len(failed_pids) > 0:
+                    LOGGER.error(
+                        (
+                            f"Failed to import new questionnaire responses. "
+                            f"Failed for {len(failed_pids)}, succeeded for {len(import_result.imported_study_ids)}."
+                        )
+                    )
+                    LOGGER.error(f"Failed study_ids: {json.dumps(failed_pids, indent=4, default=str)}")
+                    if import_result.error is not None:
+                        LOGGER.error(
+                            f"{len(import_result.stopped)} records were not sent to REDCap "
+                            f"because the import stopped: {import_result.error}"
+                        )
+                    for record, reason in import_result.failed:
+                        LOGGER.error(
+                            (
+                                f"Failed record: study_id {record['study_id']}, "
+                                f"TC id: {get_response_id_from_response_data(record)} -> "
+                                f"{record.get('redcap_repeat_instrument', 'consent')}: {reason}"
+                            )
+                        )
+                if len(import_result.imported) > 0:
+                    pid_qid_map = {}
+                    for x in import_result.imported:
+                        pid_qid_map.setdefault(str(x["study_id"]), []).append(
+                            (
+                                f"TC id: {get_response_id_from_response_data(x)} -> "
+                                f"{x.get('redcap_repeat_instrument', 'consent')}"
+                            )
+                        )
+                    LOGGER.info(
+                        (
+                            f"Added {len(import_result.imported)} new questionnaire "
+                            f"responses for {len(pid_qid_map)} participants: "
+                            f"{json.dumps(pid_qid_map, indent=4)}."
+                        )
+                    )
+
+        click.echo(" - OK")
+        click.echo(
+            f"\t{len(new_responses)} new responses for {len(unique_ids)} participants ({len(new_participants)} new)."
+        )
+        if len(failed_pids) > 0:
+            click.echo(f"\tImport failed for {len(failed_pids)} participants: {failed_pids}.", err=True)
+        metrics.success = len(failed_pids) == 0
+        if state is not None and metrics.success and not dry_run:
+            state.record_archive(tc_archive)
+            state.set_row_hashes(row_delta.current)
+        LOGGER.info(
+            "Stage timings: " + ", ".join(
+                f"{name} {stage.wall:.2f}s" for name, stage in metrics.stages.items()
+            ) + f". {sum(r.count for r in metrics.requests.values())} REDCap requests."
+        )
+
+        # Errors and warnings are counted as they are logged
+        log_queue.flush()
+        log_counts = get_counting_handler()
+        error_count = log_counts.errors
+        warning_count = log_counts.warnings
+
+        # Send email summary
+        if mailto is not None:
+            click.echo("Sending email summary", nl=False)
+
+            if (
+                    len(new_responses) == 0
+                    and error_count == 0
+                    and warning_count == 0
+            ):
+                click.echo(" - SKIPPED: No changes detected.")
+                return metrics
+
+            if len(new_participants) == 0 and len(new_responses) == 0:
+                change_list = None
+            else:
+                if len(failed_pids) > 0:
+                    failed_str = (
+                        f"Import failed for {len(failed_pids)} participants: {json.dumps(failed_pids, indent=4)}."
+                    )
+                else:
+                    failed_str = ""
+                change_list = f"""
+<h2>Changes</h2>
+    <p>
+        {len(new_responses)} new responses added for {len(unique_ids)} participants ({len(new_participants)} new).
+        {failed_str}
+    </p>
+</h2>
+                """
+
+            email_html = f"""
+<html>
+<body>
+<h1>True Colours -> REDCap Data Comparison Summary</h1>
+{change_list if change_list else ""}
+<h2>Log Summary</h2>
+    <p>Log File ({error_count} Errors, {warning_count} Warnings) attached as {run_name}.log.gz.</p>
+{log_digest_html(log_counts)}
+</h2>
+</body>
+</html>
+        """
+
+            url = f"https://api.mailgun.net/v3/{mg_domain}/messages"
+
+            data = {
+                "from": f"TRD CLI <mailgun@{mg_domain}>",
+                "to": mailto,
+                "subject": f"TRD CLI Summary{' [DRY RUN]' if dry_run else ''}",
+                "html": email_html,
+            }
+
+            # The full log is attached compressed rather than inlined, so big (e.g. DEBUG) logs don't bloat the email
+            files = [("attachment", (f"{run_name}.log.gz", gzip_file(log_file), "application/gzip"))]
+
+            response = requests.post(
+                url, data=data, files=files, auth=(mg_username, mg_secret)
+            )
+            response.raise_for_status()
+            click.echo(" - OK")
+
+    except Exception as e:
+        metrics.success = False
+        metrics.error = e
+        click.echo(" - ERROR", err=True)
+        LOGGER.exception(e)
+        click.echo(f"{e.__class__.__name__}: {e}", err=True)
+    finally:
+        if unpack_executor is not None:
+            unpack_executor.shutdown(wait=False, cancel_futures=True)
+        if close_state:
+            state.close()
+        if session is not None:
+            metrics.release_session(session)
+        try:
+            if profiler is not None:
+                profiler.stop()
+            metrics.write(log_dir, f"{run_name}.metrics.json")
+        except Exception as e:
+            LOGGER.exception(e)
+        if log_queue is not None:
+            log_queue.stop()
+        if pid_file is not None:
+            os.remove(pid_file)
+    return metrics
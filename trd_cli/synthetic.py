@@ -0,0 +1,299 @@
+import csv
+import io
+import json
+import os
+import random
+import zipfile
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from trd_cli.conversions import QuestionnaireMetadata
+from trd_cli.main_functions import compare_tc_to_rc, get_redcap_export_fields
+from trd_cli.parse_tc import JSON_FIELDS
+from trd_cli.questionnaires import QUESTIONNAIRES
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# Column headers of the True Colours export files
+PATIENT_FIELDS = [
+    "id", "nhsnumber", "lastresponse", "birthdate", "gender", "contactemail", "mobilenumber", "userid", "created",
+    "updated", "active", "firstname", "lastname", "deceasedboolean", "deceaseddatetime", "integrationid",
+    "tenantid", "preferredcontact", "dashboardquestionnaireid", "custompatientid", "schedulelock",
+]
+RESPONSE_FIELDS = [
+    "id", "questionnaireid", "staffid", "patientid", "caseloadid", "responses", "scores", "submitted", "version",
+    "created", "updated", "active", "tenantid", "scheduleid", "interoperability", "interoperabilitysubmitted",
+    "state", "loadsection", "senttoexternalreport", "editedstaffid",
+]
+
+# Consent has 19 questions, of which 18 is a signature
+CONSENT_QUESTIONS = 19
+FIRST_NAMES = ["Alex", "Sam", "Jo", "Chris", "Pat", "Robin", "Charlie", "Jamie", "Morgan", "Taylor"]
+LAST_NAMES = ["Smith", "Jones", "Taylor", "Brown", "Williams", "Wilson", "Evans", "Thomas", "Roberts", "Walker"]
+DISPLAY_VALUES = ["Not at all", "Several days", "More than half the days", "Nearly every day"]
+# Synthetic data starts from a fixed date so that it's the same every time
+START_DATE = datetime(2024, 1, 1)
+
+
+def format_timestamp(t: datetime) -> str:
+    """
+    Format `t` the way True Colours exports timestamps, e.g. `2024-11-04 12:59:24.973`.
+    """
+    return t.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+class SyntheticArchive:
+    """
+    Deterministic, realistic True Colours data for scale testing and benchmarking.
+
+    Patients and questionnaire responses are generated from `seed`, with responses to every questionnaire
+    in `QUESTIONNAIRES` (as long as there are at least as many responses as questionnaires).
+    `incomplete` is the fraction of responses that were started but never submitted, which
+    (like those in real exports) have no `interoperability` data.
+
+    `patients` and `responses` hold the rows as `parse_tc` would read them, with the response JSON fields decoded.
+    """
+    def __init__(
+            self,
+            n_patients: int,
+            n_responses: int,
+            seed: int = 0,
+            incomplete: float = 0.1,
+            questionnaires: List[QuestionnaireMetadata] = None,
+    ):
+        self.seed = seed
+        self.questionnaires = questionnaires if questionnaires is not None else QUESTIONNAIRES
+        self._rng = random.Random(seed)
+        ids = self._rng.sample(range(10 ** 8, 2 ** 31), n_patients + n_responses)
+        self.patients: List[dict] = [self._patient(ids[i]) for i in range(n_patients)]
+        self.responses: List[dict] = []
+        consented = set()
+        repeating = [q for q in self.questionnaires if q.get("repeat_instrument", True)]
+        for i in range(n_responses):
+            patient = self._rng.choice(self.patients)
+            if i < len(self.questionnaires):
+                # Make sure every questionnaire is represented
+                questionnaire = self.questionnaires[i]
+            else:
+                questionnaire = self._rng.choice(self.questionnaires)
+            if not questionnaire.get("repeat_instrument", True) and patient["id"] in consented:
+                questionnaire = self._rng.choice(repeating)
+            if not questionnaire.get("repeat_instrument", True):
+                consented.add(patient["id"])
+            submitted = START_DATE + timedelta(minutes=10 * i + self._rng.randint(0, 9))
+            self.responses.append(
+                self._response(ids[n_patients + i], patient, questionnaire, submitted, self._rng.random() < incomplete)
+            )
+
+    def _patient(self, p_id: int) -> dict:
+        rng = self._rng
+        created = START_DATE - timedelta(days=rng.randint(1, 365), seconds=rng.randint(0, 86399))
+        updated = created + timedelta(seconds=rng.randint(0, 86399))
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        return {
+            **{k: "" for k in PATIENT_FIELDS},
+            "id": str(p_id),
+            "nhsnumber": str(rng.randint(10 ** 9, 10 ** 10 - 1)),
+            "lastresponse": format_timestamp(updated),
+            "birthdate": f"{rng.randint(1940, 2006)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "gender": str(rng.randint(0, 1)),
+            "contactemail": f"{first_name}.{last_name}{p_id}@example.com".lower(),
+            "mobilenumber": f"+44 7{rng.randint(0, 999):03d} {rng.randint(0, 999999):06d}",
+            "userid": str(rng.randint(10 ** 8, 2 ** 31)),
+            "created": format_timestamp(created),
+            "updated": format_timestamp(updated),
+            "active": "true",
+            "firstname": first_name,
+            "lastname": last_name,
+            "tenantid": "6",
+            "preferredcontact": str(rng.randint(0, 1)),
+        }
+
+    def _question_scores(self, questionnaire: QuestionnaireMetadata) -> List[dict]:
+        rng = self._rng
+        if questionnaire["code"] == "consent":
+            return [
+                {
+                    "QuestionNumber": i + 1,
+                    "QuestionShortName": f"Consent {i + 1}",
+                    "Score": None,
+                    "MaxScore": None,
+                    "Snomed": None,
+                    "DisplayValue": rng.choice(["Yes", "No"]),
+                } for i in range(CONSENT_QUESTIONS)
+            ]
+        scores = []
+        for i, item in enumerate(questionnaire["items"]):
+            score = rng.randint(0, 3)
+            scores.append({
+                "QuestionNumber": i + 1,
+                "QuestionShortName": item.replace("_", " ").capitalize(),
+                "Score": float(score),
+                "MaxScore": 3.0,
+                "Snomed": None,
+                "DisplayValue": DISPLAY_VALUES[score],
+            })
+        return scores
+
+    def _response(
+            self,
+            r_id: int,
+            patient: dict,
+            questionnaire: QuestionnaireMetadata,
+            submitted: datetime,
+            incomplete: bool,
+    ) -> dict:
+        rng = self._rng
+        question_scores = self._question_scores(questionnaire)
+        total = sum(q["Score"] or 0 for q in question_scores)
+        scores = {
+            "QuestionScores": question_scores,
+            "CategoryScores": [
+                {
+                    "Name": c,
+                    "Score": total,
+                    "MaxScore": 3.0 * len(question_scores),
+                    "Tscore": None,
+                    "HideGraph": False,
+                    "ScoreStatus": 0,
+                    "IsTotal": c == "Total",
+                    "Snomed": None,
+                    "InvalidatesTotal": False,
+                    "NumberSkipped": 0,
+                    "SkippedWarningThreshold": None,
+                    "DisplayValue": str(total),
+                } for c in questionnaire["scores"]
+            ],
+        }
+        questionnaire_id = 10 ** 8 + self.questionnaires.index(questionnaire)
+        created = submitted - timedelta(seconds=rng.randint(10, 600))
+        return {
+            **{k: "" for k in RESPONSE_FIELDS},
+            "id": str(r_id),
+            "questionnaireid": str(questionnaire_id),
+            "patientid": patient["id"],
+            "responses": [
+                {"Number": q["QuestionNumber"], "Answer": q["DisplayValue"]} for q in question_scores
+            ],
+            "scores": None if incomplete else scores,
+            "submitted": "" if incomplete else format_timestamp(submitted),
+            "version": "1",
+            "created": format_timestamp(created),
+            "updated": format_timestamp(submitted),
+            "active": "true",
+            "tenantid": "6",
+            "interoperability": None if incomplete else {
+                "version": 1,
+                "scores": scores,
+                "submitted": submitted.isoformat() + "+00:00",
+                "questionnaireid": questionnaire_id,
+                "id": r_id,
+                "tenant": "TRD",
+                "patientid": None,
+                "title": questionnaire["name"],
+                "type": "Questionnaire",
+                "active": True,
+            },
+            "state": "0" if incomplete else "2",
+        }
+
+    def tc_data(self) -> Dict[str, List[dict]]:
+        """
+        Return the data in the shape `parse_tc` returns it.
+        """
+        return {"patient.csv": self.patients, "questionnaireresponse.csv": self.responses}
+
+    def write(self, output: str):
+        """
+        Write a True Colours export to `output`, which is a .zip archive unless it is an existing directory.
+        """
+        files = {
+            "patient.csv": (PATIENT_FIELDS, self.patients),
+            "questionnaireresponse.csv": (RESPONSE_FIELDS, self.responses),
+        }
+        if os.path.isdir(output):
+            for file, (fields, rows) in files.items():
+                with open(os.path.join(output, file), "w", newline="", encoding="utf-8") as f:
+                    write_tc_csv(f, fields, rows)
+            return
+        with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for file, (fields, rows) in files.items():
+                # Set the member's date so the archive's bytes only depend on the seed
+                info = zipfile.ZipInfo(file, date_time=START_DATE.timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, "w") as raw:
+                    with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                        write_tc_csv(f, fields, rows)
+
+    def redcap_export(self, synced: float = 0.5) -> List[dict]:
+        """
+        Return a REDCap export of the records for a partially synced state, as `trd-cli run` would download it.
+
+        A `synced` fraction of the patients are in REDCap, each with the earliest `synced` fraction of their
+        questionnaire responses.
+        Study ids are allocated in patient order, whether or not the patient is synced.
+        """
+        rng = random.Random(self.seed)
+        # Incomplete responses are never imported, so leave them out rather than have them logged
+        submitted = [r for r in self.responses if r["interoperability"] is not None]
+        _, records = compare_tc_to_rc({"patient.csv": self.patients, "questionnaireresponse.csv": submitted}, {})
+        study_ids = {p["id"]: str(i + 1) for i, p in enumerate(self.patients)}
+        synced_ids = set(p["id"] for p in self.patients if rng.random() < synced)
+        by_patient: Dict[str, List[dict]] = {}
+        for r in records:
+            by_patient.setdefault(r["study_id"][len("__NEW__"):], []).append(r)
+
+        fields = [f for f in get_redcap_export_fields() if f != "study_id"]
+        out = []
+        for p_id, p_records in by_patient.items():
+            if p_id not in synced_ids:
+                continue
+            participant, responses = p_records[:2], p_records[2:]
+            for r in participant + responses[:round(len(responses) * synced)]:
+                out.append({
+                    "study_id": study_ids[p_id],
+                    "redcap_repeat_instrument": r.get("redcap_repeat_instrument", ""),
+                    "redcap_repeat_instance": r.get("redcap_repeat_instance", ""),
+                    **{f: str(r.get(f, "")) for f in fields},
+                    "id": p_id,
+                })
+        return out
+
+
+def write_tc_csv(f: io.TextIOBase, fields: List[str], rows: List[dict]):
+    """
+    Write `rows` to `f` in the True Colours (pipe-separated) export format, JSON-encoding the response fields.
+    """
+    f.write("|".join(f'"{k}"' for k in fields) + "\n")
+    writer = csv.writer(f, delimiter="|", lineterminator="\n")
+    for row in rows:
+        writer.writerow([
+            ("" if row[k] is None else json.dumps(row[k], separators=(",", ":"))) if k in JSON_FIELDS else row[k]
+            for k in fields
+        ])
+
+
+def generate_archive(
+        output: str,
+        n_patients: int,
+        n_responses: int,
+        seed: int = 0,
+        redcap_export: str = None,
+        synced: float = 0.5,
+) -> Tuple[SyntheticArchive, List[dict]]:
+    """
+    Write a synthetic True Colours export to `output`, and optionally a matching REDCap export (JSON) to `redcap_export`.
+
+    Return the archive and the REDCap export records (empty if `redcap_export` isn't given).
+    """
+    archive = SyntheticArchive(n_patients, n_responses, seed=seed)
+    archive.write(output)
+    LOGGER.info(f"Wrote {n_patients} patients and {n_responses} responses to {output}.")
+    records = []
+    if redcap_export is not None:
+        records = archive.redcap_export(synced=synced)
+        with open(redcap_export, "w") as f:
+            json.dump(records, f, indent=4)
+        LOGGER.info(f"Wrote {len(records)} REDCap records to {redcap_export}.")
+    return archive, records
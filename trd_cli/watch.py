@@ -0,0 +1,196 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+
+if TYPE_CHECKING:
+    from trd_cli.metrics import RunMetrics
+
+import logging
+LOGGER = logging.getLogger(__name__)
+
+# How often to check the archive for changes when inotify isn't available
+DEFAULT_POLL_SECONDS = 5.0
+# How long the archive must go without changing before it's synced, so a half-written drop isn't read
+DEFAULT_SETTLE_SECONDS = 5.0
+# How often to sync when the archive doesn't change
+DEFAULT_INTERVAL_SECONDS = 3600.0
+# The health file `watch` keeps up to date, in its --log-dir
+HEALTH_FILE = "trd_cli.health.json"
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Return the inode, size and modification time of the file at `path`, or None if there is no file there.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class PollingWatcher:
+    """
+    Watch the file at `path` for changes by checking its `file_signature` every `poll_seconds`.
+    """
+    def __init__(self, path: str, poll_seconds: float = DEFAULT_POLL_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._last = file_signature(path)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for the file to change. Return whether it did.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            signature = file_signature(self.path)
+            if signature != self._last:
+                self._last = signature
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_seconds, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Watch the file at `path` for changes with Linux inotify, called through ctypes.
+
+    The file's directory is watched rather than the file itself, so a new archive that is moved into place
+    (replacing the inode) is seen as well as one written over the old file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._name = os.fsencode(os.path.basename(path))
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+        directory = os.fsencode(os.path.dirname(os.path.abspath(path)))
+        if libc.inotify_add_watch(self._fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed: {os.strerror(errno)}")
+
+    def _read_events(self) -> bool:
+        """
+        Read the pending events and return whether any of them were for the watched file.
+        """
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _wd, _mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            if data[offset:offset + length].rstrip(b"\0") == self._name:
+                changed = True
+            offset += length
+        return changed
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for the file to change. Return whether it did.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if ready and self._read_events():
+                return True
+            if remaining <= 0:
+                return False
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(path: str, poll_seconds: float = DEFAULT_POLL_SECONDS):
+    """
+    Return an `InotifyWatcher` for `path` where inotify is available, otherwise a `PollingWatcher`.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError) as e:
+            LOGGER.warning(f"Can't watch {path} with inotify ({e}); polling every {poll_seconds}s instead.")
+    return PollingWatcher(path, poll_seconds)
+
+
+class WatchHealth:
+    """
+    The health of a `trd-cli watch` process, written as JSON to `path` whenever it changes.
+
+    Monitoring can alert on a stale `updated` time, on `consecutive_failures`, or on the `last_cycle`
+    (which holds the last sync's metrics, as `RunMetrics.to_dict`).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.started = time.time()
+        self.cycles = 0
+        self.consecutive_failures = 0
+        self.last_cycle: Optional[dict] = None
+
+    def record(self, metrics: "RunMetrics", trigger: str):
+        """
+        Record a sync, started because of `trigger` ("start", "change" or "interval").
+        """
+        self.cycles += 1
+        self.consecutive_failures = 0 if metrics.success else self.consecutive_failures + 1
+        self.last_cycle = {"trigger": trigger, "finished": time.time(), **metrics.to_dict()}
+
+    def write(self, status: str, next_cycle: Optional[float] = None):
+        """
+        Write the health file, replacing it atomically so it is never read half-written.
+        """
+        health = {
+            "status": status,
+            "pid": os.getpid(),
+            "started": self.started,
+            "updated": time.time(),
+            "cycles": self.cycles,
+            "consecutive_failures": self.consecutive_failures,
+            "next_cycle": next_cycle,
+            "last_cycle": self.last_cycle,
+        }
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(health, f, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def _interrupt(_signum, _frame):
+    raise KeyboardInterrupt()
+
+
+@contextmanager
+def stop_on_sigterm() -> Iterator[None]:
+    """
+    Treat SIGTERM (e.g. from systemd stopping the service) like Ctrl-C while in this context.
+    """
+    previous = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)